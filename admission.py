@@ -0,0 +1,143 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+
+class _Waiter:
+    __slots__ = ("event", "loop", "future", "granted")
+
+    def __init__(self, event=None, loop=None, future=None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+    def notify(self) -> None:
+        if self.event is not None:
+            self.event.set()
+        elif not self.future.done():
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class AdmissionController:
+    """
+    LLM生成の同時実行数を制限するアドミッション制御
+
+    生成枠（max_concurrent）が埋まっている間、後続のリクエストは上限付きの待ち行列
+    （max_queue）で順番を待つ。待ち行列が満杯、または queue_timeout 秒以内に枠が
+    空かなかったリクエストは生成を行わず、キャッシュのみのモードに切り替える（shed）。
+    同期版（スレッド）と非同期版（asyncio）のどちらのハンドラからも使える。
+    """
+
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 16, queue_timeout: float = 10.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()
+
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+
+    def _try_admit_locked(self) -> str:
+        """枠があれば確保して 'admitted'、待ち行列に並べるなら 'wait'、満杯なら 'shed' を返す"""
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self.admitted += 1
+            return "admitted"
+        if len(self._waiters) >= self.max_queue:
+            self.shed_queue_full += 1
+            return "shed"
+        return "wait"
+
+    def _abandon_locked(self, waiter: _Waiter) -> bool:
+        """待ちを諦める。その直前に枠が譲られていた場合は True（枠を保持している）"""
+        if waiter.granted:
+            return True
+        self._waiters.remove(waiter)
+        self.shed_timeout += 1
+        return False
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """生成枠を取得する（ブロッキング）。取得できなければ False"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._lock:
+            decision = self._try_admit_locked()
+            if decision != "wait":
+                return decision == "admitted"
+            waiter = _Waiter(event=threading.Event())
+            self._waiters.append(waiter)
+
+        if waiter.event.wait(timeout):
+            return True
+        with self._lock:
+            return self._abandon_locked(waiter)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        """acquire の非同期版（イベントループをブロックしない）"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            decision = self._try_admit_locked()
+            if decision != "wait":
+                return decision == "admitted"
+            waiter = _Waiter(loop=loop, future=loop.create_future())
+            self._waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self._lock:
+                return self._abandon_locked(waiter)
+        except asyncio.CancelledError:
+            with self._lock:
+                holding = self._abandon_locked(waiter)
+            if holding:
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """生成枠を返却する。待っているリクエストがあれば先頭に枠を譲る"""
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                self.admitted += 1
+            else:
+                self._active -= 1
+                return
+        waiter.notify()
+
+    @property
+    def overloaded(self) -> bool:
+        """生成枠が埋まり、待ち行列にもリクエストがある状態"""
+        return self._active >= self.max_concurrent and len(self._waiters) > 0
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "active_generations": self._active,
+            "max_concurrent_generations": self.max_concurrent,
+            "queue_depth": len(self._waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_timeout": self.shed_timeout,
+            "shed_total": self.shed_queue_full + self.shed_timeout
+        }
+
+
+admission_controller = AdmissionController(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_GENERATIONS", "8")),
+    max_queue=int(os.getenv("GENERATION_QUEUE_SIZE", "16")),
+    queue_timeout=float(os.getenv("GENERATION_QUEUE_TIMEOUT", "10"))
+)
@@ -1,43 +1,71 @@
 import gradio as gr
 from dotenv import load_dotenv
 from langchain_community.chat_message_histories import ChatMessageHistory
-from badminton_utils import search_cached_answer_badminton, store_response_in_pinecone_badminton, store_response_in_pinecone
+from badminton_utils import search_cached_answer_badminton, search_cached_answer_badminton_async
+from cache_writer import cache_write_queue
 import signal
 import sys
-from badminton_engine import chat_badminton_simple, get_badminton_index
+from badminton_engine import GENERATION_ERROR_MESSAGE, generate_badminton_stream, generate_badminton_stream_async, get_badminton_index, is_schedule_question, lookup_executor
+from badminton_utils import canonical_point_id, get_schedule_response
+from admission import admission_controller
 import os
 from datetime import datetime
-import boto3
-from decimal import Decimal
-from save_dynamo import save_to_dynamodb_async
-import uuid
-from qdrant_client import QdrantClient
+from save_dynamo import save_to_dynamodb_async, chat_log_sink
+from embedding_cache import EmbeddingContext
+from clients import get_qdrant_client, get_async_qdrant_client, close_clients
 import time
+import asyncio
+import contextvars
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from observability import logger, metrics, start_trace
+from resilience import circuit_breakers, hedge_metrics, start_deadline
+from embedding_cache import embedding_cache
+from question_cache import question_answer_cache
+from cache_mirror import cache_mirror
+from cache_snapshot import mirror_sync, snapshot_writer, warm_cache_mirror
+from hit_recorder import hit_recorder
+from intent_router import intent_router
+from coalescer import generation_coalescer
+from context_builder import context_builder
+from cache_compaction import CACHE_COMPACTION_ENABLED, start_compaction_scheduler, stop_compaction_scheduler
 
 load_dotenv()
 
 badminton_index = None
 qdrant_client = None
+async_qdrant_client = None
 MAX_HISTORY_LENGTH = 4
+ERROR_MESSAGE_TEMPLATE = "申し訳ございません、回答の生成中にエラーが発生しました。しばらくしてから再度お試しください。（{error}）"
 
-def respond_badminton(message, chat_history):      
-    global badminton_index, qdrant_client
-    
-    overall_start_time = time.time()
-    
-    print("=" * 60)
-    print("[BADMINTON] 処理開始")
-    print(f"[BADMINTON] 受信メッセージ: '{message}'")
-    print(f"[BADMINTON] 現在の履歴件数: {len(chat_history) if chat_history else 0}")
-    print(f"[BADMINTON] インデックス状態: {'初期化済み' if badminton_index is not None else '未初期化'}")
-    
-    user_info = {
-        'ip': 'Webアプリ経由',
-        'timestamp': datetime.now().isoformat()
-    }
-    
-    # 履歴変換
-    print("[BADMINTON] 履歴変換開始...")
+# 高負荷時（生成枠・待ち行列が埋まったとき）に新規生成の代わりに返すメッセージ
+BUSY_MESSAGE = "申し訳ございません、ただいま大変混み合っているため新しい回答を作成できませんでした。少し時間をおいて再度お試しください。"
+
+# Gradio側の同時実行数とキューの上限
+CHAT_CONCURRENCY_LIMIT = int(os.getenv("CHAT_CONCURRENCY_LIMIT", "32"))
+CHAT_QUEUE_MAX_SIZE = int(os.getenv("CHAT_QUEUE_MAX_SIZE", "100"))
+
+# true の場合は badminton-cache をメモリにミラーしてローカルで類似検索する
+CACHE_MIRROR_ENABLED = os.getenv("CACHE_MIRROR_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# これより古いスナップショットは使わずにコレクション全体を読み直す（秒）
+CACHE_SNAPSHOT_MAX_AGE = float(os.getenv("CACHE_SNAPSHOT_MAX_AGE", "86400"))
+
+# true の場合は AsyncOpenAI / AsyncQdrantClient を使う非同期パイプラインで応答する
+ASYNC_PIPELINE = os.getenv("ASYNC_PIPELINE", "true").lower() in ("1", "true", "yes")
+
+def _log_request_start(message, chat_history):
+    trace_id = start_trace()
+    # 以降の外部呼び出しの持ち時間はこの締め切りから割り当てる
+    start_deadline()
+    logger.info("[BADMINTON] 処理開始 trace=%s message=%r", trace_id, message[:50])
+    logger.debug("[BADMINTON] 現在の履歴件数: %d / インデックス: %s",
+                 len(chat_history) if chat_history else 0,
+                 '初期化済み' if badminton_index is not None else '未初期化')
+
+def _build_history(chat_history):
+    """Gradioの履歴（messages形式）を ChatMessageHistory に変換"""
     history = ChatMessageHistory()
     
     if chat_history:
@@ -45,122 +73,421 @@ def respond_badminton(message, chat_history):
             if isinstance(chat_message, dict):
                 role = chat_message.get('role', 'unknown')
                 content = chat_message.get('content', '')
-                print(f"🏸 [BADMINTON] 履歴{i+1}: {role} -> {content[:30]}...")
+                logger.debug("[BADMINTON] 履歴%d: %s -> %s...", i + 1, role, content[:30])
                 
                 if role == 'user':
                     history.add_user_message(content)
                 elif role == 'assistant':
                     history.add_ai_message(content)
     
-    print(f"[BADMINTON] 履歴変換完了: {len(history.messages)}メッセージ")
+    logger.debug("[BADMINTON] 履歴変換完了: %dメッセージ", len(history.messages))
+    return history
 
-    # キャッシュ検索
-    print("[BADMINTON] キャッシュ検索開始...")
-    try:
-        cached_result = search_cached_answer_badminton(message, qdrant_client)    
-        print(f"[BADMINTON] キャッシュ検索結果: {cached_result}")
-    except Exception as e:
-        print(f"[ERROR] キャッシュ検索でエラー: {e}")
-        cached_result = {"found": False}
+def _cached_bot_message(cached_result, overall_start_time):
+    """キャッシュヒット時の回答と処理時間"""
+    bot_message = cached_result.get("answer") or cached_result.get("text") or "回答が見つかりませんでした"
+    processing_time = time.time() - overall_start_time
+    
+    logger.info("[BADMINTON] キャッシュヒット (%s): 類似度 %.3f / %.3f秒 / %d文字",
+                cached_result.get('cache_level', 'L2'), cached_result.get('score', 0), processing_time, len(bot_message))
+    return bot_message, processing_time
 
-    processing_time = None
-    saved_vector_id = None
+def _shed_bot_message(message, overall_start_time):
+    """
+    過負荷時のキャッシュのみモードの回答
 
-    if cached_result.get("found"):
-        # キャッシュヒット
-        bot_message = cached_result.get("answer") or cached_result.get("text") or "回答が見つかりませんでした"
-        processing_time = time.time() - overall_start_time
-        saved_vector_id = cached_result.get('vector_id')
-        
-        print(f"[BADMINTON] キャッシュヒット！")
-        print(f"[BADMINTON] 類似度: {cached_result.get('score', 0):.3f}")
-        print(f"[BADMINTON] 処理時間: {processing_time:.3f}秒")
-        print(f"[BADMINTON] 回答長: {len(bot_message)}文字")
+    スケジュールの質問ならメモリ内スナップショットのテンプレート回答を返し、
+    それ以外は混雑メッセージを返す（LLMは呼ばない）。
+    """
+    logger.warning("[ADMISSION] 過負荷のため生成をスキップ: %s", admission_controller.metrics())
+    if is_schedule_question(message):
+        bot_message = get_schedule_response(message)
     else:
-        # 新規生成
-        print("[BADMINTON] キャッシュミス -> 新規回答生成を実行")
-        print(f"[BADMINTON] 新規回答生成中: {message[:50]}...")
-        
-        prompt = f"""
-        あなたはバドミントンサークル「鶯（うぐいす）」のアシスタントです。
-        サークルメンバーや参加希望者からの質問に、自然な口調で回答してください。
-
-        ## 回答の基本
-        - 質問に直接的に答えることを最優先にする
-        - 親しみやすい敬語で、適度に詳しく実用的に回答する
-        - 初心者にも分かりやすく、具体的な情報を含めて説明する
-        - 必要に応じて背景情報や実践的なアドバイスを2-3文で補足する
-        - 関連するリンクがあれば自然に紹介する
-        - 文末は質問を促すフレーズを必ず入れる必要はなく、内容に応じて自然に締めくくる
-
-        質問: {message}
-        """
-        
-        try:
-            start_time = time.time()
-            
-            print("[BADMINTON] AI回答生成開始...")
-            bot_message = chat_badminton_simple(prompt, history, badminton_index)
-            
-            processing_time = time.time() - start_time
-            
-            print(f"[BADMINTON] AI回答生成完了!")
-            print(f"[BADMINTON] 処理時間: {processing_time:.2f}秒")
-            print(f"[BADMINTON] 生成回答長: {len(bot_message)}文字")
-            print(f"[BADMINTON] 回答プレビュー: {bot_message[:100]}...")
-            
-        except Exception as e:
-            print(f"[BADMINTON] AI回答生成エラー: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            
-            bot_message = ERROR_MESSAGE_TEMPLATE.format(error=str(e))
-            processing_time = 0
-
-        # Qdrantに保存
-        print("[BADMINTON] Qdrant保存処理...")        
-        store_result = store_response_in_pinecone_badminton(message, bot_message)
-        if store_result:
-            print("[BADMINTON] 新規回答を正常にQdrantに保存しました")
-        
-        saved_vector_id = str(uuid.uuid4()) if store_result else None
+        bot_message = BUSY_MESSAGE
+    return bot_message, time.time() - overall_start_time
 
-    # DynamoDB保存
-    print("[DYNAMODB] 質問・回答データ保存中...")
-    save_result = save_to_dynamodb_async(message, bot_message, user_info, cached_result, processing_time, saved_vector_id)
-    
-    if save_result.get('success'):
-        print(f"[DYNAMODB] 保存成功: ID={save_result['chat_id']}")
-    else:
-        print(f"[DYNAMODB] 保存失敗: {save_result.get('error')}")
+def _log_generation_done(bot_message, processing_time, generation_tier):
+    logger.info("[BADMINTON] AI回答生成完了 (%s): %.2f秒 / %d文字", generation_tier, processing_time, len(bot_message))
+    logger.debug("[BADMINTON] 回答プレビュー: %s...", bot_message[:100])
 
-    # チャット履歴更新
-    print("[BADMINTON] 履歴更新開始...")
-    
-    if not chat_history:
-        chat_history = []
+def _enqueue_cache_write(message, bot_message, embedding_context):
+    """Qdrantへの保存はライトビハインドキューに任せる（最後のチャンクを返した後に実行）"""
+    question_embedding = embedding_context.embedding if embedding_context.is_computed else None
+    point_id = canonical_point_id(message)
+    queued = cache_write_queue.submit(
+        question=message,
+        answer=bot_message,
+        question_embedding=question_embedding,
+        point_id=point_id
+    )
+    if queued:
+        logger.debug("[BADMINTON] Qdrant保存ジョブ投入完了 (キュー: %d件)", cache_write_queue.metrics()['depth'])
     
+    return point_id if queued else None
+
+def _routed_turn(message, bot_message, chat_history, user_info, overall_start_time):
+    """ルーターがテンプレートで回答したターン（キャッシュ検索・生成・キャッシュ保存なし）"""
+    chat_history = chat_history or []
     chat_history.append({"role": "user", "content": message})
     chat_history.append({"role": "assistant", "content": bot_message})
+    processing_time = time.time() - overall_start_time
+    logger.info("[BADMINTON] スケジュールの質問をテンプレートで回答: %.3f秒", processing_time)
+    return _finish_turn(message, bot_message, user_info, {"found": False, "tier": "routed"}, processing_time, None,
+                        chat_history, overall_start_time, "routed")
+
+# リクエストの結果区分 -> チャットログに記録する応答の tier
+RESPONSE_TIERS = {
+    "l1_hit": "hit",
+    "l2_hit": "hit",
+    "adapted": "near_miss",
+    "generated": "miss",
+    "coalesced": "coalesced",
+    "shed": "shed",
+    "routed": "routed"
+}
+
+def _request_outcome(cached_result, generated, coalesced=False, generation_tier=None):
+    """リクエストの結果区分（メトリクスのラベル）"""
+    if cached_result.get("found"):
+        return "l1_hit" if cached_result.get("cache_level") == "L1" else "l2_hit"
+    if coalesced:
+        return "coalesced"
+    if not generated:
+        return "shed"
+    return "adapted" if generation_tier == "near_miss" else "generated"
+
+def _join_generation(message, embedding_context):
+    """キャッシュミス時に、同じ（よく似た）質問を生成中のリクエストを探す"""
+    embedding = embedding_context.embedding if embedding_context.is_computed else None
+    return generation_coalescer.join(message, embedding)
+
+def _finish_turn(message, bot_message, user_info, cached_result, processing_time, saved_vector_id,
+                 chat_history, overall_start_time, outcome):
+    """チャットログの保存と履歴長制限を行い、最終的な履歴を返す"""
+    # DynamoDB保存（バッファに積むだけでブロックしない）
+    save_result = save_to_dynamodb_async(message, bot_message, user_info, cached_result, processing_time, saved_vector_id,
+                                         response_tier=RESPONSE_TIERS.get(outcome))
     
-    print(f"[BADMINTON] 更新後履歴件数: {len(chat_history)}")
+    if save_result.get('success'):
+        logger.debug("[DYNAMODB] 保存キュー投入: ID=%s", save_result['chat_id'])
+    else:
+        logger.warning("[DYNAMODB] 保存失敗: %s", save_result.get('error'))
 
     # 履歴長制限
     if len(chat_history) > MAX_HISTORY_LENGTH:
         removed_count = len(chat_history) - MAX_HISTORY_LENGTH
         chat_history = chat_history[-MAX_HISTORY_LENGTH:]
-        print(f"[BADMINTON] 履歴制限適用: {removed_count}件削除, 残り{len(chat_history)}件")
+        logger.debug("[BADMINTON] 履歴制限適用: %d件削除, 残り%d件", removed_count, len(chat_history))
 
     total_time = time.time() - overall_start_time
-    print(f"[BADMINTON] 処理完了! (合計: {total_time:.2f}秒)")
-    print("=" * 60)
+    metrics.observe("request", total_time)
+    metrics.inc("requests", outcome=outcome)
+    logger.info("[BADMINTON] 処理完了 (%s, 合計: %.2f秒)", outcome, total_time)
+    return chat_history
+
+class ChatTurn:
+    """
+    1回のチャット応答の状態と処理（同期版・非同期版のハンドラで共通）
+
+    ハンドラはルーター・キャッシュ検索・生成の共有待ち・アドミッション・生成といった I/O だけを
+    同期／非同期で行って結果を渡し、このクラスが履歴の更新・生成の共有・キャッシュ保存・
+    ログ保存を行って、表示する chat_history を返す。
+    """
+
+    def __init__(self, message, chat_history):
+        self.start_time = time.time()
+        _log_request_start(message, chat_history)
+        self.message = message
+        self.chat_history = chat_history
+        self.user_info = {
+            'ip': 'Webアプリ経由',
+            'timestamp': datetime.now().isoformat()
+        }
+        # 質問の埋め込みは1リクエストで一度だけ計算し、検索・生成・保存で共有する
+        self.embedding_context = EmbeddingContext(message)
+
+        self.cached_result = None
+        self.flight = None
+        self.leader = True
+        self.generated = False
+        self.generation_tier = None
+        self.shareable = True
+        self.bot_message = ""
+        self.processing_time = 0
+        self.saved_vector_id = None
+        self._stage_start = None
+
+    @property
+    def hit(self):
+        return bool(self.cached_result and self.cached_result.get("found"))
+
+    def routed(self, bot_message):
+        """ルーターがテンプレートで回答した場合の最終的な履歴"""
+        return _routed_turn(self.message, bot_message, self.chat_history, self.user_info, self.start_time)
+
+    def history(self):
+        """生成に渡す会話履歴（begin() で今回の質問を追加する前に呼ぶ）"""
+        return _build_history(self.chat_history)
+
+    def begin(self, cached_result):
+        """
+        キャッシュ検索の結果を受け取り、回答欄を空で追加する
+
+        ヒットならその回答を表示する。ミスなら同じ（よく似た）質問を生成中のリクエストを探し、
+        あればフォロワー（leader=False）として共有、なければリーダーとして生成する。
+        """
+        logger.debug("[BADMINTON] キャッシュ検索結果: %s", cached_result)
+        self.cached_result = cached_result
+        metrics.inc("cache_lookups", tier=cached_result.get("tier", "miss"))
+
+        # チャット履歴更新（回答欄は空で追加し、ストリーミングで埋めていく）
+        self.chat_history = self.chat_history or []
+        self.chat_history.append({"role": "user", "content": self.message})
+        self.chat_history.append({"role": "assistant", "content": ""})
 
-    return "", chat_history
+        if self.hit:
+            bot_message, self.processing_time = _cached_bot_message(cached_result, self.start_time)
+            self.saved_vector_id = cached_result.get('vector_id')
+            self.show(bot_message)
+        else:
+            self.flight, self.leader = _join_generation(self.message, self.embedding_context)
+            self._stage_start = time.time()
+        return self.chat_history
+
+    def cache_failed(self, error):
+        logger.error("[ERROR] キャッシュ検索でエラー: %s", error)
+        return {"found": False, "tier": "miss"}
+
+    def show(self, bot_message):
+        """回答欄を bot_message にして履歴を返す"""
+        self.bot_message = bot_message
+        self.chat_history[-1]["content"] = bot_message
+        return self.chat_history
+
+    def follow_timed_out(self, error):
+        logger.warning("[COALESCE] %s", error)
+        return self.show(ERROR_MESSAGE_TEMPLATE.format(error=str(error)))
+
+    def follow_done(self):
+        """共有した回答の受け取り完了（生成・キャッシュ保存はしない）"""
+        self.processing_time = time.time() - self._stage_start
+
+    def shed(self, bot_message, processing_time):
+        """過負荷: キャッシュのみモードの回答（生成・キャッシュ保存はしない）"""
+        self.processing_time = processing_time
+        if self.flight is not None:
+            self.flight.finish(bot_message, shareable=False)
+        return self.show(bot_message)
+
+    def start_generation(self):
+        logger.debug("[BADMINTON] キャッシュミス -> 新規回答生成を実行")
+        self.generated = True
+        self._stage_start = time.time()
+
+    def add_chunk(self, generation_tier, chunk):
+        """生成中の回答にチャンクを追加し、フォロワーにも公開する"""
+        self.generation_tier = generation_tier
+        self.show(self.bot_message + chunk)
+        if self.flight is not None:
+            self.flight.publish(self.bot_message)
+        return self.chat_history
+
+    def generation_done(self):
+        self.processing_time = time.time() - self._stage_start
+        # 障害・締め切り超過でエンジンが返したエラーメッセージは共有もキャッシュもしない
+        self.shareable = GENERATION_ERROR_MESSAGE not in self.bot_message
+        _log_generation_done(self.bot_message, self.processing_time, self.generation_tier)
+
+    def generation_failed(self, error):
+        logger.exception("[BADMINTON] AI回答生成エラー: %s", error)
+        self.shareable = False
+        self.processing_time = 0
+        bot_message = ERROR_MESSAGE_TEMPLATE.format(error=str(error))
+        if self.flight is not None:
+            self.flight.finish(bot_message, shareable=False)
+        return self.show(bot_message)
+
+    def store(self):
+        """生成した回答をフォロワーに確定し、キャッシュへの保存を投入する"""
+        if self.flight is not None:
+            self.flight.finish(self.bot_message, shareable=self.shareable)
+        # エラー時の定型文はキャッシュに保存しない
+        if self.shareable:
+            self.saved_vector_id = _enqueue_cache_write(self.message, self.bot_message, self.embedding_context)
+
+    def release(self):
+        generation_coalescer.release(self.flight)
+
+    def finish(self):
+        """チャットログを保存して最終的な履歴を返す"""
+        outcome = _request_outcome(self.cached_result, self.generated, coalesced=not self.leader,
+                                   generation_tier=self.generation_tier)
+        return _finish_turn(self.message, self.bot_message, self.user_info, self.cached_result, self.processing_time,
+                            self.saved_vector_id, self.chat_history, self.start_time, outcome)
+
+
+def respond_badminton(message, chat_history):      
+    """
+    チャット応答（ジェネレータ）
+
+    生成中の回答を含む chat_history を逐次 yield して gr.Chatbot にストリーミング表示し、
+    Qdrant・DynamoDBへの保存は最後のチャンクの後に行う。
+    """
+    turn = ChatTurn(message, chat_history)
+
+    # スケジュールの質問は最新の予定からテンプレートで回答する（古いキャッシュ回答を返さない）
+    routed_message = intent_router.route(message)
+    if routed_message is not None:
+        yield "", turn.routed(routed_message)
+        return
+
+    history = turn.history()
+    try:
+        cached_result = search_cached_answer_badminton(message, qdrant_client, embedding_context=turn.embedding_context)
+    except Exception as e:
+        cached_result = turn.cache_failed(e)
+    chat_history = turn.begin(cached_result)
+
+    if turn.hit:
+        yield "", chat_history
+    elif not turn.leader:
+        # 同じ（よく似た）質問を生成中のリクエストの回答を共有する
+        try:
+            for bot_message in turn.flight.follow(generation_coalescer.wait_timeout):
+                yield "", turn.show(bot_message)
+        except TimeoutError as e:
+            yield "", turn.follow_timed_out(e)
+        turn.follow_done()
+    else:
+        try:
+            if not admission_controller.acquire():
+                yield "", turn.shed(*_shed_bot_message(message, turn.start_time))
+            else:
+                turn.start_generation()
+                try:
+                    # near_miss は小さいモデルでキャッシュの回答を調整し、miss は大きいモデルで生成する
+                    for generation_tier, chunk in generate_badminton_stream(
+                        message, history, badminton_index, embedding_context=turn.embedding_context,
+                        cache_result=cached_result
+                    ):
+                        yield "", turn.add_chunk(generation_tier, chunk)
+                    turn.generation_done()
+                except Exception as e:
+                    yield "", turn.generation_failed(e)
+                finally:
+                    admission_controller.release()
+                turn.store()
+        finally:
+            turn.release()
+
+    yield "", turn.finish()
+
+
+async def respond_badminton_async(message, chat_history):
+    """
+    respond_badminton の非同期版（非同期ジェネレータ）
+
+    OpenAI・Qdrantの待ち時間中にワーカースレッドを占有しないため、1プロセスで多数の
+    チャットを同時に処理できる。保存処理はバックグラウンドのキュー／シンクに渡すだけ。
+    """
+    turn = ChatTurn(message, chat_history)
+    loop = asyncio.get_running_loop()
+
+    # スナップショット初回読み込みでブロックし得るのでスレッドプールで実行
+    routed_message = await loop.run_in_executor(
+        lookup_executor, contextvars.copy_context().run, intent_router.route, message
+    )
+    if routed_message is not None:
+        yield "", turn.routed(routed_message)
+        return
+
+    history = turn.history()
+    try:
+        cached_result = await search_cached_answer_badminton_async(
+            message, async_qdrant_client or get_async_qdrant_client(), embedding_context=turn.embedding_context
+        )
+    except Exception as e:
+        cached_result = turn.cache_failed(e)
+    chat_history = turn.begin(cached_result)
+
+    if turn.hit:
+        yield "", chat_history
+    elif not turn.leader:
+        try:
+            async for bot_message in turn.flight.follow_async(generation_coalescer.wait_timeout):
+                yield "", turn.show(bot_message)
+        except TimeoutError as e:
+            yield "", turn.follow_timed_out(e)
+        turn.follow_done()
+    else:
+        try:
+            if not await admission_controller.acquire_async():
+                # スナップショット初回読み込みでブロックし得るのでスレッドプールで実行
+                yield "", turn.shed(*await loop.run_in_executor(
+                    lookup_executor, _shed_bot_message, message, turn.start_time
+                ))
+            else:
+                turn.start_generation()
+                try:
+                    async for generation_tier, chunk in generate_badminton_stream_async(
+                        message, history, async_qdrant_client or get_async_qdrant_client(),
+                        embedding_context=turn.embedding_context, cache_result=cached_result
+                    ):
+                        yield "", turn.add_chunk(generation_tier, chunk)
+                    turn.generation_done()
+                except Exception as e:
+                    yield "", turn.generation_failed(e)
+                finally:
+                    admission_controller.release()
+                turn.store()
+        finally:
+            turn.release()
+
+    yield "", turn.finish()
+
+
+def get_service_status():
+    """アドミッション制御・書き込みキュー・ログシンクの状態（監視用）"""
+    return {
+        "admission": admission_controller.metrics(),
+        "cache_write_queue": cache_write_queue.metrics(),
+        "chat_log_sink": chat_log_sink.metrics(),
+        "latency": metrics.summary()
+    }
+
+# /metrics でスクレイプ時に出力するゲージ
+metrics.register_gauges("admission", admission_controller.metrics)
+metrics.register_gauges("cache_write_queue", cache_write_queue.metrics)
+metrics.register_gauges("chat_log_sink", chat_log_sink.metrics)
+metrics.register_gauges("embedding_cache", embedding_cache.stats)
+metrics.register_gauges("question_cache", question_answer_cache.stats)
+metrics.register_gauges("cache_mirror", cache_mirror.stats)
+metrics.register_gauges("hit_recorder", hit_recorder.metrics)
+metrics.register_gauges("coalescer", generation_coalescer.metrics)
+metrics.register_gauges("circuit", circuit_breakers.metrics)
+metrics.register_gauges("hedge", hedge_metrics)
+
+def create_server(blocks):
+    """Gradioアプリと /metrics（Prometheus形式）を同じポートで公開するFastAPIアプリ"""
+    server = FastAPI()
+
+    @server.get("/metrics", response_class=PlainTextResponse)
+    def prometheus_metrics():
+        return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    return gr.mount_gradio_app(server, blocks, path="/")
 
 
 def signal_handler(sig, frame):
     """Ctrl+C での終了処理"""
     print('\n[INFO] サーバーを終了しています...')
+    cache_write_queue.drain(timeout=float(os.getenv("CACHE_WRITE_DRAIN_TIMEOUT", "30")))
+    chat_log_sink.close(timeout=float(os.getenv("CHAT_LOG_DRAIN_TIMEOUT", "10")))
+    mirror_sync.stop()
+    snapshot_writer.stop()
+    stop_compaction_scheduler()
+    hit_recorder.close()
+    close_clients()
     sys.exit(0)
 
 def main():
@@ -173,16 +500,31 @@ def main():
     
     try:
         # グローバル変数の宣言
-        global badminton_index, qdrant_client
+        global badminton_index, qdrant_client, async_qdrant_client
         
         # Qdrantクライアントの初期化
         print("[INFO] Qdrantクライアント初期化中...")
-        qdrant_client = QdrantClient(
-            url=os.getenv("QDRANT_URL"),
-            api_key=os.getenv("QDRANT_API_KEY"),
-        )
+        qdrant_client = get_qdrant_client()
+        if ASYNC_PIPELINE:
+            async_qdrant_client = get_async_qdrant_client()
         print("[INFO] Qdrantクライアント初期化完了")
         
+        # キャッシュのローカルミラーを構築（スナップショット＋差分。失敗してもQdrant検索で動作する）
+        if CACHE_MIRROR_ENABLED:
+            try:
+                warm_cache_mirror(qdrant_client, max_age=CACHE_SNAPSHOT_MAX_AGE)
+                snapshot_writer.start()
+                mirror_sync.start(qdrant_client)
+            except Exception as e:
+                print(f"[WARN] キャッシュミラーの読み込みに失敗しました: {e}")
+
+        # キャッシュのコンパクション（期限切れ削除・件数上限）を定期実行
+        if CACHE_COMPACTION_ENABLED:
+            start_compaction_scheduler()
+        
+        # トークナイザを読み込んでおく（初回リクエストでエンコーディングを取得しない）
+        print(f"[INFO] プロンプトのトークン数: {'tiktoken' if context_builder.counter.exact else '概算'}")
+
         # バドミントンインデックス初期化
         badminton_index = get_badminton_index()
         print("バドミントンインデックス初期化完了")
@@ -203,21 +545,28 @@ def main():
                 label="質問・相談"
             )
             
-            msg.submit(respond_badminton, [msg, chatbot], [msg, chatbot])
+            handler = respond_badminton_async if ASYNC_PIPELINE else respond_badminton
+            print(f"[INFO] 応答パイプライン: {'async' if ASYNC_PIPELINE else 'sync'}")
+            msg.submit(handler, [msg, chatbot], [msg, chatbot], concurrency_limit=CHAT_CONCURRENCY_LIMIT)
+
+            # 監視用API（キューを通さず即時応答: /gradio_api/call/service_status）
+            status = gr.JSON(visible=False)
+            status_button = gr.Button(visible=False)
+            status_button.click(get_service_status, None, status, api_name="service_status", queue=False)
+
+        # キューの上限（超えた分はGradioが受付を拒否する）
+        app.queue(max_size=CHAT_QUEUE_MAX_SIZE, default_concurrency_limit=CHAT_CONCURRENCY_LIMIT)
         
         port = int(os.getenv("PORT", 7861))
 
         print(f"バドミントンチャット: http://127.0.0.1:{port}")
+        print(f"メトリクス: http://127.0.0.1:{port}/metrics")
         print("=" * 60)
         print("サーバーが起動しました")
         print("Ctrl+C で終了")
 
-        # シンプルな起動設定
-        app.launch(
-            server_name="0.0.0.0",
-            server_port=port,
-            share=False
-        )
+        # Gradioアプリを /metrics と同じFastAPIにマウントして起動
+        uvicorn.run(create_server(app), host="0.0.0.0", port=port, log_level="warning")
             
     except Exception as e:
         print(f"[ERROR] 起動エラー: {e}")
@@ -0,0 +1,253 @@
+"""
+badminton_chat_logs から badminton-cache を一括構築する（中断しても再開可能）
+
+1. チャットログテーブルを TotalSegments 分割の並列スキャンで読み込む
+2. LLMが新規に生成した回答（response_tier が miss。tier のない古いログも含む）だけを残し、
+   混雑/エラー時の定型応答を除いて、正規化した質問文で重複を除く
+   （同じ質問が複数あれば最新の回答を使う）
+3. 数百件ずつまとめて埋め込みを取得し、複数ワーカーでバッチアップサートする
+4. アップサートが完了した回答IDをチェックポイントファイルに追記する
+
+再実行時はチェックポイントにある回答IDを飛ばすので、中断したところから再開できる。
+点IDは通常の書き込みと同じ canonical_point_id(質問) なので、既存の点は上書きされるだけ。
+AIによる拡張（類義語・要約）は行わず、正規の回答点だけを登録する。
+
+使い方:
+    python backfill_cache.py --dry-run
+    python backfill_cache.py --segments 8 --workers 4 --embed-batch 256
+    python backfill_cache.py --reset          # チェックポイントを消して最初から
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from qdrant_client.models import PointStruct
+
+from badminton_utils import CACHE_COLLECTION_NAME, canonical_point_id, classify_badminton_category
+from clients import get_dynamodb_resource, get_qdrant_client
+from embedding_cache import embedding_cache
+from observability import logger, span
+from question_cache import normalize_question
+
+load_dotenv()
+
+CHAT_LOG_TABLE = os.getenv("DYNAMODB_CHAT_LOG_TABLE", "badminton_chat_logs")
+CHECKPOINT_PATH = os.getenv("CACHE_BACKFILL_CHECKPOINT", "backfill_cache.checkpoint")
+
+# 混雑時・エラー時の定型応答（キャッシュに入れない）
+SKIP_RESPONSE_PREFIXES = ("申し訳ございません",)
+# キャッシュに入れる応答の tier（routed はテンプレートの予定、coalesced / near_miss は
+# 他の回答の流用、shed は混雑時の応答なので入れない）
+CACHEABLE_TIERS = {"miss"}
+
+_SCAN_ATTRIBUTES = {
+    "#q": "user_question",
+    "#a": "bot_response",
+    "#t": "timestamp",
+    "#c": "is_cached_response",
+    "#r": "response_tier"
+}
+
+
+def _scan_segment(table, segment: int, total_segments: int, page_size: int) -> List[Dict[str, Any]]:
+    """1セグメント分のログを最後までページングして読み込む"""
+    items = []
+    kwargs = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "ProjectionExpression": ", ".join(_SCAN_ATTRIBUTES),
+        "ExpressionAttributeNames": _SCAN_ATTRIBUTES,
+        "Limit": page_size
+    }
+    while True:
+        with span("backfill_scan", segment=segment):
+            response = table.scan(**kwargs)
+        items.extend(response.get("Items", []))
+        last_key = response.get("LastEvaluatedKey")
+        if not last_key:
+            break
+        kwargs["ExclusiveStartKey"] = last_key
+    logger.debug("[BACKFILL] セグメント %d/%d: %d件", segment + 1, total_segments, len(items))
+    return items
+
+
+def scan_chat_logs(table, total_segments: int = 4, page_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """テーブル全体を total_segments 並列でスキャンする"""
+    with ThreadPoolExecutor(max_workers=total_segments, thread_name_prefix="backfill-scan") as executor:
+        futures = [executor.submit(_scan_segment, table, segment, total_segments, page_size)
+                   for segment in range(total_segments)]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def _is_cacheable(item: Dict[str, Any]) -> bool:
+    question = (item.get("user_question") or "").strip()
+    answer = (item.get("bot_response") or "").strip()
+    if not question or not answer or item.get("is_cached_response"):
+        return False
+    tier = item.get("response_tier")
+    if tier is not None and tier not in CACHEABLE_TIERS:
+        return False
+    return not answer.startswith(SKIP_RESPONSE_PREFIXES)
+
+
+def collect_candidates(items) -> Dict[str, Dict[str, Any]]:
+    """正規化した質問文 -> 最新のログ（質問・回答・時刻）"""
+    candidates = {}
+    scanned = 0
+    for item in items:
+        scanned += 1
+        if not _is_cacheable(item):
+            continue
+        key = normalize_question(item["user_question"])
+        current = candidates.get(key)
+        if current is None or str(item.get("timestamp", "")) > str(current.get("timestamp", "")):
+            candidates[key] = item
+    logger.info("[BACKFILL] スキャン %d件 -> 登録候補 %d件（重複除去後）", scanned, len(candidates))
+    return candidates
+
+
+class Checkpoint:
+    """アップサート済みの回答IDを1行1件で追記するチェックポイントファイル"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+    def mark(self, point_ids: List[str]) -> None:
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{point_id}\n" for point_id in point_ids))
+                f.flush()
+                os.fsync(f.fileno())
+            self.done.update(point_ids)
+
+    def reset(self) -> None:
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.done = set()
+
+
+def _build_points(items: List[Dict[str, Any]], vectors: List[List[float]]) -> List[PointStruct]:
+    # timestamp はキャッシュへの登録時刻（ミラーの差分取得・コンパクションの期限判定に使う）
+    timestamp = datetime.now().isoformat(timespec="seconds")
+    points = []
+    for item, vector in zip(items, vectors):
+        question = item["user_question"]
+        point_id = canonical_point_id(question)
+        points.append(PointStruct(
+            id=point_id,
+            vector=vector,
+            payload={
+                "text": item["bot_response"],
+                "question": question,
+                "timestamp": timestamp,
+                "logged_at": str(item.get("timestamp", "")),
+                "type": "chatbot_response",
+                "kind": "canonical",
+                "answer_id": point_id,
+                "category": classify_badminton_category(question),
+                "source": "backfill"
+            }
+        ))
+    return points
+
+
+def _ingest_chunk(client, items: List[Dict[str, Any]], checkpoint: Checkpoint, collection_name: str,
+                  upsert_batch: int) -> int:
+    """1チャンク分の埋め込みを1回のAPI呼び出しで取得し、バッチでアップサートする"""
+    vectors = embedding_cache.embed_many([item["user_question"] for item in items])
+    points = _build_points(items, vectors)
+    for i in range(0, len(points), upsert_batch):
+        batch = points[i:i + upsert_batch]
+        with span("backfill_upsert", points=len(batch)):
+            client.upsert(collection_name=collection_name, points=batch, wait=True)
+        checkpoint.mark([str(point.id) for point in batch])
+    return len(points)
+
+
+def backfill(table=None, client=None, checkpoint_path: str = CHECKPOINT_PATH,
+             collection_name: str = CACHE_COLLECTION_NAME, segments: int = 4, workers: int = 4,
+             embed_batch: int = 256, upsert_batch: int = 64, limit: Optional[int] = None,
+             dry_run: bool = False) -> Dict[str, Any]:
+    table = table or get_dynamodb_resource().Table(CHAT_LOG_TABLE)
+    client = client or get_qdrant_client()
+    checkpoint = Checkpoint(checkpoint_path)
+    started = time.time()
+
+    candidates = collect_candidates(scan_chat_logs(table, total_segments=segments))
+    pending = [item for item in candidates.values()
+               if canonical_point_id(item["user_question"]) not in checkpoint.done]
+    already_done = len(candidates) - len(pending)
+    if limit is not None:
+        pending = pending[:limit]
+    report = {
+        "candidates": len(candidates),
+        "already_done": already_done,
+        "pending": len(pending),
+        "ingested": 0,
+        "failed_chunks": 0,
+        "dry_run": dry_run
+    }
+    logger.info("[BACKFILL] 登録対象 %d件（チェックポイント済み %d件）", len(pending), report["already_done"])
+    if dry_run or not pending:
+        return report
+
+    chunks = [pending[i:i + embed_batch] for i in range(0, len(pending), embed_batch)]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill-ingest") as executor:
+        futures = [executor.submit(_ingest_chunk, client, chunk, checkpoint, collection_name, upsert_batch)
+                   for chunk in chunks]
+        for future in as_completed(futures):
+            try:
+                report["ingested"] += future.result()
+            except Exception as e:
+                report["failed_chunks"] += 1
+                logger.error("[BACKFILL] チャンクの登録に失敗（再実行で再開できます）: %s", e)
+            logger.info("[BACKFILL] 進捗 %d/%d件", report["ingested"], len(pending))
+
+    report["elapsed_seconds"] = round(time.time() - started, 1)
+    logger.info("[BACKFILL] 完了: %d件登録 / 失敗チャンク %d (%.1f秒)",
+                report["ingested"], report["failed_chunks"], report["elapsed_seconds"])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャットログから badminton-cache を一括構築する")
+    parser.add_argument('--segments', type=int, default=4, help='並列スキャンのセグメント数')
+    parser.add_argument('--workers', type=int, default=4, help='埋め込み・アップサートのワーカー数')
+    parser.add_argument('--embed-batch', type=int, default=256, help='1回の埋め込みAPI呼び出しの件数')
+    parser.add_argument('--upsert-batch', type=int, default=64, help='1回のアップサートの件数')
+    parser.add_argument('--limit', type=int, default=None, help='登録する最大件数')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH, help='チェックポイントファイル')
+    parser.add_argument('--reset', action='store_true', help='チェックポイントを削除して最初から実行する')
+    parser.add_argument('--dry-run', action='store_true', help='登録を行わず件数だけ表示する')
+    args = parser.parse_args()
+
+    if args.reset:
+        Checkpoint(args.checkpoint).reset()
+        print(f"[INFO] チェックポイントを削除しました: {args.checkpoint}")
+
+    report = backfill(
+        checkpoint_path=args.checkpoint,
+        segments=args.segments,
+        workers=args.workers,
+        embed_batch=args.embed_batch,
+        upsert_batch=args.upsert_batch,
+        limit=args.limit,
+        dry_run=args.dry_run
+    )
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
+import asyncio
+import contextvars
 import os
 import time
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
-from openai import OpenAI
-from qdrant_client import QdrantClient
+from clients import get_async_openai_client, get_openai_client, get_qdrant_client
+from embedding_cache import embedding_cache
+from observability import logger, metrics, span
+from intent_router import intent_router
+from context_builder import context_builder
+from resilience import (BudgetExhausted, CircuitOpenError, DeadlineExceeded, circuit_breakers, hedged_call,
+                        hedged_call_async, request_timeout, stage_timeout)
 from langchain_community.chat_message_histories import ChatMessageHistory
 
 # DynamoDB機能をインポート
@@ -15,14 +24,44 @@ except ImportError as e:
     DYNAMODB_AVAILABLE = False
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# スケジュール取得・ベクトル検索を並列実行する共有スレッドプール
+lookup_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LOOKUP_MAX_WORKERS", "8")),
+    thread_name_prefix="badminton-lookup"
+)
+
+# 回答を生成するモデルと、near_miss（似た質問の回答がある）のときに回答を調整する小さいモデル
+# NEAR_MISS_MODEL を空にすると near_miss も大きいモデルで生成する
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o")
+NEAR_MISS_MODEL = os.getenv("NEAR_MISS_MODEL", "gpt-4o-mini")
+NEAR_MISS_MAX_TOKENS = int(os.getenv("NEAR_MISS_MAX_TOKENS", "700"))
+
+# 参考情報の候補として取得する件数（スコア下限・重複除去・トークン予算で絞り込む）
+RAG_CANDIDATES = int(os.getenv("RAG_CANDIDATES", "5"))
+
+# 全リクエストで同一のシステムプロンプト（質問ごとに変わる内容は後ろのメッセージに置く）
+SYSTEM_PROMPT = """あなたはバドミントンサークル「鶯（うぐいす）」の親しみやすいアシスタントです。
+サークルメンバーや参加希望者からの質問に、自然な口調で回答してください。
+
+## 回答の基本
+- 質問に直接的に答えることを最優先にする
+- 親しみやすい敬語で、適度に詳しく実用的に回答する
+- バドミントンの専門知識を活かし、初心者にも分かりやすく具体的に説明する
+- 必要に応じて背景情報や実践的なアドバイスを2-3文で補足する
+- 練習スケジュールについては提供された最新の情報を使う
+- 関連するリンクがあれば自然に紹介する
+- 文末は質問を促すフレーズを必ず入れる必要はなく、内容に応じて自然に締めくくる"""
+
+# near_miss 用（SYSTEM_PROMPT を先頭にそのまま含め、共通のプレフィックスにする）
+NEAR_MISS_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+
+## 似た質問への回答の調整
+参考情報は、今回とよく似た別の質問への回答です。その内容と事実を保ったまま、今回の質問に
+直接答える形に書き直してください。参考情報にないことを推測で付け加えないでください。"""
 
 def get_badminton_index():
     """バドミントンコレクションへの接続を取得"""
-    qdrant_client = QdrantClient(
-        url=os.getenv("QDRANT_URL"),
-        api_key=os.getenv("QDRANT_API_KEY")
-    )
+    qdrant_client = get_qdrant_client()
     
     # コレクション情報を取得
     collection_info = qdrant_client.get_collection("badminton")
@@ -30,100 +69,437 @@ def get_badminton_index():
     
     return qdrant_client
 
-def chat_badminton_simple(prompt: str, history: ChatMessageHistory, qdrant_client) -> str:
-    start_time = time.time()
+def _timed(fn, *args):
+    """関数を実行し、(結果, 経過秒数) を返す"""
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+async def _timed_async(coro):
+    """コルーチンを実行し、(結果, 経過秒数) を返す"""
+    start = time.time()
+    result = await coro
+    return result, time.time() - start
+
+def _fetch_schedule_context(prompt: str) -> str:
+    """DynamoDBからスケジュール情報を取得してプロンプト用の文字列にする"""
+    try:
+        with span("schedule_fetch"):
+            schedule_response = get_schedule_response(prompt)
+        if schedule_response and "予定されている練習はありません" not in schedule_response:
+            logger.debug("[BADMINTON] DynamoDBからスケジュール情報を取得: %d文字", len(schedule_response))
+            return f"\n\n【最新の練習スケジュール】\n{schedule_response}"
+        logger.debug("[BADMINTON] DynamoDBスケジュール: 予定なし")
+    except Exception as e:
+        logger.warning("[BADMINTON] DynamoDBスケジュール取得失敗: %s", e)
+    return ""
+
+def _rag_search_request(embedding) -> dict:
+    """badmintonコレクションへの query_points の引数"""
+    return {
+        "collection_name": "badminton",
+        "query": embedding,
+        "limit": RAG_CANDIDATES,
+        "score_threshold": context_builder.score_floor,
+        "with_payload": ["text"]
+    }
+
+def _query_reference_points(qdrant_client, embedding):
+    with span("rag_query", collection="badminton"):
+        return qdrant_client.query_points(**_rag_search_request(embedding))
+
+async def _query_reference_points_async(qdrant_client, embedding):
+    with span("rag_query", collection="badminton"):
+        return await qdrant_client.query_points(**_rag_search_request(embedding))
+
+def _reference_hits(search_results) -> list:
+    """検索結果を (本文, スコア) のリストにする"""
+    if not search_results or not hasattr(search_results, 'points'):
+        return []
+    return [(point.payload.get("text", ""), point.score) for point in search_results.points]
+
+def _retrieve_reference_context(prompt: str, qdrant_client, embedding_context=None) -> list:
+    """badmintonコレクションから参考情報の候補を (本文, スコア) のリストで返す（Qdrant版）"""
+    try:
+        if embedding_context is not None:
+            embedding = embedding_context.embedding
+        else:
+            embedding = embedding_cache.embed(f"バドミントン: {prompt}")
+
+        # Qdrantで検索（ブレーカーが開いていれば即座に CircuitOpenError）
+        search_results = circuit_breakers.get("qdrant_rag").call(
+            hedged_call, "rag_query", _query_reference_points, qdrant_client, embedding,
+            timeout=request_timeout("rag")
+        )
+        return _reference_hits(search_results)
+
+    except Exception as e:
+        logger.warning("[WARN] Qdrant検索失敗: %s", e)
+        return []
+
+async def _retrieve_reference_context_async(prompt: str, qdrant_client, embedding_context=None) -> list:
+    """_retrieve_reference_context の非同期版（AsyncQdrantClientを使用）"""
     try:
-        print(f"[BADMINTON] DynamoDB統合版での処理開始: {prompt}")
-
-        # スケジュール関連のキーワードをチェック
-        schedule_keywords = ['練習', 'スケジュール', '予定', '日程', 'いつ', '時間', '場所', '今週', '来週', '今月']
-        is_schedule_question = any(keyword in prompt for keyword in schedule_keywords)
-
-        print(f"[BADMINTON] スケジュール関連質問: {is_schedule_question}")
-
-        # DynamoDBからスケジュール情報を取得（利用可能な場合のみ）
-        schedule_context = ""
-        if is_schedule_question and DYNAMODB_AVAILABLE:
-            try:
-                print(f"[BADMINTON] DynamoDBからスケジュール取得中...")
-                schedule_response = get_schedule_response(prompt)
-                if schedule_response and "予定されている練習はありません" not in schedule_response:
-                    schedule_context = f"\n\n【最新の練習スケジュール】\n{schedule_response}"
-                    print(f"[BADMINTON] DynamoDBからスケジュール情報を取得: {len(schedule_response)}文字")
-                else:
-                    print(f"[BADMINTON] DynamoDBスケジュール: 予定なし")
-            except Exception as e:
-                print(f"[BADMINTON] DynamoDBスケジュール取得失敗: {e}")
-
-        # ベクトル生成＆検索（Qdrant版）
+        if embedding_context is not None:
+            embedding = await embedding_context.get_embedding_async()
+        else:
+            embedding = await embedding_cache.embed_async(f"バドミントン: {prompt}")
+
+        search_results = await circuit_breakers.get("qdrant_rag").call_async(
+            hedged_call_async, "rag_query", _query_reference_points_async, qdrant_client, embedding,
+            timeout=request_timeout("rag")
+        )
+        return _reference_hits(search_results)
+
+    except Exception as e:
+        logger.warning("[WARN] Qdrant検索失敗: %s", e)
+        return []
+
+def is_schedule_question(prompt: str) -> bool:
+    """スケジュール関連のキーワードをチェック（ルーターのオートマトンで1回走査）"""
+    result = intent_router.mentions_schedule(prompt)
+    logger.debug("[BADMINTON] スケジュール関連質問: %s", result)
+    return result
+
+def _build_messages(prompt: str, history: ChatMessageHistory, reference_hits: list, schedule_context: str) -> list:
+    """固定のシステムプロンプト・履歴・参考情報・スケジュールからLLMへのメッセージを構成する（トークン予算内）"""
+    messages, _ = context_builder.build_messages(
+        SYSTEM_PROMPT, prompt, history.messages, reference_hits, schedule_context
+    )
+    return messages
+
+def _prepare_badminton_messages(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None):
+    """
+    RAG検索とスケジュール情報を組み合わせてLLMへのメッセージを組み立てる
+
+    embedding_context が渡された場合は、ユーザーの質問から計算済みの埋め込みで
+    badmintonコレクションを検索する（プロンプト全体を再度埋め込まない）。
+
+    Returns:
+        (messages, schedule_question, schedule_context)
+    """
+
+    schedule_question = is_schedule_question(prompt)
+
+    # スケジュール取得（DynamoDB）とベクトル検索（Qdrant）は独立しているので並列に実行する
+    fanout_start = time.time()
+    futures = {}
+    if schedule_question and DYNAMODB_AVAILABLE:
+        # copy_context: ワーカースレッドの span にもリクエストのトレースIDを引き継ぐ
+        futures["schedule"] = lookup_executor.submit(contextvars.copy_context().run, _timed, _fetch_schedule_context, prompt)
+    futures["rag"] = lookup_executor.submit(
+        contextvars.copy_context().run, _timed, _retrieve_reference_context, prompt, qdrant_client, embedding_context
+    )
+
+    # 各ステージの持ち時間はリクエストの締め切りから割り当てる
+    timeouts = {stage: stage_timeout(stage) for stage in futures}
+    results = {}
+    for stage, future in futures.items():
+        remaining = max(0.0, timeouts[stage] - (time.time() - fanout_start))
         try:
-            embedding = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=[f"バドミントン: {prompt}"]
-            ).data[0].embedding
-
-            # Qdrantで検索
-            search_results = qdrant_client.query_points(
-                collection_name="badminton",
-                query=embedding,
-                limit=3,
-                with_payload=True
-            )
+            results[stage], elapsed = future.result(timeout=remaining)
+            logger.debug("[BADMINTON] %s取得: %.3f秒", stage, elapsed)
+        except FutureTimeoutError:
+            metrics.inc("stage_timeouts", stage=stage)
+            logger.warning("[WARN] %s取得がタイムアウトしました (%.1f秒)", stage, timeouts[stage])
+            results[stage] = ""
+        except Exception as e:
+            logger.warning("[WARN] %s取得失敗: %s", stage, e)
+            results[stage] = ""
+
+    schedule_context = results.get("schedule", "")
+    reference_hits = results.get("rag") or []
+    logger.debug("[BADMINTON] コンテキスト収集完了: %.3f秒", time.time() - fanout_start)
+
+    messages = _build_messages(prompt, history, reference_hits, schedule_context)
+    return messages, schedule_question, schedule_context
+
+async def _prepare_badminton_messages_async(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None):
+    """_prepare_badminton_messages の非同期版（スケジュール取得はスレッドプール、検索はasyncで並行実行）"""
+
+    schedule_question = is_schedule_question(prompt)
+
+    fanout_start = time.time()
+    loop = asyncio.get_running_loop()
+    tasks = {}
+    if schedule_question and DYNAMODB_AVAILABLE:
+        tasks["schedule"] = loop.run_in_executor(
+            lookup_executor, contextvars.copy_context().run, _timed, _fetch_schedule_context, prompt
+        )
+    tasks["rag"] = asyncio.ensure_future(
+        _timed_async(_retrieve_reference_context_async(prompt, qdrant_client, embedding_context))
+    )
 
-            context_text = ""
-            if search_results and hasattr(search_results, 'points'):
-                for result in search_results.points:
-                    context_text += result.payload.get("text", "") + "\n"
-                
+    timeouts = {stage: stage_timeout(stage) for stage in tasks}
+    results = {}
+    for stage, task in tasks.items():
+        remaining = max(0.0, timeouts[stage] - (time.time() - fanout_start))
+        try:
+            results[stage], elapsed = await asyncio.wait_for(task, timeout=remaining)
+            logger.debug("[BADMINTON] %s取得: %.3f秒", stage, elapsed)
+        except asyncio.TimeoutError:
+            metrics.inc("stage_timeouts", stage=stage)
+            logger.warning("[WARN] %s取得がタイムアウトしました (%.1f秒)", stage, timeouts[stage])
+            results[stage] = ""
         except Exception as e:
-            print(f"[WARN] Qdrant検索失敗: {e}")
-            context_text = ""
-
-        # メッセージ構成
-        messages = [
-            {"role": "system", "content": """あなたはバドミントンサークルの親しみやすいアシスタント「鶯（うぐいす）」です。
-
-以下の点を心がけて回答してください：
-- 親しみやすく、丁寧な言葉遣い
-- バドミントンの専門知識を活用
-- 練習スケジュールについては最新の情報を提供
-- 初心者にも分かりやすい説明"""}
-        ]
-
-        for msg in history.messages[-2:]:
-            messages.append({
-                "role": "user" if msg.type == "human" else "assistant",
-                "content": msg.content
-            })
-
-        if context_text:
-            messages.append({"role": "system", "content": f"参考情報:\n{context_text}"})
-
-        if schedule_context:
-            messages.append({"role": "system", "content": schedule_context})
-            print(f"[BADMINTON] スケジュール情報をプロンプトに追加")
-
-        messages.append({"role": "user", "content": prompt})
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
+            logger.warning("[WARN] %s取得失敗: %s", stage, e)
+            results[stage] = ""
+
+    schedule_context = results.get("schedule", "")
+    reference_hits = results.get("rag") or []
+    logger.debug("[BADMINTON] コンテキスト収集完了: %.3f秒", time.time() - fanout_start)
+
+    messages = _build_messages(prompt, history, reference_hits, schedule_context)
+    return messages, schedule_question, schedule_context
+
+def _completion_request(messages: list, timeout: float, model: str = LLM_MODEL, max_tokens: int = 1000) -> dict:
+    return {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "timeout": timeout
+    }
+
+def _check_llm_deadline(llm_deadline: float) -> None:
+    if time.monotonic() > llm_deadline:
+        metrics.inc("deadline_exceeded", stage="llm")
+        raise DeadlineExceeded("LLM生成がリクエストの締め切りを過ぎました")
+
+def _chunk_text(chunk) -> str:
+    """ストリーミングのチャンクからテキスト片を取り出す（なければ空文字）"""
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+def _stream_completion(messages: list, model: str = LLM_MODEL, max_tokens: int = 1000, stage: str = "llm",
+                       breaker_name: str = "openai_chat"):
+    """
+    OpenAIを stream=True で呼び出し、テキスト片を yield する
+
+    サーキットが開いていれば呼び出さずに CircuitOpenError。最初のテキスト片より前の
+    失敗だけをOpenAIの障害としてブレーカーに数える。
+    """
+    breaker = circuit_breakers.get(breaker_name)
+    llm_timeout = stage_timeout("llm")
+    if llm_timeout <= 0:
+        # 持ち時間がないまま呼ぶとOpenAIの障害として数えてしまうので、呼ぶ前に打ち切る
+        metrics.inc("deadline_exceeded", stage="llm")
+        raise BudgetExhausted("LLM生成の持ち時間が残っていません")
+    if not breaker.allow():
+        raise CircuitOpenError(breaker.name)
+    llm_deadline = time.monotonic() + llm_timeout
+    emitted = False
+
+    with span(stage, model=model):
+        llm_start = time.time()
+        try:
+            stream = get_openai_client().chat.completions.create(
+                **_completion_request(messages, llm_timeout, model, max_tokens)
+            )
+            for chunk in stream:
+                _check_llm_deadline(llm_deadline)
+                delta = _chunk_text(chunk)
+                if not delta:
+                    continue
+                if not emitted:
+                    metrics.observe(f"{stage}_first_token", time.time() - llm_start)
+                    logger.debug("[BADMINTON] 最初のトークン受信 (%s): %.2f秒", model, time.time() - llm_start)
+                    breaker.record_success()
+                    emitted = True
+                yield delta
+        except Exception:
+            if not emitted:
+                breaker.record_failure()
+            raise
+        if not emitted:
+            breaker.record_success()
+
+async def _stream_completion_async(messages: list, model: str = LLM_MODEL, max_tokens: int = 1000, stage: str = "llm",
+                                   breaker_name: str = "openai_chat"):
+    """_stream_completion の非同期版（AsyncOpenAIを使用）"""
+    breaker = circuit_breakers.get(breaker_name)
+    llm_timeout = stage_timeout("llm")
+    if llm_timeout <= 0:
+        # 持ち時間がないまま呼ぶとOpenAIの障害として数えてしまうので、呼ぶ前に打ち切る
+        metrics.inc("deadline_exceeded", stage="llm")
+        raise BudgetExhausted("LLM生成の持ち時間が残っていません")
+    if not breaker.allow():
+        raise CircuitOpenError(breaker.name)
+    llm_deadline = time.monotonic() + llm_timeout
+    emitted = False
+
+    with span(stage, model=model):
+        llm_start = time.time()
+        try:
+            stream = await get_async_openai_client().chat.completions.create(
+                **_completion_request(messages, llm_timeout, model, max_tokens)
+            )
+            async for chunk in stream:
+                _check_llm_deadline(llm_deadline)
+                delta = _chunk_text(chunk)
+                if not delta:
+                    continue
+                if not emitted:
+                    metrics.observe(f"{stage}_first_token", time.time() - llm_start)
+                    logger.debug("[BADMINTON] 最初のトークン受信 (%s): %.2f秒", model, time.time() - llm_start)
+                    breaker.record_success()
+                    emitted = True
+                yield delta
+        except Exception:
+            if not emitted:
+                breaker.record_failure()
+            raise
+        if not emitted:
+            breaker.record_success()
+
+SCHEDULE_CONTACT_NOTE = "\n\n💡 練習スケジュールの詳細については、サークル管理者にお問い合わせください。"
+GENERATION_ERROR_MESSAGE = "申し訳ございません、現在回答を生成できません。しばらくしてから再度お試しください。"
+
+def chat_badminton_stream(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None):
+    """
+    回答をストリーミング生成するジェネレータ
+
+    OpenAIを stream=True で呼び出し、受信したテキスト片を順次 yield する。
+    エラー時は（それまでの出力に続けて）エラーメッセージを yield する。
+    """
+    start_time = time.time()
+    emitted = False
+    try:
+        messages, schedule_question, schedule_context = _prepare_badminton_messages(
+            prompt, history, qdrant_client, embedding_context
         )
 
-        final_response = response.choices[0].message.content
+        for delta in _stream_completion(messages):
+            emitted = True
+            yield delta
 
-        if is_schedule_question and not schedule_context and not DYNAMODB_AVAILABLE:
-            final_response += "\n\n💡 練習スケジュールの詳細については、サークル管理者にお問い合わせください。"
+        if schedule_question and not schedule_context and not DYNAMODB_AVAILABLE:
+            yield SCHEDULE_CONTACT_NOTE
 
-        # 回答の保存（スケジュール質問のときは保存スキップメッセージだけ出力）
-        if is_schedule_question:
-            print("[SKIP] スケジュール質問のため回答の保存をスキップします") 
-        return final_response 
-    
+        logger.debug("[BADMINTON] ストリーミング生成完了: %.2f秒", time.time() - start_time)
+
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.warning("[BADMINTON] 回答生成を中止: %s", e)
+        yield f"\n\n{GENERATION_ERROR_MESSAGE}" if emitted else GENERATION_ERROR_MESSAGE
     except Exception as e:
-        print(f"[ERROR] バドミントンチャット処理失敗: {e}")
-        import traceback
-        traceback.print_exc()
-        return "申し訳ございません、現在回答を生成できません。しばらくしてから再度お試しください。"
\ No newline at end of file
+        logger.exception("[ERROR] バドミントンチャット処理失敗: %s", e)
+        yield f"\n\n{GENERATION_ERROR_MESSAGE}" if emitted else GENERATION_ERROR_MESSAGE
+
+async def chat_badminton_stream_async(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None):
+    """chat_badminton_stream の非同期版（AsyncOpenAIでストリーミング）"""
+    start_time = time.time()
+    emitted = False
+    try:
+        messages, schedule_question, schedule_context = await _prepare_badminton_messages_async(
+            prompt, history, qdrant_client, embedding_context
+        )
+
+        async for delta in _stream_completion_async(messages):
+            emitted = True
+            yield delta
+
+        if schedule_question and not schedule_context and not DYNAMODB_AVAILABLE:
+            yield SCHEDULE_CONTACT_NOTE
+        logger.debug("[BADMINTON] ストリーミング生成完了（async）: %.2f秒", time.time() - start_time)
+
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.warning("[BADMINTON] 回答生成を中止: %s", e)
+        yield f"\n\n{GENERATION_ERROR_MESSAGE}" if emitted else GENERATION_ERROR_MESSAGE
+    except Exception as e:
+        logger.exception("[ERROR] バドミントンチャット処理失敗: %s", e)
+        yield f"\n\n{GENERATION_ERROR_MESSAGE}" if emitted else GENERATION_ERROR_MESSAGE
+
+def _near_miss_messages(prompt: str, history: ChatMessageHistory, near_miss: dict) -> list:
+    """似た質問の回答を参考情報にした、小さいモデル向けのメッセージ"""
+    reference = near_miss["answer"]
+    if near_miss.get("cached_question"):
+        reference = f"似た質問: {near_miss['cached_question']}\n回答: {reference}"
+    messages, _ = context_builder.build_messages(
+        NEAR_MISS_SYSTEM_PROMPT, prompt, history.messages, [(reference, near_miss.get("score", 1.0))]
+    )
+    return messages
+
+def _use_near_miss(cache_result: Optional[dict]) -> bool:
+    return bool(NEAR_MISS_MODEL and cache_result and cache_result.get("tier") == "near_miss"
+                and cache_result.get("answer"))
+
+def adapt_cached_answer_stream(prompt: str, history: ChatMessageHistory, near_miss: dict):
+    """
+    near_miss の回答を小さいモデルで今回の質問に合わせて書き直し、テキスト片を yield する
+
+    最初のテキスト片より前に失敗した場合は何も yield せずに終わる（呼び出し側が大きいモデルで生成する）。
+    途中で失敗した場合はそれまでの出力に続けてエラーメッセージを yield する。
+    """
+    emitted = False
+    try:
+        messages = _near_miss_messages(prompt, history, near_miss)
+        for delta in _stream_completion(messages, NEAR_MISS_MODEL, NEAR_MISS_MAX_TOKENS,
+                                        stage="llm_near_miss", breaker_name="openai_chat_small"):
+            emitted = True
+            yield delta
+    except Exception as e:
+        if not emitted:
+            logger.warning("[BADMINTON] 小さいモデルでの回答調整に失敗（大きいモデルで生成します）: %s", e)
+            return
+        logger.exception("[ERROR] 小さいモデルでの回答調整が途中で失敗: %s", e)
+        yield f"\n\n{GENERATION_ERROR_MESSAGE}"
+
+async def adapt_cached_answer_stream_async(prompt: str, history: ChatMessageHistory, near_miss: dict):
+    """adapt_cached_answer_stream の非同期版"""
+    emitted = False
+    try:
+        messages = _near_miss_messages(prompt, history, near_miss)
+        async for delta in _stream_completion_async(messages, NEAR_MISS_MODEL, NEAR_MISS_MAX_TOKENS,
+                                                    stage="llm_near_miss", breaker_name="openai_chat_small"):
+            emitted = True
+            yield delta
+    except Exception as e:
+        if not emitted:
+            logger.warning("[BADMINTON] 小さいモデルでの回答調整に失敗（大きいモデルで生成します）: %s", e)
+            return
+        logger.exception("[ERROR] 小さいモデルでの回答調整が途中で失敗: %s", e)
+        yield f"\n\n{GENERATION_ERROR_MESSAGE}"
+
+def generate_badminton_stream(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None,
+                              cache_result: Optional[dict] = None):
+    """
+    キャッシュ検索の tier に応じて回答を生成し、(生成した tier, テキスト片) を yield する
+
+        near_miss - 小さいモデル（NEAR_MISS_MODEL）で似た質問の回答を調整する。失敗したら miss として生成
+        miss      - RAG・スケジュール情報を使って大きいモデルで生成する
+    hit はキャッシュの回答をそのまま返すので、ここは呼ばれない。
+    """
+    if _use_near_miss(cache_result):
+        adapted = False
+        for delta in adapt_cached_answer_stream(prompt, history, cache_result):
+            adapted = True
+            yield "near_miss", delta
+        if adapted:
+            return
+        metrics.inc("near_miss_fallbacks")
+    for delta in chat_badminton_stream(prompt, history, qdrant_client, embedding_context):
+        yield "miss", delta
+
+async def generate_badminton_stream_async(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None,
+                                          cache_result: Optional[dict] = None):
+    """generate_badminton_stream の非同期版"""
+    if _use_near_miss(cache_result):
+        adapted = False
+        async for delta in adapt_cached_answer_stream_async(prompt, history, cache_result):
+            adapted = True
+            yield "near_miss", delta
+        if adapted:
+            return
+        metrics.inc("near_miss_fallbacks")
+    async for delta in chat_badminton_stream_async(prompt, history, qdrant_client, embedding_context):
+        yield "miss", delta
+
+def chat_badminton_simple(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None) -> str:
+    """RAG検索とスケジュール情報を組み合わせて回答を生成（ストリーミング結果をまとめて返す）"""
+    return "".join(chat_badminton_stream(prompt, history, qdrant_client, embedding_context))
+
+async def chat_badminton_simple_async(prompt: str, history: ChatMessageHistory, qdrant_client, embedding_context=None) -> str:
+    """chat_badminton_simple の非同期版"""
+    return "".join([chunk async for chunk in chat_badminton_stream_async(prompt, history, qdrant_client, embedding_context)])
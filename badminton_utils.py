@@ -1,98 +1,241 @@
-from openai import OpenAI
-from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, Filter, FieldCondition, MatchValue
-import boto3
+from qdrant_client.models import PointStruct, WithLookup
+from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import os
 from typing import Optional, Dict, Any, List
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from uuid import uuid4
+from uuid import uuid5, UUID
 import time
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import json
 from dotenv import load_dotenv
 import re
+import threading
+from bisect import bisect_left, bisect_right
+from clients import get_openai_client, get_qdrant_client, get_dynamodb_resource
+from embedding_cache import embedding_cache
+from question_cache import normalize_question, question_answer_cache
+from observability import logger, metrics, span
+from cache_mirror import cache_mirror
+from hit_recorder import hit_recorder
+from enrichment import enricher
+from resilience import (CircuitOpenError, DeadlineExceeded, circuit_breakers, hedged_call, hedged_call_async,
+                        request_timeout)
 
 
 load_dotenv()
 
-embedding_model = OpenAIEmbeddings(model="text-embedding-3-small")
-enhancement_llm = ChatOpenAI(model_name="gpt-4o", temperature=0)
 
 CACHE_COLLECTION_NAME = "badminton-cache"
 
+# キャッシュ保存時の拡張でLLMを使う条件（off / fallback / always、enhance_with_ai を参照）
+ENRICHMENT_LLM_FALLBACK = os.getenv("ENRICHMENT_LLM_FALLBACK", "fallback").lower()
 
-client = OpenAI()
+# true の場合、キャッシュ保存時にすべての回答について言い換えの質問をLLMで生成し、類義語の点として登録する
+CACHE_ALTERNATIVE_QUESTIONS = os.getenv("CACHE_ALTERNATIVE_QUESTIONS", "false").lower() in ("1", "true", "yes")
+ALTERNATIVE_QUESTION_MODEL = os.getenv("ALTERNATIVE_QUESTION_MODEL", "gpt-4o-mini")
+ALTERNATIVE_QUESTION_COUNT = int(os.getenv("ALTERNATIVE_QUESTION_COUNT", "3"))
+
+# キャッシュの点IDを質問文から決定的に作るための名前空間
+CACHE_ID_NAMESPACE = UUID("6f1c2d3e-8a4b-5c6d-9e7f-0a1b2c3d4e5f")
+
+# 正規の回答点と類義語の点をまとめるペイロードキー
+ANSWER_GROUP_KEY = "answer_id"
+
+
+def canonical_point_id(question: str) -> str:
+    """正規化した質問文から回答点のIDを決める（同じ質問なら常に同じID）"""
+    return str(uuid5(CACHE_ID_NAMESPACE, normalize_question(question)))
+
+
+def alternative_point_id(answer_id: str, alt_question: str) -> str:
+    """類義語の点のID（回答IDと類義語の文から決定的に生成）"""
+    return str(uuid5(UUID(answer_id), normalize_question(alt_question)))
 
-def get_qdrant_client():
-    """Qdrantクライアントを取得"""
-    return QdrantClient(
-        url=os.getenv("QDRANT_URL"),
-        api_key=os.getenv("QDRANT_API_KEY")
-    )
 
 def enhance_with_ai_badminton(question: str) -> Dict[str, Any]:
-    try:
-        system_prompt = """
-        あなたは、バドミントンサークル「鶯（うぐいす）」専属のAIアシスタントです。
-
-        ユーザーからの質問を以下の観点で総合的に分析し、
-        その主旨を要約し、関連するキーワード、カテゴリ、難易度を特定してください。
-
-        【分析観点】
-        - 参加資格（年齢・学生・子供など）
-        - 参加形式（1回のみ・親子・友人同伴・途中参加）
-        - レベル（初心者・経験者・ブランクあり）
-        - 練習内容・雰囲気（形式・人数・ゲーム・指導）
-        - 費用・支払い方法（現金・PayPay・キャンセル）
-        - 安全性や保険・撮影などの配慮
-        - 初心者向けの「Boot Camp15」関連
-
-        【出力形式（JSONのみ）】
-        {
-        "summary": "質問の主旨（30文字以内）",
-        "keywords": ["キーワード1", "キーワード2", "キーワード3"],
-        "category": "カテゴリ名（例：参加資格、親子参加、初心者、費用、雰囲気、その他）",
-        "difficulty_level": "初級 / 中級 / 上級"
-        }
+    """質問の要約・キーワード・カテゴリ・難易度（ローカル辞書で抽出、LLMは呼ばない）"""
+    result = enricher.enrich(question)
+    return {
+        "summary": result["question_summary"],
+        "keywords": result["keywords"],
+        "category": result["category"],
+        "difficulty_level": result["difficulty_level"],
+        "intents": result["intents"],
+        "timestamp": datetime.now().isoformat()
+    }
 
-        説明文や解説は不要です。JSON形式でのみ出力してください。
-        """
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"次のバドミントンに関する質問を分析してください：{question}"}
-            ],
-            temperature=0.3
+def _lookup_l1_cache(question: str) -> Optional[Dict[str, Any]]:
+    """L1: 正規化した質問文の完全一致（ネットワーク呼び出しなし）"""
+    with span("l1_lookup") as s:
+        l1_entry = question_answer_cache.get(question)
+        s.set(hit=l1_entry is not None)
+    if l1_entry is None:
+        return None
+
+    logger.debug("[BADMINTON] L1キャッシュヒット: %s", question_answer_cache.stats())
+    hit_recorder.record(l1_entry["vector_id"])
+    return {
+        "found": True,
+        "answer": l1_entry["answer"],
+        "score": l1_entry["score"] if l1_entry["score"] is not None else 1.0,
+        "vector_id": l1_entry["vector_id"],
+        "tier": "hit",
+        "cache_level": "L1"
+    }
+
+class CacheThresholds:
+    """
+    キャッシュ検索の判定閾値
+
+    - hit: この類似度以上ならキャッシュの回答をそのまま返す（カテゴリごとに上書き可能）
+    - near_miss: hit 未満でもこの類似度以上なら「惜しい」結果として類似度と回答を返す
+      （小さいモデルが今回の質問に合わせて調整する。generate_badminton_stream を参照）
+    near_miss より低い結果はQdrant側の score_threshold で除外され、転送されない。
+    """
+
+    def __init__(self, hit: float = 0.85, near_miss: float = 0.75, per_category: Optional[Dict[str, float]] = None):
+        self.hit = hit
+        self.near_miss = near_miss
+        self.per_category = per_category or {}
+
+    @property
+    def floor(self) -> float:
+        """サーバー側に渡す最低類似度"""
+        return min([self.near_miss, self.hit] + list(self.per_category.values()))
+
+    def with_bands(self, hit: Optional[float] = None, near_miss: Optional[float] = None) -> 'CacheThresholds':
+        """hit / near_miss の境界だけを差し替えたコピー（カテゴリごとの hit はそのまま）"""
+        return CacheThresholds(
+            hit=self.hit if hit is None else hit,
+            near_miss=self.near_miss if near_miss is None else near_miss,
+            per_category=self.per_category
         )
 
-        result = {
-            "summary": extract_summary_badminton(response),
-            "keywords": extract_keywords_badminton(question),
-            "category": classify_badminton_category(question),
-            "difficulty_level": assess_difficulty_level(question),
-            "timestamp": datetime.now().isoformat()
-        }
+    def hit_threshold(self, category: Optional[str]) -> float:
+        return self.per_category.get(category, self.hit)
 
-        print("[BADMINTON] AI拡張処理完了")
-        return result
+    def classify(self, score: float, category: Optional[str]) -> str:
+        if score >= self.hit_threshold(category):
+            return "hit"
+        if score >= self.near_miss:
+            return "near_miss"
+        return "miss"
 
-    except Exception as e:
-        print(f"[ERROR] バドミントンAI拡張処理失敗: {e}")
-        return {
-            "summary": question,
-            "keywords": [],
-            "category": "その他",
-            "difficulty_level": "初級",
-            "timestamp": datetime.now().isoformat()
-        }
 
-    
-def search_cached_answer_badminton(question, qdrant_client_param, history=None):
+def _load_category_thresholds() -> Dict[str, float]:
+    raw = os.getenv("CACHE_CATEGORY_THRESHOLDS")
+    if not raw:
+        return {}
+    try:
+        return {category: float(value) for category, value in json.loads(raw).items()}
+    except (ValueError, AttributeError) as e:
+        logger.warning("[WARN] CACHE_CATEGORY_THRESHOLDS を解釈できません: %s", e)
+        return {}
+
+
+cache_thresholds = CacheThresholds(
+    hit=float(os.getenv("CACHE_HIT_THRESHOLD", "0.85")),
+    near_miss=float(os.getenv("CACHE_NEAR_MISS_THRESHOLD", "0.75")),
+    per_category=_load_category_thresholds()
+)
+
+# 判定に必要なペイロード項目だけを取得する（ヒット側は類似度の判定用、lookup 側は回答本文）
+CACHE_HIT_PAYLOAD = ["category"]
+CACHE_ANSWER_PAYLOAD = ["text", "answer", "question", "category"]
+
+def _cache_search_request(question_vector, thresholds: CacheThresholds) -> Dict[str, Any]:
+    """
+    badminton-cache への query_points_groups の引数
+
+    類義語の点は回答本文を持たないので、answer_id でグループ化して回答ごとに最良の1件を取り、
+    回答本文は with_lookup で正規の回答点から1回だけ取得する。閾値未満の点はサーバー側で除外する。
+    """
+    return {
+        "collection_name": CACHE_COLLECTION_NAME,
+        "query": question_vector,
+        "group_by": ANSWER_GROUP_KEY,
+        "limit": 3,
+        "group_size": 1,
+        "score_threshold": thresholds.floor,
+        "with_payload": CACHE_HIT_PAYLOAD,
+        "with_lookup": WithLookup(collection=CACHE_COLLECTION_NAME, with_payload=CACHE_ANSWER_PAYLOAD, with_vectors=False)
+    }
+
+def _query_cache_groups(client, request: Dict[str, Any]):
+    with span("qdrant_query", collection=CACHE_COLLECTION_NAME):
+        return client.query_points_groups(**request)
+
+async def _query_cache_groups_async(client, request: Dict[str, Any]):
+    with span("qdrant_query", collection=CACHE_COLLECTION_NAME):
+        return await client.query_points_groups(**request)
+
+def _select_cached_answer(question: str, search_results, thresholds: CacheThresholds) -> Dict[str, Any]:
+    """
+    グループ化した検索結果を判定する
+
+    結果は tier で区別する:
+        hit       - 閾値以上の回答（found=True、L1キャッシュにも登録）
+        near_miss - 閾値には届かないが近い回答（found=False、類似度と回答を含む）
+        miss      - 該当なし
+    """
+    groups = [group for group in getattr(search_results, 'groups', []) if group.hits]
+    near_miss = None
+
+    for group in groups:
+        best_match = group.hits[0]
+        canonical = (group.lookup.payload if group.lookup is not None else None) or best_match.payload or {}
+        category = (best_match.payload or {}).get('category') or canonical.get('category')
+        tier = thresholds.classify(best_match.score, category)
+        logger.debug("[DEBUG] 候補: スコア %.4f 回答ID %s カテゴリ %s -> %s", best_match.score, group.id, category, tier)
+
+        answer = canonical.get('text') or canonical.get('answer')
+        if not answer:
+            logger.warning("[BADMINTON] 回答本文が見つかりません: 回答ID=%s", group.id)
+            continue
+
+        if tier == "hit":
+            # 条件を満たす最初の回答で打ち切る
+            question_answer_cache.put(question, answer, vector_id=str(group.id), score=best_match.score)
+            hit_recorder.record(group.id)
+            return {
+                "found": True,
+                "tier": "hit",
+                "answer": answer,
+                "score": best_match.score,
+                "category": category,
+                "vector_id": str(group.id),
+                "cache_level": "L2"
+            }
+        if tier == "near_miss" and near_miss is None:
+            near_miss = {
+                "found": False,
+                "tier": "near_miss",
+                "answer": answer,
+                "score": best_match.score,
+                "category": category,
+                "threshold": thresholds.hit_threshold(category),
+                "vector_id": str(group.id),
+                "cached_question": canonical.get('question')
+            }
+
+    if near_miss is not None:
+        logger.debug("[BADMINTON] 惜しい結果: Score=%.3f (閾値 %.2f)", near_miss["score"], near_miss["threshold"])
+        return near_miss
+    logger.debug("[BADMINTON] 類似質問が見つかりませんでした")
+    return {"found": False, "tier": "miss"}
+
+def _resolve_thresholds(thresholds: Optional[CacheThresholds], hit_threshold: Optional[float],
+                        near_miss_threshold: Optional[float]) -> CacheThresholds:
+    thresholds = thresholds or cache_thresholds
+    if hit_threshold is None and near_miss_threshold is None:
+        return thresholds
+    return thresholds.with_bands(hit=hit_threshold, near_miss=near_miss_threshold)
+
+def search_cached_answer_badminton(question, qdrant_client_param, history=None, embedding_context=None,
+                                   thresholds: Optional[CacheThresholds] = None,
+                                   hit_threshold: Optional[float] = None, near_miss_threshold: Optional[float] = None):
     """
     Qdrantキャッシュから類似質問を検索
     
@@ -100,68 +243,95 @@ def search_cached_answer_badminton(question, qdrant_client_param, history=None):
         question: ユーザーの質問
         qdrant_client_param: Qdrantクライアントインスタンス
         history: 会話履歴（オプション）
+        embedding_context: リクエスト単位の埋め込みコンテキスト（オプション）
+        thresholds: 判定閾値（省略時は環境変数から読んだ cache_thresholds）
+        hit_threshold: hit の下限（指定時は thresholds の既定値を上書き）
+        near_miss_threshold: near_miss の下限（指定時は thresholds の値を上書き）
+
+    Returns:
+        found・tier（hit / near_miss / miss）・answer・score などを含む辞書。
+        near_miss の場合は似た質問（cached_question）も含む
     """
+    thresholds = _resolve_thresholds(thresholds, hit_threshold, near_miss_threshold)
     try:
-        print(f"[DEBUG] 検索質問: '{question}'")
-        print("[BADMINTON] Qdrantキャッシュ検索開始...")
-        
-        # ベクトル化
-        question_vector = get_embedding_badminton(question)
-        print(f"[DEBUG] ベクトル長: {len(question_vector)}")
-        
-        # ✅ 正しいQdrant検索（query_points を使う）
-        search_results = qdrant_client_param.query_points(
-            collection_name="badminton-cache",
-            query=question_vector,  # query_vector ではなく query
-            limit=10,
-            score_threshold=0.0,  # まず閾値なしで全件取得
-            with_payload=True
-        )
-        
-        # 結果の取得
-        all_results = search_results.points if hasattr(search_results, 'points') else []
-        
-        print(f"[DEBUG] 検索結果総数: {len(all_results)}")
-        print("[DEBUG] トップ10の類似度スコアと質問:")
-        for i, result in enumerate(all_results[:10], 1):
-            # payloadから元の質問を取得
-            payload = result.payload
-            original_q = payload.get('question', 'N/A')
-            summary = payload.get('question_summary', 'N/A')
-            category = payload.get('category', 'N/A')
-            
-            print(f"  {i}. スコア: {result.score:.4f}")
-            print(f"     元質問: {original_q[:50]}...")
-            print(f"     要約: {summary}")
-            print(f"     カテゴリ: {category}")
-            print()
-        
-        # 閾値でフィルタリング
-        threshold = 0.85
-        filtered_results = [r for r in all_results if r.score >= threshold]
-        
-        print(f"[DEBUG] 閾値{threshold}以上の結果: {len(filtered_results)}件")
-        
-        if not filtered_results:
-            print("[BADMINTON] 類似質問が見つかりませんでした")
-            return {"found": False}
-        
-        # ベストマッチを返す
-        best_match = filtered_results[0]
-        print(f"[BADMINTON] ベストマッチ発見: Score={best_match.score:.3f}, ID={best_match.id}")
-        
-        return {
-            "found": True,
-            "answer": best_match.payload.get('text') or best_match.payload.get('answer'),  # 'text' も確認
-            "score": best_match.score,
-            "vector_id": best_match.id
-        }
-        
+        l1_result = _lookup_l1_cache(question)
+        if l1_result is not None:
+            return l1_result
+
+        with span("l2_lookup") as s:
+            # ベクトル化（コンテキストがあれば計算済みの埋め込みを再利用）
+            if embedding_context is not None:
+                question_vector = embedding_context.embedding
+            else:
+                question_vector = get_embedding_badminton(question)
+
+            if cache_mirror.ready:
+                # ローカルミラーで検索（ネットワーク往復なし）
+                with span("mirror_query"):
+                    search_results = cache_mirror.query_points_groups(**_cache_search_request(question_vector, thresholds))
+            else:
+                # ブレーカーが開いていれば即座に CircuitOpenError（キャッシュ検索を飛ばす）
+                search_results = circuit_breakers.get("qdrant_cache").call(
+                    hedged_call, "qdrant_query", _query_cache_groups, qdrant_client_param,
+                    _cache_search_request(question_vector, thresholds), timeout=request_timeout("cache_query")
+                )
+            result = _select_cached_answer(question, search_results, thresholds)
+            s.set(tier=result["tier"])
+        return result
+
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.debug("[BADMINTON] キャッシュ検索をスキップ: %s", e)
+        return {"found": False, "tier": "miss"}
+    except Exception as e:
+        logger.exception("[ERROR] キャッシュ検索中にエラー: %s", e)
+        return {"found": False, "tier": "miss"}
+
+async def search_cached_answer_badminton_async(question, qdrant_client_param, history=None, embedding_context=None,
+                                               thresholds: Optional[CacheThresholds] = None,
+                                               hit_threshold: Optional[float] = None,
+                                               near_miss_threshold: Optional[float] = None):
+    """
+    search_cached_answer_badminton の非同期版
+
+    Args:
+        question: ユーザーの質問
+        qdrant_client_param: AsyncQdrantClient インスタンス
+        history: 会話履歴（オプション）
+        embedding_context: リクエスト単位の埋め込みコンテキスト（オプション）
+        thresholds: 判定閾値（省略時は cache_thresholds）
+        hit_threshold: hit の下限（指定時は thresholds の既定値を上書き）
+        near_miss_threshold: near_miss の下限（指定時は thresholds の値を上書き）
+    """
+    thresholds = _resolve_thresholds(thresholds, hit_threshold, near_miss_threshold)
+    try:
+        l1_result = _lookup_l1_cache(question)
+        if l1_result is not None:
+            return l1_result
+
+        with span("l2_lookup") as s:
+            if embedding_context is not None:
+                question_vector = await embedding_context.get_embedding_async()
+            else:
+                question_vector = await embedding_cache.embed_async(question)
+
+            if cache_mirror.ready:
+                with span("mirror_query"):
+                    search_results = cache_mirror.query_points_groups(**_cache_search_request(question_vector, thresholds))
+            else:
+                search_results = await circuit_breakers.get("qdrant_cache").call_async(
+                    hedged_call_async, "qdrant_query", _query_cache_groups_async, qdrant_client_param,
+                    _cache_search_request(question_vector, thresholds), timeout=request_timeout("cache_query")
+                )
+            result = _select_cached_answer(question, search_results, thresholds)
+            s.set(tier=result["tier"])
+        return result
+
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.debug("[BADMINTON] キャッシュ検索をスキップ: %s", e)
+        return {"found": False, "tier": "miss"}
     except Exception as e:
-        print(f"[ERROR] キャッシュ検索中にエラー: {e}")
-        import traceback
-        traceback.print_exc()
-        return {"found": False}
+        logger.exception("[ERROR] キャッシュ検索中にエラー: %s", e)
+        return {"found": False, "tier": "miss"}
 
 def get_badminton_statistics() -> Dict[str, Any]:
     try:
@@ -175,166 +345,165 @@ def get_badminton_statistics() -> Dict[str, Any]:
         }
 
     except Exception as e:
-        print(f"[ERROR] バドミントン統計取得失敗: {e}")
+        logger.error("[BADMINTON] バドミントン統計取得失敗: %s", e)
         return {"total_qa_pairs": 0, "collection_name": "unknown"}
 
 def classify_badminton_category(question: str) -> str:
-    question_lower = question.lower()
-
-    categories = {
-        "技術": ["スマッシュ", "クリア", "ドロップ", "ネット", "サーブ", "レシーブ", "フォア", "バック", "フットワーク"],
-        "戦術": ["戦術", "戦略", "ダブルス", "シングルス", "ポジション", "攻撃", "守備", "ローテーション"],
-        "道具": ["ラケット", "ガット", "シューズ", "ウェア", "グリップ", "シャトル", "バッグ"],
-        "練習": ["練習", "トレーニング", "メニュー", "上達", "コツ", "基礎", "応用", "筋トレ"],
-        "ルール": ["ルール", "反則", "得点", "審判", "コート", "サイズ", "線", "規則"],
-        "怪我・健康": ["怪我", "痛み", "予防", "ストレッチ", "準備運動", "アイシング", "テーピング"],
-        "サークル運営": ["サークル", "練習日", "会費", "新人", "イベント", "大会", "合宿"]
-    }
-
-    for category, keywords in categories.items():
-        if any(keyword in question_lower for keyword in keywords):
-            return category
-
-    return "その他"
+    return enricher.analyze(question)["category"]
 
 def assess_difficulty_level(question: str) -> str:
-    question_lower = question.lower()
-
-    beginner_keywords = ["初心者", "始める", "基礎", "基本", "簡単", "教えて"]
-    intermediate_keywords = ["上達", "コツ", "改善", "練習方法"]
-    advanced_keywords = ["高度", "応用", "戦術", "競技", "大会", "プロ"]
-
-    if any(keyword in question_lower for keyword in advanced_keywords):
-        return "上級"
-    elif any(keyword in question_lower for keyword in intermediate_keywords):
-        return "中級"
-    elif any(keyword in question_lower for keyword in beginner_keywords):
-        return "初級"
-    else:
-        return "中級"
-
-def extract_summary_badminton(response) -> str:
-    try:
-        content = response.choices[0].message.content
-        lines = content.split('\n')
-        return lines[0][:100] if lines else content[:100]
-    except:
-        return "バドミントンに関する質問"
+    return enricher.analyze(question)["difficulty_level"]
 
 def extract_keywords_badminton(question_text: str) -> List[str]:
-    try:
-        followup = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": """あなたは日本語のバドミントン専門アシスタントです。
-
-質問から重要なキーワードを3〜5個抽出してください。以下の点に注意してください：
-
-1. 質問の具体的な意図を明確に区別してください：
-   - 場所関連: 「どこ」「場所」「会場」「体育館」「住所」「アクセス」
-   - 内容関連: 「どんな」「内容」「メニュー」「何をする」「練習内容」「プログラム」
-   - 時間関連: 「いつ」「曜日」「時間」「スケジュール」「日程」
-   - 費用関連: 「料金」「費用」「いくら」「お金」「参加費」
-   - 参加関連: 「初心者」「レベル」「条件」「年齢」「経験」
-   - 準備関連: 「持ち物」「ラケット」「シューズ」「服装」「用意」
+    return enricher.analyze(question_text)["keywords"]
 
-2. 汎用的すぎる単語（「バドミントン」「練習」「サークル」）は避け、より具体的な意図を表すキーワードを選んでください。
-
-3. 必ず以下の形式でのみ返してください：[\"キーワード1\", \"キーワード2\", \"キーワード3\"]"""},
-                {"role": "user", "content": f"この質問から重要なキーワードを抽出してください：\n\n{question_text}"}
-            ],
-            temperature=0.1
-        )
+def get_embedding_badminton(text: str) -> list:
+    try:
+        return embedding_cache.embed(text)
 
-        result = followup.choices[0].message.content.strip()
-        
-        # デバッグ用ログ
-        print(f"[DEBUG] 質問からのキーワード抽出結果: {result}")
-        
-        return json.loads(result)
-    
-    except json.JSONDecodeError as e:
-        print(f"[ERROR] JSON解析エラー: {e}")
-        print(f"[DEBUG] 受信したテキスト: {followup.choices[0].message.content}")
-        return []
     except Exception as e:
-        print(f"[ERROR] キーワード抽出エラー: {e}")
+        logger.error("[BADMINTON] バドミントン埋め込み生成失敗: %s", e)
         return []
 
-def get_embedding_badminton(text: str) -> list:
+def cleanup_old_badminton_cache(days_to_keep: int = 90, dry_run: bool = False):
+    """古いキャッシュのクリーンアップ（期限切れ削除と件数上限は cache_compaction を参照）"""
     try:
-        response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=[text]
-        )
-
-        if not response.data or not response.data[0].embedding:
-            raise ValueError("埋め込みが空です")
-
-        return response.data[0].embedding
+        from cache_compaction import compact_cache
+        return compact_cache(get_qdrant_client(), max_age_days=days_to_keep, dry_run=dry_run)
 
     except Exception as e:
-        print(f"[ERROR] バドミントン埋め込み生成失敗: {e}")
-        return []
+        logger.error("[BADMINTON] キャッシュクリーンアップ失敗: %s", e)
+        return None
 
-def cleanup_old_badminton_cache(days_to_keep: int = 90):
-    """古いキャッシュのクリーンアップ（Qdrantでは手動で実装が必要）"""
-    try:
-        qdrant_client = get_qdrant_client()
-        cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).isoformat()
 
-        print(f"[BADMINTON] {days_to_keep}日より古いキャッシュをクリーンアップ（未実装）")
-        # Qdrantでは、scroll APIを使って古いポイントを削除する必要があります
 
-    except Exception as e:
-        print(f"[ERROR] バドミントンキャッシュクリーンアップ失敗: {e}")
+# bad_schedules の検索用GSI（パーティションキー: status_month, ソートキー: date）
+SCHEDULE_INDEX_NAME = os.getenv('DYNAMODB_SCHEDULE_INDEX', 'status-month-index')
+
+def build_status_month(status: str, date_str: str) -> str:
+    """GSIのパーティションキー値を作る（例: 'active#2026-10'）"""
+    return f"{status}#{date_str[:7]}"
 
+def _month_ranges(start: date, end: date) -> List[tuple]:
+    """start〜endを月ごとの (YYYY-MM, 月内の開始日, 月内の終了日) に分割する"""
+    ranges = []
+    cursor = start
+    while cursor <= end:
+        next_month = (cursor.replace(day=28) + timedelta(days=4)).replace(day=1)
+        month_end = min(end, next_month - timedelta(days=1))
+        ranges.append((cursor.strftime('%Y-%m'), cursor, month_end))
+        cursor = next_month
+    return ranges
 
 
 class BadmintonScheduleManager:
     def __init__(self):
         """DynamoDBクライアントを初期化"""
         try:
-            self.dynamodb = boto3.resource(
-                'dynamodb',
-                region_name=os.getenv('AWS_REGION', 'ap-northeast-1'),
-                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-            )
+            self.dynamodb = get_dynamodb_resource()
             
             # テーブル名（既存のbad_schedulesテーブルを使用）
             self.schedule_table_name = os.getenv('DYNAMODB_SCHEDULE_TABLE', 'bad_schedules')
             self.schedule_table = self.dynamodb.Table(self.schedule_table_name)
+            self.index_name = SCHEDULE_INDEX_NAME
+            self.index_available = True
+            # status_month の未設定行がないと確認済みの (status, 月)
+            self._indexed_months = set()
+
+            # 直近の読み込みで消費したキャパシティ（比較・監視用）
+            self.last_consumed_capacity = 0.0
             
-            print(f"[INFO] DynamoDBテーブル '{self.schedule_table_name}' に接続しました")
+            logger.info("[SCHEDULE] DynamoDBテーブル '%s' に接続しました", self.schedule_table_name)
         except Exception as e:
-            print(f"[ERROR] DynamoDB初期化失敗: {e}")
+            logger.error("[SCHEDULE] DynamoDB初期化失敗: %s", e)
             raise
+
+    def _paginate(self, operation, **kwargs) -> List[Dict[str, Any]]:
+        """query/scan を LastEvaluatedKey がなくなるまで繰り返し、全件と消費キャパシティを集計する（DynamoDBのブレーカー越し）"""
+        items = []
+        kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+        breaker = circuit_breakers.get("dynamodb")
+        while True:
+            response = breaker.call(operation, **kwargs)
+            items.extend(response.get('Items', []))
+            self.last_consumed_capacity += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return items
+            kwargs['ExclusiveStartKey'] = last_key
+
+    def query_practices(self, start_date: date, end_date: date, status: str = 'active') -> List[Dict[str, Any]]:
+        """
+        GSI（status_month + date）で期間内の練習予定を取得する
+
+        月ごとのパーティションに対して date の BETWEEN 範囲クエリを発行し、
+        ページネーションで全件を取得する。GSIが未作成の場合は、移行期間用に
+        ページネーション付きscanへフォールバックする。GSIはあるが結果が空の月は、
+        status_month 未設定（バックフィル漏れ）の行がないかを確かめ、あればその行を返す。
+        """
+        self.last_consumed_capacity = 0.0
+
+        if self.index_available:
+            try:
+                practices = []
+                for month, month_start, month_end in _month_ranges(start_date, end_date):
+                    items = self._paginate(
+                        self.schedule_table.query,
+                        IndexName=self.index_name,
+                        KeyConditionExpression=(
+                            Key('status_month').eq(f"{status}#{month}") &
+                            Key('date').between(month_start.isoformat(), month_end.isoformat())
+                        )
+                    )
+                    if not items and (status, month) not in self._indexed_months:
+                        items = self._unindexed_practices(status, month, month_start, month_end)
+                    practices.extend(items)
+                return practices
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'ValidationException':
+                    raise
+                self.index_available = False
+                logger.warning("[SCHEDULE] GSI '%s' が使用できません。migrate_schedule_index.py を実行してください: %s", self.index_name, e)
+
+        return self._paginate(
+            self.schedule_table.scan,
+            FilterExpression=(
+                Attr('date').between(start_date.isoformat(), end_date.isoformat()) &
+                Attr('status').eq(status)
+            )
+        )
     
+    def _unindexed_practices(self, status: str, month: str, month_start: date, month_end: date) -> List[Dict[str, Any]]:
+        """GSIに載っていない（status_month 未設定の）行をscanで探す。なければ月を確認済みにする"""
+        items = self._paginate(
+            self.schedule_table.scan,
+            FilterExpression=(
+                Attr('date').between(month_start.isoformat(), month_end.isoformat()) &
+                Attr('status').eq(status) &
+                Attr('status_month').not_exists()
+            )
+        )
+        if not items:
+            self._indexed_months.add((status, month))
+            return items
+
+        metrics.inc("schedule_unindexed_rows", len(items))
+        logger.warning(
+            "[SCHEDULE] %s の %d件に status_month がなくGSIで取得できません。scanで補います。"
+            "migrate_schedule_index.py --backfill を実行してください",
+            month, len(items)
+        )
+        return items
+
     def get_upcoming_practices(self, days_ahead: int = 14) -> List[Dict[str, Any]]:
         try:
             today = datetime.now().date()
             end_date = today + timedelta(days=days_ahead)
             
-            print(f"[INFO] 練習予定を検索中: {today} ～ {end_date}")
+            logger.debug("[INFO] 練習予定を検索中: %s ～ %s", today, end_date)
             
-            response = self.schedule_table.scan(
-                FilterExpression=(
-                    '#date BETWEEN :start_date AND :end_date AND #status = :active_status'
-                ),
-                ExpressionAttributeNames={
-                    '#date': 'date',
-                    '#status': 'status'
-                },
-                ExpressionAttributeValues={
-                    ':start_date': today.isoformat(),
-                    ':end_date': end_date.isoformat(),
-                    ':active_status': 'active'
-                }
-            )
-
-            practices = response.get('Items', [])
-            print(f"[INFO] {len(practices)}件の練習予定を取得しました")
+            practices = self.query_practices(today, end_date)
+            logger.debug("[INFO] %d件の練習予定を取得しました (消費RCU: %s)", len(practices), self.last_consumed_capacity)
 
             # 日付順ソート
             practices.sort(key=lambda x: x.get('date', ''))
@@ -342,46 +511,26 @@ class BadmintonScheduleManager:
             return practices
 
         except ClientError as e:
-            print(f"[ERROR] DynamoDB練習予定取得エラー: {e}")
+            logger.error("[SCHEDULE] DynamoDB練習予定取得エラー: %s", e)
             return []
         except Exception as e:
-            print(f"[ERROR] 予期しないエラー: {e}")
+            logger.error("[SCHEDULE] 予期しないエラー: %s", e)
             return []
     
     def get_practice_by_date(self, target_date: str) -> Optional[Dict[str, Any]]:
         """特定日の練習予定を取得"""
         try:
-            print(f"[INFO] {target_date}の練習予定を検索中...")
-            
-            # まずGSIを試す
-            try:
-                response = self.schedule_table.query(
-                    IndexName='date-index',
-                    KeyConditionExpression='#date = :date',
-                    ExpressionAttributeNames={
-                        '#date': 'date'
-                    },
-                    ExpressionAttributeValues={
-                        ':date': target_date
-                    }
-                )
-                
-                items = response.get('Items', [])
-                return items[0] if items else None
-                
-            except ClientError as e:
-                print(f"[ERROR] DynamoDB特定日練習予定取得エラー: {e}")
-                # GSIがない場合はscanにフォールバック
-                response = self.schedule_table.scan(
-                    FilterExpression='#date = :date',
-                    ExpressionAttributeNames={'#date': 'date'},
-                    ExpressionAttributeValues={':date': target_date}
-                )
-                items = response.get('Items', [])
-                return items[0] if items else None
+            logger.debug("[INFO] %sの練習予定を検索中...", target_date)
+
+            day = datetime.strptime(target_date, '%Y-%m-%d').date()
+            items = self.query_practices(day, day)
+            return items[0] if items else None
             
+        except ClientError as e:
+            logger.error("[SCHEDULE] DynamoDB特定日練習予定取得エラー: %s", e)
+            return None
         except Exception as e:
-            print(f"[ERROR] 予期しないエラー: {e}")
+            logger.error("[SCHEDULE] 予期しないエラー: %s", e)
             return None
     
     def format_schedule_for_chat(self, schedules: List[Dict[str, Any]]) -> str:
@@ -416,179 +565,328 @@ class BadmintonScheduleManager:
         return formatted_text.strip()
 
 
+class ScheduleUnavailable(RuntimeError):
+    """練習予定を取得できず、使えるスナップショットもない"""
+
+
+class ScheduleSnapshot:
+    """
+    アクティブな練習予定のメモリ内スナップショット
+
+    日付順に並べた練習予定を保持し、bisectによる範囲検索で今週・来週・今月・特定日の
+    予定を返す。データはバックグラウンドスレッドがTTLごとにDynamoDBから再取得する。
+
+    再取得に失敗した場合は直前のスナップショットを古いもの（stale）として使い続ける。
+    最後の取得から max_stale 秒を過ぎた場合と初回の取得に失敗した場合は
+    ScheduleUnavailable を送出し、呼び出し側のフォールバックに任せる。
+    """
+
+    def __init__(self, manager: 'BadmintonScheduleManager', ttl: float = 300, horizon_days: int = 62,
+                 max_stale: float = 3600):
+        """
+        Args:
+            manager: DynamoDBアクセスに使うスケジュールマネージャ
+            ttl: 再取得間隔（秒）
+            horizon_days: 今日から何日先までを保持するか
+            max_stale: 再取得に失敗し続けた場合に古いスナップショットを使う上限（秒）
+        """
+        self.manager = manager
+        self.ttl = ttl
+        self.horizon_days = horizon_days
+        self.max_stale = max_stale
+        # (日付文字列のリスト, 練習予定のリスト) を1つのタプルで差し替えてアトミックに更新する
+        self._data = ([], [])
+        self.loaded_at = None
+        self.stale = False
+        self.refresh_failures = 0
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def refresh(self) -> None:
+        """
+        DynamoDBから練習予定を読み直してスナップショットを差し替える
+
+        get_upcoming_practices はエラー時に空リストを返すため使わず、直接クエリして
+        エラーは呼び出し側へ送出する（空の予定で正しいスナップショットを上書きしない）。
+        """
+        today = datetime.now().date()
+        practices = self.manager.query_practices(today, today + timedelta(days=self.horizon_days))
+        practices = sorted(practices, key=lambda x: x.get('date', ''))
+        self._data = ([p.get('date', '') for p in practices], practices)
+        self.loaded_at = time.time()
+        self.stale = False
+        self.refresh_failures = 0
+        logger.info("[SCHEDULE] 練習予定スナップショット更新: %d件", len(practices))
+
+    def _refresh_loop(self) -> None:
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.refresh()
+            except Exception as e:
+                self.stale = True
+                self.refresh_failures += 1
+                metrics.inc("schedule_refresh_failures")
+                logger.warning("[SCHEDULE] 練習予定スナップショット更新失敗（%.0f秒前の予定を使用）: %s", time.time() - self.loaded_at, e)
+
+    def _ensure_loaded(self) -> None:
+        if self.loaded_at is None or self._refresher is None:
+            with self._lock:
+                if self.loaded_at is None:
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        raise ScheduleUnavailable(f"練習予定を取得できません: {e}") from e
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._refresh_loop, name="schedule-refresh", daemon=True)
+                    self._refresher.start()
+        if self.stale and time.time() - self.loaded_at > self.max_stale:
+            raise ScheduleUnavailable(f"練習予定が{self.max_stale:.0f}秒以上更新できていません")
+
+    def between(self, start: date, end: date) -> List[Dict[str, Any]]:
+        """start〜end（両端含む）の練習予定を返す"""
+        self._ensure_loaded()
+        dates, practices = self._data
+        lo = bisect_left(dates, start.isoformat())
+        hi = bisect_right(dates, end.isoformat())
+        return practices[lo:hi]
+
+    def on_date(self, target: date) -> List[Dict[str, Any]]:
+        return self.between(target, target)
+
+    def upcoming(self, today: date, days_ahead: int = 14) -> List[Dict[str, Any]]:
+        return self.between(today, today + timedelta(days=days_ahead))
+
+    def this_week(self, today: date) -> List[Dict[str, Any]]:
+        """今日から今週の日曜日まで"""
+        return self.between(today, today + timedelta(days=6 - today.weekday()))
+
+    def next_week(self, today: date) -> List[Dict[str, Any]]:
+        """来週の月曜日から日曜日まで"""
+        next_monday = today + timedelta(days=7 - today.weekday())
+        return self.between(next_monday, next_monday + timedelta(days=6))
+
+    def this_month(self, today: date) -> List[Dict[str, Any]]:
+        """今日から今月末まで"""
+        next_month = (today.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return self.between(today, next_month - timedelta(days=1))
+
+
+_schedule_snapshot = None
+_schedule_snapshot_lock = threading.Lock()
+
+def get_schedule_snapshot() -> ScheduleSnapshot:
+    """プロセス全体で共有するスケジュールスナップショットを取得（初回のみマネージャを生成）"""
+    global _schedule_snapshot
+    if _schedule_snapshot is None:
+        with _schedule_snapshot_lock:
+            if _schedule_snapshot is None:
+                _schedule_snapshot = ScheduleSnapshot(
+                    BadmintonScheduleManager(),
+                    ttl=float(os.getenv("SCHEDULE_SNAPSHOT_TTL", "300")),
+                    horizon_days=int(os.getenv("SCHEDULE_SNAPSHOT_DAYS", "62")),
+                    max_stale=float(os.getenv("SCHEDULE_SNAPSHOT_MAX_STALE", "3600"))
+                )
+    return _schedule_snapshot
+
+
 # チャットボット統合用の関数（クラス外の独立関数）
 def get_schedule_response(user_message: str) -> str:
-    """ユーザーメッセージに基づいて練習スケジュール情報を返す"""
+    """ユーザーメッセージに基づいて練習スケジュール情報を返す（メモリ内スナップショットから応答）"""
     try:
-        schedule_manager = BadmintonScheduleManager()
+        snapshot = get_schedule_snapshot()
         today = datetime.now().date()
         
         # メッセージ内容に基づいて処理を分岐
-        message_lower = user_message.lower()
-        
         if '今週' in user_message or 'この週' in user_message:
-            practices = schedule_manager.get_upcoming_practices(days_ahead=7)
-            return schedule_manager.format_schedule_for_chat(practices)
-        
+            practices = snapshot.this_week(today)
         elif '来週' in user_message or '次週' in user_message:
-            days_to_next_week = 7 - today.weekday()
-            practices = schedule_manager.get_upcoming_practices(days_ahead=14)
-            
-            # 来週分のみフィルタリング
-            next_week_practices = []
-            for practice in practices:
-                try:
-                    practice_date = datetime.strptime(practice['date'], '%Y-%m-%d').date()
-                    if practice_date >= today + timedelta(days=days_to_next_week):
-                        next_week_practices.append(practice)
-                except Exception as e:
-                    print(f"[WARN] 日付解析エラー: {e}")
-                    continue
-            
-            return schedule_manager.format_schedule_for_chat(next_week_practices)
-        
+            practices = snapshot.next_week(today)
         elif '今月' in user_message or 'この月' in user_message:
-            practices = schedule_manager.get_upcoming_practices(days_ahead=60)
-            
-            # 今月分のみフィルタリング
-            current_month = today.month
-            current_year = today.year
-            current_month_practices = []
-            
-            for practice in practices:
-                try:
-                    practice_date = datetime.strptime(practice['date'], '%Y-%m-%d').date()
-                    if (practice_date.year == current_year and 
-                        practice_date.month == current_month and 
-                        practice_date >= today):
-                        current_month_practices.append(practice)
-                except Exception as e:
-                    print(f"[WARN] 日付解析エラー: {e}")
-                    continue
-            
-            return schedule_manager.format_schedule_for_chat(current_month_practices)
-        
+            practices = snapshot.this_month(today)
         else:
             # デフォルトは今後2週間
-            practices = schedule_manager.get_upcoming_practices()
-            return schedule_manager.format_schedule_for_chat(practices)
+            practices = snapshot.upcoming(today)
+
+        return snapshot.manager.format_schedule_for_chat(practices)
     
     except Exception as e:
-        print(f"[ERROR] スケジュール取得エラー: {e}")
+        logger.error("[SCHEDULE] スケジュール取得エラー: %s", e)
         return "申し訳ございません、現在スケジュール情報を取得できません。"
 
 
-def store_response_in_pinecone_badminton(question: str, answer: str) -> bool:
+def store_response_in_pinecone_badminton(question: str, answer: str, question_embedding: Optional[List[float]] = None,
+                                         point_id: Optional[str] = None) -> bool:
     """バドミントン用チャットのQAペアをQdrantキャッシュに保存する関数"""
     return store_response_in_qdrant(
         question=question,
         answer=answer,
-        collection_name="badminton-cache"
+        collection_name="badminton-cache",
+        question_embedding=question_embedding,
+        point_id=point_id
     )
 
-def store_response_in_qdrant(question, answer, collection_name=CACHE_COLLECTION_NAME):
-    """質問と回答のペアをQdrantに保存する関数。AIで拡張した情報も保存。"""
+def store_response_in_qdrant(question, answer, collection_name=CACHE_COLLECTION_NAME, question_embedding=None, point_id=None):
+    """
+    質問と回答のペアをQdrantに保存する関数。AIで拡張した情報も保存。
+
+    question_embedding が渡された場合は、検索時に計算済みのベクトルを再利用する。
+    point_id が渡された場合はそのIDで保存する（呼び出し側で事前にIDを払い出す場合）。
+    """
     try:
         qdrant_client = get_qdrant_client()
 
         # AI拡張情報の取得
         enhanced_data = enhance_with_ai(question, answer)
 
-        # ベクトル生成
-        question_embedding = embedding_model.embed_query(question)
-        print(f"質問の埋め込みベクトル生成完了 (長さ: {len(question_embedding)})")
-
-        # 保存前にキャッシュ類似チェック（重複防止）
-        search_results = qdrant_client.query_points(  # ← ここを修正
-            collection_name=collection_name,
-            query=question_embedding,  # ← query_vector → query
-            limit=5,
-            with_payload=True  # ← 追加
-        )
-        
-        # 結果の取得方法も修正
-        if search_results and hasattr(search_results, 'points'):  # ← 追加
-            for result in search_results.points:  # ← search_results → search_results.points
-                if result.score >= 0.95:
-                    print(f"[INFO] 類似質問が既に存在（ID: {result.id}, Score: {result.score:.3f}）→ 保存をスキップ")
-                    return True
-
-        # 一意IDの生成
-        unique_id = str(uuid4())
-
-        # メタデータの準備
+        # 類義語の候補（CACHE_ALTERNATIVE_QUESTIONS のときだけ生成する。短すぎるものは除外）
+        alt_questions = generate_alternative_questions(question, answer) if CACHE_ALTERNATIVE_QUESTIONS else []
+        enhanced_data["alternative_questions"] = alt_questions
+        valid_alts = []
+        seen = {normalize_question(question)}
+        for i, alt_question in enumerate(alt_questions):
+            if alt_question and len(alt_question) > 5:
+                if normalize_question(alt_question) not in seen:
+                    seen.add(normalize_question(alt_question))
+                    valid_alts.append((i, alt_question))
+            else:
+                logger.debug("類義語 %d: '%s' - スキップ（短すぎ）", i + 1, alt_question)
+
+        # ベクトル生成：元の質問（計算済みでなければ）と類義語を1回のリクエストでまとめて埋め込む
+        texts = [alt for _, alt in valid_alts]
+        if question_embedding is None:
+            texts.insert(0, question)
+        vectors = embedding_cache.embed_many(texts) if texts else []
+        if question_embedding is None:
+            question_embedding = vectors.pop(0)
+        alt_embeddings = vectors
+        logger.debug("質問の埋め込みベクトル生成完了 (長さ: %d, 類義語: %d件)", len(question_embedding), len(alt_embeddings))
+
+        # IDは質問文から決定的に生成する（同じ質問を再投入しても同じ点を上書きするだけ）
+        unique_id = point_id or canonical_point_id(question)
+        # ISO形式（日時インデックスでの範囲検索・コンパクションの期限判定に使う）
+        timestamp = datetime.now().isoformat(timespec="seconds")
+        category = enhanced_data.get("category", "未分類")
+
+        # 正規の回答点（回答本文はここにだけ持つ）
         metadata = {
             "text": answer,
             "question": question,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": timestamp,
             "type": "chatbot_response",
+            "kind": "canonical",
+            "answer_id": unique_id,
             "question_summary": enhanced_data.get("question_summary", ""),
             "answer_summary": enhanced_data.get("answer_summary", ""),
             "alternative_questions": enhanced_data.get("alternative_questions", []),
             "keywords": enhanced_data.get("keywords", []),
-            "category": enhanced_data.get("category", "未分類")
+            "category": category
         }
 
-        # Qdrantにアップサート
+        points = [
+            PointStruct(
+                id=unique_id,
+                vector=question_embedding,
+                payload=metadata
+            )
+        ]
+
+        # 類義語の点は正規の回答点への参照（answer_id）だけを持つ
+        if alt_embeddings:
+            original = np.asarray(question_embedding, dtype=np.float32)
+            alts = np.asarray(alt_embeddings, dtype=np.float32)
+            similarities = (alts @ original) / (np.linalg.norm(alts, axis=1) * np.linalg.norm(original) + 1e-12)
+
+            for (i, alt_question), alt_embedding, similarity in zip(valid_alts, alt_embeddings, similarities):
+                logger.debug("類義語 %d: '%s' 元の質問との類似度: %.4f", i + 1, alt_question, similarity)
+                points.append(
+                    PointStruct(
+                        id=alternative_point_id(unique_id, alt_question),
+                        vector=alt_embedding,
+                        payload={
+                            "question": alt_question,
+                            "timestamp": timestamp,
+                            "type": "chatbot_response",
+                            "kind": "alternative",
+                            "answer_id": unique_id,
+                            "category": category
+                        }
+                    )
+                )
+
+        # Qdrantに1回のリクエストでアップサート
         qdrant_client.upsert(
             collection_name=collection_name,
-            points=[
-                PointStruct(
-                    id=unique_id,
-                    vector=question_embedding,
-                    payload=metadata
-                )
-            ]
+            points=points
         )
-        print(f"オリジナル質問ベクトルをアップサート: {unique_id}")
-
-        # 類義語の処理
-        alt_questions = enhanced_data.get("alternative_questions", [])
-        original_embedding = np.array(question_embedding).reshape(1, -1)
-
-        if alt_questions:
-            print("===== 類義語の類似度分析 =====")
-            alt_points = []
-            for i, alt_question in enumerate(alt_questions):
-                if alt_question and len(alt_question) > 5:
-                    print(f"類義語 {i+1}: '{alt_question}'")
-
-                    alt_embedding = embedding_model.embed_query(alt_question)
-                    similarity = cosine_similarity(original_embedding, [alt_embedding])[0][0]
-                    print(f"  元の質問との類似度: {similarity:.4f}")
-
-                    alt_points.append(
-                        PointStruct(
-                            id=f"{unique_id}-alt-{i}",
-                            vector=alt_embedding,
-                            payload=metadata
-                        )
-                    )
-                else:
-                    print(f"類義語 {i+1}: '{alt_question}' - スキップ（短すぎ）")
-            
-            if alt_points:
-                qdrant_client.upsert(
-                    collection_name=collection_name,
-                    points=alt_points
-                )
+        if collection_name == cache_mirror.collection_name:
+            cache_mirror.upsert(points)
+        question_answer_cache.put(question, answer, vector_id=unique_id)
 
-        print(f"拡張Q&AをIDで保存しました: {unique_id} (コレクション: {collection_name})")
+        logger.info("拡張Q&AをIDで保存しました: %s (類義語%d件, コレクション: %s)", unique_id, len(points) - 1, collection_name)
         return True
 
     except Exception as e:
-        print(f"Qdrantへの応答保存エラー: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Qdrantへの応答保存エラー: %s", e)
         return False
 
 # Pinecone互換のためのエイリアス
 store_response_in_pinecone = store_response_in_qdrant
     
 def enhance_with_ai(question: str, answer: str) -> dict:
+    """
+    キャッシュ保存用の拡張情報（要約・キーワード・カテゴリ）
+
+    ローカル辞書（enrichment）で抽出し、ENRICHMENT_LLM_FALLBACK に応じてLLMを使う:
+        off      - LLMを呼ばない
+        fallback - 辞書でカテゴリも意図も判定できなかった質問だけLLMを呼ぶ（既定）
+        always   - 毎回LLMを呼ぶ
+    言い換えの質問は拡張とは別に generate_alternative_questions で生成する。
+    """
+    local = enricher.enrich(question, answer)
+    if ENRICHMENT_LLM_FALLBACK == "off" or (ENRICHMENT_LLM_FALLBACK != "always" and enricher.is_confident(local)):
+        metrics.inc("enrichment", source="local")
+        local["timestamp"] = datetime.now().isoformat()
+        logger.debug("ローカル拡張結果: キーワード=%s カテゴリ=%s 意図=%s", local["keywords"], local["category"], local["intents"])
+        return local
+
+    metrics.inc("enrichment", source="llm")
+    return _enhance_with_llm(question, answer, local)
+
+
+def generate_alternative_questions(question: str, answer: str) -> List[str]:
+    """同じ回答で答えられる言い換えの質問をLLMで生成する（失敗した場合は空リスト）"""
+    prompt = f"""
+以下のバドミントンに関する質問と回答のペアについて、同じ回答で答えられる言い換えの質問を
+{ALTERNATIVE_QUESTION_COUNT}つまで作ってください。
+
+質問: {question}
+
+回答: {answer}
+
+出力は以下のJSON形式のみで返してください:
+{{"alternative_questions": ["言い換え1", "言い換え2"]}}
+    """
     try:
-        print("===== AI拡張処理開始 =====")
-        print(f"元の質問: {question}")
+        response = get_openai_client().chat.completions.create(
+            model=ALTERNATIVE_QUESTION_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"},
+            temperature=0.3
+        )
+        data = json.loads(response.choices[0].message.content or "{}")
+        alternatives = [str(alt).strip() for alt in data.get("alternative_questions", []) if str(alt).strip()]
+        metrics.inc("alternative_questions", len(alternatives))
+        return alternatives[:ALTERNATIVE_QUESTION_COUNT]
+    except Exception as e:
+        logger.warning("[BADMINTON] 言い換えの質問の生成に失敗: %s", e)
+        return []
+
+
+def _enhance_with_llm(question: str, answer: str, local: dict) -> dict:
+    """LLMによる拡張。失敗した場合はローカル抽出の結果を返す"""
+    try:
+        logger.debug("AI拡張処理開始: %s", question)
 
         prompt = f"""
 以下のバドミントンに関する質問と回答のペアに対して、次の拡張情報を生成してください:
@@ -614,13 +912,15 @@ def enhance_with_ai(question: str, answer: str) -> dict:
         """
 
         # LLM応答取得
-        response = enhancement_llm.invoke(prompt)
+        response = get_openai_client().chat.completions.create(
+            model="gpt-4o",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0
+        )
 
         # content 抽出
-        raw = getattr(response, "content", "").strip()
-        print("=== LLM応答（raw） ===")
-        print(raw)
-        print("======================")
+        raw = (response.choices[0].message.content or "").strip()
+        logger.debug("LLM応答（raw）: %s", raw)
 
         # コードブロック除去処理
         if raw.startswith("```json"):
@@ -633,22 +933,14 @@ def enhance_with_ai(question: str, answer: str) -> dict:
         enhanced_data = json.loads(raw)
 
         # 結果表示
-        print("===== AI拡張結果 =====")
-        print(f"  要約: {enhanced_data.get('question_summary', '')}")
-        print(f"  キーワード: {enhanced_data.get('keywords', [])}")
-        print(f"  カテゴリ: {enhanced_data.get('category', '')}")
-        print("===== AI拡張処理完了 =====")
+        logger.debug("AI拡張結果: 要約=%s キーワード=%s カテゴリ=%s", enhanced_data.get('question_summary', ''),
+                     enhanced_data.get('keywords', []), enhanced_data.get('category', ''))
 
         # タイムスタンプ付加
         enhanced_data["timestamp"] = datetime.now().isoformat()
         return enhanced_data
 
     except Exception as e:
-        print(f"[ERROR] AI拡張処理失敗: {e}")
-        return {
-            "question_summary": question[:30] + "…" if len(question) > 30 else question,
-            "answer_summary": answer[:50] + "…" if len(answer) > 50 else answer,
-            "keywords": [],
-            "category": "その他",
-            "timestamp": datetime.now().isoformat()
-        }
\ No newline at end of file
+        logger.error("[ERROR] AI拡張処理失敗: %s", e)
+        local["timestamp"] = datetime.now().isoformat()
+        return local
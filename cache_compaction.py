@@ -0,0 +1,240 @@
+"""
+badminton-cache のコンパクション（期限切れ削除と件数上限）
+
+1. 期限切れ削除: timestamp が max_age_days より古い点をバッチで削除する
+   （料金や会場など、古くなった回答が残り続けないようにする）
+2. 件数上限: 点の総数が max_points を超えた分を、最後にヒットしてから最も時間が経った
+   回答から順に、類義語の点ごと削除する（last_hit_at がなければ timestamp を使う）
+
+last_hit_at は検索経路から hit_recorder がまとめて書き込む。
+
+使い方:
+    python cache_compaction.py --create-index        # timestamp / last_hit_at の日時インデックスを作成
+    python cache_compaction.py --dry-run             # 削除対象の件数だけ表示
+    python cache_compaction.py --max-age-days 60 --max-points 3000
+
+アプリ内では CACHE_COMPACTION_ENABLED=true のとき start_compaction_scheduler() が
+CACHE_COMPACTION_INTERVAL_HOURS ごとに compact_cache() を実行する。
+"""
+import argparse
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+from qdrant_client.http import models
+
+from cache_mirror import CACHE_COLLECTION_NAME, cache_mirror
+from clients import get_qdrant_client
+from hit_recorder import LAST_HIT_FIELD, hit_recorder
+from observability import logger, metrics, span
+from question_cache import question_answer_cache
+
+load_dotenv()
+
+CACHE_MAX_AGE_DAYS = int(os.getenv("CACHE_MAX_AGE_DAYS", "90"))
+CACHE_MAX_POINTS = int(os.getenv("CACHE_MAX_POINTS", "5000"))
+CACHE_COMPACTION_INTERVAL_HOURS = float(os.getenv("CACHE_COMPACTION_INTERVAL_HOURS", "24"))
+CACHE_COMPACTION_ENABLED = os.getenv("CACHE_COMPACTION_ENABLED", "false").lower() == "true"
+
+# 日時インデックスを張るペイロードキー
+DATETIME_FIELDS = ["timestamp", LAST_HIT_FIELD]
+
+_SCAN_FIELDS = ["question", "answer_id", "kind", "timestamp", LAST_HIT_FIELD]
+
+
+def ensure_indexes(client, collection_name: str = CACHE_COLLECTION_NAME) -> None:
+    for field in DATETIME_FIELDS:
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=field,
+            field_schema=models.PayloadSchemaType.DATETIME
+        )
+        logger.info("[COMPACTION] '%s' の日時インデックスを作成しました", field)
+
+
+def _scan(client, collection_name: str, scroll_filter=None, batch_size: int = 256):
+    """条件に合う点を (id, payload) で列挙する（ベクトルは取得しない）"""
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=scroll_filter,
+            limit=batch_size,
+            offset=offset,
+            with_payload=_SCAN_FIELDS,
+            with_vectors=False
+        )
+        for record in records:
+            yield str(record.id), record.payload or {}
+        if offset is None:
+            break
+
+
+def _delete_points(client, collection_name: str, points: List[tuple], batch_size: int) -> None:
+    """点をバッチで削除し、ミラーとL1キャッシュからも取り除く"""
+    for i in range(0, len(points), batch_size):
+        batch = points[i:i + batch_size]
+        ids = [point_id for point_id, _ in batch]
+        client.delete(
+            collection_name=collection_name,
+            points_selector=models.PointIdsList(points=ids),
+            wait=True
+        )
+        if collection_name == cache_mirror.collection_name:
+            cache_mirror.delete(ids)
+        for _, payload in batch:
+            if payload.get("question"):
+                question_answer_cache.invalidate(payload["question"])
+
+
+def delete_expired(client, max_age_days: int = CACHE_MAX_AGE_DAYS, collection_name: str = CACHE_COLLECTION_NAME,
+                   dry_run: bool = False, batch_size: int = 256) -> Dict[str, Any]:
+    """timestamp が max_age_days より古い点を削除する"""
+    cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat(timespec="seconds")
+    expired_filter = models.Filter(must=[
+        models.FieldCondition(key="timestamp", range=models.DatetimeRange(lt=cutoff))
+    ])
+
+    with span("cache_expire", dry_run=dry_run) as s:
+        # 削除しながらスクロールするとページ位置がずれるため、先に対象を集める
+        points = list(_scan(client, collection_name, scroll_filter=expired_filter, batch_size=batch_size))
+        answers = {payload.get("answer_id") or point_id for point_id, payload in points}
+        s.set(points=len(points))
+        if points and not dry_run:
+            _delete_points(client, collection_name, points, batch_size)
+
+    return {"cutoff": cutoff, "points": len(points), "answers": len(answers),
+            "point_ids": [point_id for point_id, _ in points]}
+
+
+def evict_to_max(client, max_points: int = CACHE_MAX_POINTS, collection_name: str = CACHE_COLLECTION_NAME,
+                 dry_run: bool = False, batch_size: int = 256, exclude=frozenset()) -> Dict[str, Any]:
+    """
+    点の総数を max_points 以下にする
+
+    回答単位（正規の回答点＋類義語の点）で、最後にヒットした時刻が古い順に削除する。
+    answer_id を持たない旧形式の点はそれ自体を1つの回答として扱う。
+    exclude の点は削除済みとみなす（dry-run で期限切れ削除の結果を反映するため）。
+    """
+    with span("cache_evict", dry_run=dry_run) as s:
+        groups = defaultdict(list)
+        last_used = {}
+        for point_id, payload in _scan(client, collection_name, batch_size=batch_size):
+            if point_id in exclude:
+                continue
+            answer_id = payload.get("answer_id") or point_id
+            groups[answer_id].append((point_id, payload))
+            used = str(payload.get(LAST_HIT_FIELD) or payload.get("timestamp") or "")
+            if used > last_used.get(answer_id, ""):
+                last_used[answer_id] = used
+
+        total = sum(len(members) for members in groups.values())
+        excess = total - max_points
+        victims = []
+        evicted_answers = 0
+        newest_evicted = None
+        if excess > 0:
+            for answer_id in sorted(groups, key=lambda a: last_used.get(a, "")):
+                if len(victims) >= excess:
+                    break
+                victims.extend(groups[answer_id])
+                evicted_answers += 1
+                newest_evicted = last_used.get(answer_id) or None
+
+        s.set(total=total, points=len(victims))
+        if victims and not dry_run:
+            _delete_points(client, collection_name, victims, batch_size)
+
+    return {
+        "total": total,
+        "max_points": max_points,
+        "points": len(victims),
+        "answers": evicted_answers,
+        "newest_evicted": newest_evicted
+    }
+
+
+def compact_cache(client=None, max_age_days: int = CACHE_MAX_AGE_DAYS, max_points: int = CACHE_MAX_POINTS,
+                  collection_name: str = CACHE_COLLECTION_NAME, dry_run: bool = False) -> Dict[str, Any]:
+    """期限切れ削除 -> 件数上限の順に実行し、結果のレポートを返す"""
+    client = client or get_qdrant_client()
+    # 直近のヒット時刻を反映してから件数上限の判定を行う
+    hit_recorder.flush()
+
+    started_at = datetime.now().isoformat(timespec="seconds")
+    expired = delete_expired(client, max_age_days, collection_name, dry_run=dry_run)
+    expired_ids = frozenset(expired.pop("point_ids"))
+    report = {
+        "collection": collection_name,
+        "dry_run": dry_run,
+        "started_at": started_at,
+        "expired": expired,
+        "evicted": evict_to_max(client, max_points, collection_name, dry_run=dry_run,
+                                exclude=expired_ids if dry_run else frozenset())
+    }
+    if not dry_run:
+        metrics.inc("cache_compacted_points", report["expired"]["points"], reason="expired")
+        metrics.inc("cache_compacted_points", report["evicted"]["points"], reason="evicted")
+
+    logger.info("[COMPACTION] %s期限切れ %d件 / 上限超過 %d件 (総数 %d, 上限 %d)",
+                "[DRY-RUN] " if dry_run else "", report["expired"]["points"], report["evicted"]["points"],
+                report["evicted"]["total"], max_points)
+    return report
+
+
+def _scheduled_compaction() -> None:
+    try:
+        compact_cache()
+    except Exception as e:
+        logger.exception("[COMPACTION] 定期実行に失敗: %s", e)
+
+
+_scheduler = None
+
+
+def start_compaction_scheduler(interval_hours: float = CACHE_COMPACTION_INTERVAL_HOURS):
+    """APSchedulerのバックグラウンドスケジューラで compact_cache() を定期実行する"""
+    global _scheduler
+    if _scheduler is not None:
+        return _scheduler
+    try:
+        from apscheduler.schedulers.background import BackgroundScheduler
+    except ImportError:
+        logger.warning("[COMPACTION] apscheduler が未インストールのため定期実行は無効です")
+        return None
+
+    _scheduler = BackgroundScheduler(daemon=True)
+    _scheduler.add_job(_scheduled_compaction, "interval", hours=interval_hours,
+                       id="cache_compaction", max_instances=1, coalesce=True)
+    _scheduler.start()
+    logger.info("[COMPACTION] 定期実行を開始 (%s時間ごと)", interval_hours)
+    return _scheduler
+
+
+def stop_compaction_scheduler() -> None:
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler.shutdown(wait=False)
+        _scheduler = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="badminton-cache のコンパクション")
+    parser.add_argument('--create-index', action='store_true', help='timestamp / last_hit_at の日時インデックスを作成する')
+    parser.add_argument('--max-age-days', type=int, default=CACHE_MAX_AGE_DAYS, help='これより古い点を削除する（日）')
+    parser.add_argument('--max-points', type=int, default=CACHE_MAX_POINTS, help='コレクションの最大点数')
+    parser.add_argument('--dry-run', action='store_true', help='削除を行わず対象の件数だけ表示する')
+    args = parser.parse_args()
+
+    client = get_qdrant_client()
+    if args.create_index:
+        ensure_indexes(client)
+    report = compact_cache(client, args.max_age_days, args.max_points, dry_run=args.dry_run)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""
+badminton-cache コレクションのプロセス内ミラー
+
+数千件程度のFAQベクトルを正規化済みの連続した行列（float32、またはメモリ半分で検索はやや遅い float16）と
+小さなペイロード表としてメモリに保持し、類似検索を1回の行列ベクトル積で行う。
+起動時にQdrantをスクロールして読み込み、以降は書き込み経路（store_response_in_qdrant）から
+同期する。Qdrantが正本であり、ミラーが使えない間は従来どおり query_points で検索する。
+
+行列は「ベース」（一括読み込み分）と「デルタ」（起動後に追加された分）に分けて持ち、
+デルタが一定件数を超えたらベースに統合する。ベースはスナップショット（cache_snapshot.py）から
+メモリマップした読み取り専用の行列でもよい。
+"""
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from qdrant_client.http import models
+
+from observability import logger
+
+CACHE_COLLECTION_NAME = "badminton-cache"
+
+# ミラーに保持するペイロード項目（回答の選択・表示に必要なものだけ）
+MIRROR_PAYLOAD_FIELDS = ["text", "answer", "question", "question_summary", "category", "timestamp", "answer_id", "kind"]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def project_payload(payload: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    payload = payload or {}
+    return {key: payload[key] for key in MIRROR_PAYLOAD_FIELDS if key in payload}
+
+
+class VectorMirror:
+    """正規化済みベクトル行列＋ペイロード表によるローカル類似検索（コサイン類似度）"""
+
+    def __init__(self, collection_name: str = CACHE_COLLECTION_NAME, dtype: str = "float32",
+                 compact_threshold: int = 256):
+        self.collection_name = collection_name
+        self.dtype = np.dtype(dtype)
+        self.compact_threshold = compact_threshold
+
+        self._lock = threading.RLock()
+        self.dim = None
+        self.ready = False
+
+        # ベース: 一括読み込みした行列（置き換え・削除された行は _base_alive で無効化）
+        self._base = np.zeros((0, 0), dtype=self.dtype)
+        self._base_ids: List[str] = []
+        self._base_payloads: List[Dict[str, Any]] = []
+        self._base_alive = np.zeros(0, dtype=bool)
+
+        # デルタ: 読み込み後に追加された行
+        self._delta_rows: List[np.ndarray] = []
+        self._delta_ids: List[str] = []
+        self._delta_payloads: List[Dict[str, Any]] = []
+        self._delta_matrix = None
+
+        # ID -> ("base" | "delta", 行番号)
+        self._positions: Dict[str, tuple] = {}
+
+        # 内容が変わるたびに増える（スナップショットの書き出し要否の判定用）
+        self.version = 0
+
+        self.searches = 0
+        self.compactions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(self._base_alive.sum()) + len(self._delta_ids)
+
+    def _set_base(self, matrix: np.ndarray, ids: List[str], payloads) -> None:
+        """ベース行列を差し替え、デルタを空にする（ロック取得済みで呼ぶ）"""
+        self._base = matrix
+        self._base_ids = ids
+        self._base_payloads = payloads
+        self._base_alive = np.ones(len(ids), dtype=bool)
+        self._delta_rows, self._delta_ids, self._delta_payloads = [], [], []
+        self._delta_matrix = None
+        self._positions = {point_id: ("base", row) for row, point_id in enumerate(ids)}
+        if len(ids):
+            self.dim = matrix.shape[1]
+
+    def replace_all(self, ids: List[str], vectors, payloads: List[Dict[str, Any]]) -> None:
+        """ミラー全体を差し替える"""
+        matrix = _normalize(vectors).astype(self.dtype, copy=False) if len(ids) else np.zeros((0, 0), self.dtype)
+        with self._lock:
+            self._set_base(matrix, [str(point_id) for point_id in ids], list(payloads))
+            self.version += 1
+
+    def adopt_base(self, matrix: np.ndarray, ids: List[str], payloads, version: Optional[int] = None) -> bool:
+        """
+        正規化済みの行列（メモリマップ可）をそのままベースにする
+
+        version を指定した場合、ミラーがその版から変更されていなければ差し替える
+        （スナップショットの書き出し中に更新があった場合は何もせず False）。
+        """
+        with self._lock:
+            if version is not None and version != self.version:
+                return False
+            if matrix.dtype != self.dtype:
+                logger.warning("[MIRROR] 行列の型 %s がミラーの型 %s と異なります", matrix.dtype, self.dtype)
+                self.dtype = matrix.dtype
+            self._set_base(matrix, list(ids), payloads)
+            if version is None:
+                self.version += 1
+            return True
+
+    def export(self):
+        """有効な全行を (版, ID一覧, 行列, ペイロード一覧) で返す（スナップショット書き出し用）"""
+        with self._lock:
+            alive = np.flatnonzero(self._base_alive)
+            ids = [self._base_ids[row] for row in alive] + list(self._delta_ids)
+            payloads = [self._base_payloads[row] for row in alive] + list(self._delta_payloads)
+            blocks = [np.asarray(self._base[alive])]
+            if self._delta_rows:
+                blocks.append(np.vstack(self._delta_rows))
+            matrix = np.vstack(blocks).astype(self.dtype, copy=False) if ids else np.zeros((0, self.dim or 0), self.dtype)
+            return self.version, ids, matrix, payloads
+
+    def watermark(self) -> Optional[str]:
+        """保持している点の timestamp の最大値（これより新しい点だけを追加取得すればよい）"""
+        with self._lock:
+            alive = np.flatnonzero(self._base_alive)
+            timestamps = [self._base_payloads[row].get("timestamp") for row in alive]
+            timestamps += [payload.get("timestamp") for payload in self._delta_payloads]
+        timestamps = [str(ts) for ts in timestamps if ts]
+        return max(timestamps) if timestamps else None
+
+    def load_from_qdrant(self, client, batch_size: int = 256) -> int:
+        """コレクションをスクロールしてミラーを構築する。読み込んだ件数を返す"""
+        info = client.get_collection(self.collection_name)
+        distance = getattr(info.config.params.vectors, "distance", None)
+        if distance is not None and distance != models.Distance.COSINE:
+            logger.warning("[MIRROR] 距離関数が %s のためミラーを無効化します（コサインのみ対応）", distance)
+            self.ready = False
+            return 0
+
+        ids, vectors, payloads = [], [], []
+        offset = None
+        while True:
+            records, offset = client.scroll(
+                collection_name=self.collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=MIRROR_PAYLOAD_FIELDS,
+                with_vectors=True
+            )
+            for record in records:
+                if not record.vector:
+                    continue
+                ids.append(str(record.id))
+                vectors.append(record.vector)
+                payloads.append(project_payload(record.payload))
+            if offset is None:
+                break
+
+        self.replace_all(ids, vectors, payloads)
+        self.ready = True
+        logger.info("[MIRROR] %s を読み込みました: %d件 (%s)", self.collection_name, len(ids), self.dtype.name)
+        return len(ids)
+
+    def _unchanged(self, position: tuple, vector: np.ndarray, payload: Dict[str, Any]) -> bool:
+        """既存の行とベクトル・ペイロードが同じか（ロック取得済みで呼ぶ）"""
+        if position[0] == "base":
+            row, current = self._base[position[1]], self._base_payloads[position[1]]
+        else:
+            row, current = self._delta_rows[position[1]], self._delta_payloads[position[1]]
+        return current == payload and np.array_equal(row, vector)
+
+    def upsert(self, points) -> int:
+        """
+        書き込み経路から呼ばれ、PointStruct のリストをミラーに反映する
+
+        ベクトルもペイロードも変わらない点は何もしない（version も増やさない）。反映した件数を返す。
+        """
+        applied = 0
+        with self._lock:
+            for point in points:
+                point_id = str(point.id)
+                vector = _normalize(point.vector).astype(self.dtype, copy=False)
+                if self.dim is None:
+                    self.dim = vector.shape[0]
+                elif vector.shape[0] != self.dim:
+                    logger.warning("[MIRROR] 次元数が一致しないため無視します: %s", point_id)
+                    continue
+
+                payload = project_payload(point.payload)
+                position = self._positions.get(point_id)
+                if position is not None and self._unchanged(position, vector, payload):
+                    continue
+                if position is not None and position[0] == "delta":
+                    self._delta_rows[position[1]] = vector
+                    self._delta_payloads[position[1]] = payload
+                else:
+                    if position is not None:
+                        self._base_alive[position[1]] = False
+                    self._positions[point_id] = ("delta", len(self._delta_ids))
+                    self._delta_rows.append(vector)
+                    self._delta_ids.append(point_id)
+                    self._delta_payloads.append(payload)
+                self._delta_matrix = None
+                self.version += 1
+                applied += 1
+
+            if len(self._delta_ids) >= self.compact_threshold:
+                self.compact()
+        return applied
+
+    def ids(self) -> set:
+        """保持している点IDの集合"""
+        with self._lock:
+            return set(self._positions)
+
+    def delete(self, point_ids) -> List[Dict[str, Any]]:
+        """点を取り除き、取り除いた点のペイロードを返す"""
+        removed = []
+        with self._lock:
+            for point_id in point_ids:
+                payload = self._payload_of(str(point_id))
+                position = self._positions.pop(str(point_id), None)
+                if position is None:
+                    continue
+                removed.append(payload)
+                self.version += 1
+                if position[0] == "base":
+                    self._base_alive[position[1]] = False
+                else:
+                    # デルタは件数が少ないので統合して作り直す
+                    self._positions[str(point_id)] = position
+                    self.compact(exclude={str(point_id)})
+        return removed
+
+    def compact(self, exclude=frozenset()) -> None:
+        """有効なベース行とデルタ行を1つのベース行列にまとめる"""
+        with self._lock:
+            ids, rows, payloads = [], [], []
+            for row in np.flatnonzero(self._base_alive):
+                if self._base_ids[row] not in exclude:
+                    ids.append(self._base_ids[row])
+                    rows.append(self._base[row])
+                    payloads.append(self._base_payloads[row])
+            for point_id, vector, payload in zip(self._delta_ids, self._delta_rows, self._delta_payloads):
+                if point_id not in exclude:
+                    ids.append(point_id)
+                    rows.append(vector)
+                    payloads.append(payload)
+
+            matrix = np.vstack(rows).astype(self.dtype, copy=False) if rows else np.zeros((0, 0), self.dtype)
+            self._set_base(matrix, ids, payloads)
+            self.compactions += 1
+
+    def _scores(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """ベース＋デルタ全行のコサイン類似度（無効な行は -inf）。ロック取得済みで呼ぶ"""
+        if self.dim is None or query.shape[0] != self.dim:
+            return None
+
+        scores = []
+        if len(self._base_ids):
+            # float16 の行列も float32 で計算する（float16同士の積はBLASが使えず遅い）
+            base_scores = self._base @ query
+            scores.append(np.where(self._base_alive, base_scores, -np.inf).astype(np.float32, copy=False))
+        if self._delta_ids:
+            if self._delta_matrix is None:
+                self._delta_matrix = np.vstack(self._delta_rows)
+            scores.append((self._delta_matrix @ query).astype(np.float32, copy=False))
+        return np.concatenate(scores) if scores else None
+
+    def _point_at(self, index: int):
+        base_count = len(self._base_ids)
+        if index < base_count:
+            return self._base_ids[index], self._base_payloads[index]
+        return self._delta_ids[index - base_count], self._delta_payloads[index - base_count]
+
+    def _payload_of(self, point_id: str) -> Optional[Dict[str, Any]]:
+        position = self._positions.get(point_id)
+        if position is None:
+            return None
+        if position[0] == "base":
+            return self._base_payloads[position[1]]
+        return self._delta_payloads[position[1]]
+
+    def search(self, vector, limit: int = 10, score_threshold: float = 0.0) -> List[models.ScoredPoint]:
+        """コサイン類似度の上位 limit 件を ScoredPoint のリストで返す"""
+        query = _normalize(vector)
+        with self._lock:
+            self.searches += 1
+            scores = self._scores(query)
+            if scores is None:
+                return []
+
+            k = min(limit, scores.shape[0])
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+
+            results = []
+            for index in top:
+                score = float(scores[index])
+                if score < score_threshold:
+                    break
+                point_id, payload = self._point_at(index)
+                results.append(models.ScoredPoint(id=point_id, version=0, score=score, payload=payload))
+            return results
+
+    def search_groups(self, vector, group_by: str, limit: int = 5, group_size: int = 1,
+                      score_threshold: float = 0.0, with_lookup: bool = False) -> List[models.PointGroup]:
+        """
+        group_by のペイロード値ごとに上位 group_size 件をまとめ、上位 limit グループを返す
+
+        group_by の値を持たない点（旧形式）は、Qdrantの query_points_groups と同じく結果に含めない
+        （migrate_cache_layout.py で移行するまで検索に出てこない）。
+        with_lookup の場合、グループIDと同じIDの点のペイロードを lookup に入れる。
+        """
+        query = _normalize(vector)
+        with self._lock:
+            self.searches += 1
+            scores = self._scores(query)
+            if scores is None:
+                return []
+
+            candidates = np.flatnonzero(scores >= score_threshold)
+            order = candidates[np.argsort(-scores[candidates])]
+
+            groups: Dict[str, List[models.ScoredPoint]] = {}
+            for index in order:
+                point_id, payload = self._point_at(index)
+                key = payload.get(group_by)
+                if not key:
+                    continue
+                key = str(key)
+                hits = groups.get(key)
+                if hits is None:
+                    if len(groups) >= limit:
+                        if all(len(h) >= group_size for h in groups.values()):
+                            break
+                        continue
+                    hits = groups[key] = []
+                if len(hits) < group_size:
+                    hits.append(models.ScoredPoint(id=point_id, version=0, score=float(scores[index]), payload=payload))
+
+            results = []
+            for key, hits in groups.items():
+                lookup = None
+                if with_lookup:
+                    payload = self._payload_of(key)
+                    if payload is not None:
+                        lookup = models.Record(id=key, payload=payload)
+                results.append(models.PointGroup(id=key, hits=hits, lookup=lookup))
+            return results
+
+    def query_points(self, query, limit: int = 10, score_threshold: float = 0.0, **kwargs) -> models.QueryResponse:
+        """QdrantClient.query_points と同じ形の結果を返す（呼び出し側の差し替え用）"""
+        return models.QueryResponse(points=self.search(query, limit=limit, score_threshold=score_threshold or 0.0))
+
+    def query_points_groups(self, query, group_by: str, limit: int = 5, group_size: int = 1,
+                            score_threshold: float = 0.0, with_lookup=None, **kwargs) -> models.GroupsResult:
+        """QdrantClient.query_points_groups と同じ形の結果を返す"""
+        return models.GroupsResult(groups=self.search_groups(
+            query, group_by, limit=limit, group_size=group_size,
+            score_threshold=score_threshold or 0.0, with_lookup=with_lookup is not None
+        ))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "points": int(self._base_alive.sum()) + len(self._delta_ids),
+                "base_rows": len(self._base_ids),
+                "delta_rows": len(self._delta_ids),
+                "searches": self.searches,
+                "compactions": self.compactions,
+                "base_mapped": isinstance(self._base, np.memmap),
+                "matrix_bytes": int(self._base.nbytes) + sum(int(row.nbytes) for row in self._delta_rows)
+            }
+
+
+cache_mirror = VectorMirror(
+    dtype=os.getenv("CACHE_MIRROR_DTYPE", "float32"),
+    compact_threshold=int(os.getenv("CACHE_MIRROR_COMPACT_THRESHOLD", "256"))
+)
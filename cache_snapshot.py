@@ -0,0 +1,368 @@
+"""
+キャッシュミラーのディスクスナップショット
+
+起動のたびにQdrantからコレクション全体をスクロールし直さないよう、ミラーの内容を
+次の形式で書き出し、起動時にメモリマップで読み込む。
+
+    <CACHE_SNAPSHOT_DIR>/
+        CURRENT                 現在の世代ディレクトリ名
+        <世代>/manifest.json     件数・次元・型・ウォーターマーク（最新の timestamp）
+        <世代>/vectors.npy       正規化済みベクトル行列（np.load(mmap_mode="r") で共有マップ）
+        <世代>/ids.json          行番号 -> 点ID
+        <世代>/payloads.jsonl    ペイロード（1行1件）
+        <世代>/payload_offsets.npy  各ペイロードの開始バイト位置（件数+1個）
+
+読み込み後はウォーターマーク以降に書き込まれた点だけをQdrantから取得して反映し、
+コンパクション・期限切れで削除された点はQdrantの点IDと突き合わせて（reconcile）取り除く。
+起動後も MirrorSync が定期的に同じ処理を行い、他のワーカーやコンパクションの変更を反映する。
+同じホストの複数ワーカープロセスは同じファイルをマップするため、ページキャッシュを共有できる。
+書き出しはファイルロックを取れた1プロセスだけが行い、世代ディレクトリを作ってから
+CURRENT を差し替えるので、読み込み中のプロセスが壊れたファイルを見ることはない。
+"""
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+import numpy as np
+from qdrant_client.http import models
+
+from cache_mirror import MIRROR_PAYLOAD_FIELDS, VectorMirror, project_payload, cache_mirror
+from observability import logger
+from question_cache import question_answer_cache
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+# 世代ディレクトリを何世代残すか（古い世代をマップ中のプロセスのため）
+KEEP_GENERATIONS = 2
+
+
+class PayloadFile:
+    """オフセット索引付きのペイロードファイル（行番号でランダムアクセス、読み込み時だけJSONを解析）"""
+
+    def __init__(self, path: str, offsets: np.ndarray):
+        self.path = path
+        self.offsets = offsets
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return json.loads(self._data[start:end])
+
+
+def _current_generation(directory: str) -> Optional[str]:
+    try:
+        with open(os.path.join(directory, "CURRENT"), encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(directory, name) if name else None
+
+
+def read_manifest(directory: str) -> Optional[Dict[str, Any]]:
+    generation = _current_generation(directory)
+    if generation is None:
+        return None
+    try:
+        with open(os.path.join(generation, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    manifest["path"] = generation
+    return manifest
+
+
+def save_snapshot(mirror: VectorMirror, directory: str) -> Optional[Dict[str, Any]]:
+    """
+    ミラーの内容を新しい世代として書き出す
+
+    他のプロセスが書き出し中（ロック取得不可）の場合は何もせず None を返す。
+    書き出し後、その間にミラーが更新されていなければ書き出したファイルをマップし直し、
+    このプロセスのベース行列も共有ページに切り替える。
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug("[SNAPSHOT] 他のプロセスが書き出し中のためスキップ")
+            return None
+
+        version, ids, matrix, payloads = mirror.export()
+        name = f"gen-{int(time.time() * 1000)}-{os.getpid()}"
+        path = os.path.join(directory, name)
+        os.makedirs(path)
+
+        np.save(os.path.join(path, "vectors.npy"), matrix)
+        with open(os.path.join(path, "ids.json"), "w", encoding="utf-8") as f:
+            json.dump(ids, f)
+
+        offsets = [0]
+        with open(os.path.join(path, "payloads.jsonl"), "wb") as f:
+            for payload in payloads:
+                line = json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n"
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.save(os.path.join(path, "payload_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+        timestamps = [str(p.get("timestamp")) for p in payloads if p.get("timestamp")]
+        manifest = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "collection": mirror.collection_name,
+            "count": len(ids),
+            "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            "dtype": matrix.dtype.name,
+            "watermark": max(timestamps) if timestamps else None,
+            "created_at": datetime.now().isoformat()
+        }
+        with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+        # CURRENT をアトミックに差し替える
+        pointer = os.path.join(directory, "CURRENT.tmp")
+        with open(pointer, "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(pointer, os.path.join(directory, "CURRENT"))
+
+        generations = sorted(d for d in os.listdir(directory) if d.startswith("gen-"))
+        for old in generations[:-KEEP_GENERATIONS]:
+            shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+
+    manifest["path"] = path
+    logger.info("[SNAPSHOT] 書き出し完了: %d件 (watermark=%s)", manifest["count"], manifest["watermark"])
+    _map_into(mirror, manifest, version=version)
+    return manifest
+
+
+def _map_into(mirror: VectorMirror, manifest: Dict[str, Any], version: Optional[int] = None) -> bool:
+    path = manifest["path"]
+    matrix = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    with open(os.path.join(path, "ids.json"), encoding="utf-8") as f:
+        ids = json.load(f)
+    offsets = np.load(os.path.join(path, "payload_offsets.npy"))
+    payloads = PayloadFile(os.path.join(path, "payloads.jsonl"), offsets)
+    if not (len(ids) == len(payloads) == matrix.shape[0]):
+        raise ValueError(f"スナップショットの件数が一致しません: {path}")
+    return mirror.adopt_base(matrix, ids, payloads, version=version)
+
+
+def load_snapshot(mirror: VectorMirror, directory: str, max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """現在の世代をマップしてミラーのベースにする。使えるスナップショットがなければ None"""
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION or manifest.get("collection") != mirror.collection_name:
+        logger.warning("[SNAPSHOT] 形式またはコレクションが異なるため使用しません: %s", manifest["path"])
+        return None
+    if max_age is not None:
+        age = (datetime.now() - datetime.fromisoformat(manifest["created_at"])).total_seconds()
+        if age > max_age:
+            logger.info("[SNAPSHOT] スナップショットが古いため使用しません (%.0f秒経過)", age)
+            return None
+
+    _map_into(mirror, manifest)
+    logger.info("[SNAPSHOT] 読み込み完了: %d件 (watermark=%s)", manifest["count"], manifest["watermark"])
+    return manifest
+
+
+def catch_up(mirror: VectorMirror, client, watermark: Optional[str], batch_size: int = 256) -> int:
+    """ウォーターマーク以降に書き込まれた点だけをQdrantから取得してミラーに反映する（変更のあった件数を返す）"""
+    scroll_filter = None
+    if watermark:
+        scroll_filter = models.Filter(must=[
+            models.FieldCondition(key="timestamp", range=models.DatetimeRange(gte=watermark))
+        ])
+
+    applied = 0
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=mirror.collection_name,
+            scroll_filter=scroll_filter,
+            limit=batch_size,
+            offset=offset,
+            with_payload=MIRROR_PAYLOAD_FIELDS,
+            with_vectors=True
+        )
+        points = [
+            models.PointStruct(id=record.id, vector=record.vector, payload=project_payload(record.payload))
+            for record in records if record.vector
+        ]
+        if points:
+            # ウォーターマークと同時刻の点は毎回取り直すが、変わっていなければ反映されない
+            applied += mirror.upsert(points)
+        if offset is None:
+            break
+    return applied
+
+
+def reconcile(mirror: VectorMirror, client, batch_size: int = 1024) -> int:
+    """
+    Qdrantから削除された点をミラーから取り除く（削除した件数を返す）
+
+    点IDだけをスクロールして突き合わせる。スクロール中に書き込まれた点を誤って消さないよう、
+    スクロール開始前からミラーにあった点だけを対象にする。
+    """
+    candidates = mirror.ids()
+    if not candidates:
+        return 0
+
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=mirror.collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False
+        )
+        candidates.difference_update(str(record.id) for record in records)
+        if offset is None:
+            break
+
+    if candidates:
+        for payload in mirror.delete(candidates):
+            if payload and payload.get("question"):
+                question_answer_cache.invalidate(payload["question"])
+        logger.info("[SNAPSHOT] Qdrantで削除済みの点をミラーから除きました: %d件", len(candidates))
+    return len(candidates)
+
+
+def warm_cache_mirror(client, mirror: VectorMirror = cache_mirror, directory: Optional[str] = None,
+                      max_age: Optional[float] = None) -> int:
+    """
+    起動時のミラー構築
+
+    スナップショットがあればマップして差分だけ取得し、なければコレクション全体を
+    スクロールして読み込んだ後にスナップショットを書き出す。ミラーの件数を返す。
+    """
+    directory = directory or CACHE_SNAPSHOT_DIR
+    try:
+        manifest = load_snapshot(mirror, directory, max_age=max_age)
+    except Exception as e:
+        logger.warning("[SNAPSHOT] 読み込み失敗: %s", e)
+        manifest = None
+
+    if manifest is not None:
+        applied = catch_up(mirror, client, manifest.get("watermark"))
+        removed = reconcile(mirror, client)
+        mirror.ready = True
+        logger.info("[SNAPSHOT] 差分を反映: 追加・更新 %d件 / 削除 %d件", applied, removed)
+        if applied or removed:
+            try:
+                save_snapshot(mirror, directory)
+            except Exception as e:
+                logger.warning("[SNAPSHOT] 書き出し失敗: %s", e)
+        return len(mirror)
+
+    count = mirror.load_from_qdrant(client)
+    if mirror.ready:
+        try:
+            save_snapshot(mirror, directory)
+        except Exception as e:
+            logger.warning("[SNAPSHOT] 書き出し失敗: %s", e)
+    return count
+
+
+class SnapshotWriter:
+    """ミラーに変更があれば interval 秒ごとにスナップショットを書き出すバックグラウンドスレッド"""
+
+    def __init__(self, mirror: VectorMirror, directory: str, interval: float = 600):
+        self.mirror = mirror
+        self.directory = directory
+        self.interval = interval
+        self._saved_version = mirror.version
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._saved_version = self.mirror.version
+            self._thread = threading.Thread(target=self._run, name="cache-snapshot", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.save_if_changed()
+
+    def save_if_changed(self) -> bool:
+        if not self.mirror.ready or self.mirror.version == self._saved_version:
+            return False
+        try:
+            version = self.mirror.version
+            if save_snapshot(self.mirror, self.directory) is not None:
+                self._saved_version = version
+                return True
+        except Exception as e:
+            logger.warning("[SNAPSHOT] 書き出し失敗: %s", e)
+        return False
+
+    def stop(self, flush: bool = True) -> None:
+        self._stop.set()
+        if flush:
+            self.save_if_changed()
+
+
+class MirrorSync:
+    """
+    interval 秒ごとに他のプロセスによる変更をミラーへ反映するバックグラウンドスレッド
+
+    ウォーターマーク以降の点を取り込み（catch_up）、Qdrantから消えた点を取り除く（reconcile）。
+    他のワーカーの書き込みや、コンパクション・期限切れによる削除を、ミラーを作り直さずに反映する。
+    """
+
+    def __init__(self, mirror: VectorMirror, interval: float = 300):
+        self.mirror = mirror
+        self.interval = interval
+        self._client = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, client) -> None:
+        self._client = client
+        if self.interval > 0 and (self._thread is None or not self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name="cache-mirror-sync", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sync()
+
+    def sync(self) -> Optional[Dict[str, int]]:
+        if not self.mirror.ready or self._client is None:
+            return None
+        try:
+            applied = catch_up(self.mirror, self._client, self.mirror.watermark())
+            removed = reconcile(self.mirror, self._client)
+        except Exception as e:
+            logger.warning("[SNAPSHOT] ミラーの同期に失敗: %s", e)
+            return None
+        logger.debug("[SNAPSHOT] ミラーを同期: 追加・更新 %d件 / 削除 %d件", applied, removed)
+        return {"applied": applied, "removed": removed}
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+CACHE_SNAPSHOT_DIR = os.getenv("CACHE_SNAPSHOT_DIR", "cache_snapshot")
+
+snapshot_writer = SnapshotWriter(
+    cache_mirror,
+    CACHE_SNAPSHOT_DIR,
+    interval=float(os.getenv("CACHE_SNAPSHOT_INTERVAL", "600"))
+)
+
+mirror_sync = MirrorSync(
+    cache_mirror,
+    interval=float(os.getenv("CACHE_MIRROR_SYNC_INTERVAL", "300"))
+)
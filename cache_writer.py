@@ -0,0 +1,185 @@
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from badminton_utils import store_response_in_pinecone_badminton
+from observability import logger, metrics, span
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class _WriteJob:
+    __slots__ = ("kwargs", "enqueued_at", "attempts")
+
+    def __init__(self, kwargs: Dict[str, Any]):
+        self.kwargs = kwargs
+        self.enqueued_at = time.time()
+        self.attempts = 0
+
+
+class CacheWriteQueue:
+    """
+    キャッシュ書き込みのライトビハインドキュー
+
+    回答生成後のQdrant保存（AI拡張・埋め込み・upsert）をバックグラウンドの
+    ワーカースレッドで実行し、ユーザーへの応答をブロックしない。
+    """
+
+    def __init__(self, write_fn: Callable[..., bool], maxsize: int = 100, max_retries: int = 3,
+                 retry_backoff: float = 1.0, drop_policy: str = DROP_OLDEST):
+        """
+        Args:
+            write_fn: 1件を書き込む関数（成功時True）
+            maxsize: キューの最大長
+            max_retries: 失敗時の最大リトライ回数
+            retry_backoff: リトライ間隔の基準秒数（指数バックオフ）
+            drop_policy: キューが満杯のときの方針（drop_oldest / drop_newest）
+        """
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"不明なdrop_policy: {drop_policy}")
+
+        self.write_fn = write_fn
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.drop_policy = drop_policy
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._worker = None
+        self._lock = threading.Lock()
+        self._accepting = True
+        self._current_job = None
+
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name="cache-writer", daemon=True)
+            self._worker.start()
+            logger.info("[CACHE_WRITER] ワーカー起動")
+
+    def submit(self, **kwargs) -> bool:
+        """書き込みジョブを投入する。受け付けられなかった場合はFalse"""
+        if not self._accepting:
+            logger.warning("[CACHE_WRITER] シャットダウン中のため投入を拒否")
+            self.dropped += 1
+            return False
+
+        self.start()
+        job = _WriteJob(kwargs)
+
+        while True:
+            try:
+                self._queue.put_nowait(job)
+                self.enqueued += 1
+                return True
+            except queue.Full:
+                if self.drop_policy == DROP_NEWEST:
+                    self.dropped += 1
+                    logger.warning("[CACHE_WRITER] キュー満杯 → 新規ジョブを破棄")
+                    return False
+
+                # drop_oldest: 最も古い未処理ジョブを捨てて空きを作る
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self.dropped += 1
+                    logger.warning("[CACHE_WRITER] キュー満杯 → 最古のジョブを破棄")
+                except queue.Empty:
+                    pass
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                self._current_job = job
+                self._process(job)
+            finally:
+                self._current_job = None
+                self._queue.task_done()
+
+    def _process(self, job: _WriteJob) -> None:
+        lag = time.time() - job.enqueued_at
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        metrics.observe("cache_write_lag", lag)
+
+        while True:
+            job.attempts += 1
+            try:
+                with span("cache_write", attempt=job.attempts):
+                    written = self.write_fn(**job.kwargs)
+                if written:
+                    self.written += 1
+                    return
+                error = "write_fnがFalseを返しました"
+            except Exception as e:
+                error = str(e)
+
+            if job.attempts > self.max_retries:
+                self.failed += 1
+                logger.error("[CACHE_WRITER] 書き込み失敗（%d回試行）: %s", job.attempts, error)
+                return
+
+            self.retried += 1
+            wait = self.retry_backoff * (2 ** (job.attempts - 1))
+            logger.warning("[CACHE_WRITER] 書き込み失敗、%.1f秒後にリトライ: %s", wait, error)
+            time.sleep(wait)
+
+    def drain(self, timeout: Optional[float] = 30.0) -> bool:
+        """新規投入を止め、キューに残ったジョブを書き終えるまで待つ。時間内に終わればTrue"""
+        self._accepting = False
+        if self._worker is None or not self._worker.is_alive():
+            return self._queue.unfinished_tasks == 0
+
+        logger.info("[CACHE_WRITER] 残りジョブを書き込み中... (残り%d件)", self._queue.qsize())
+        deadline = None if timeout is None else time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    logger.warning("[CACHE_WRITER] ドレインがタイムアウト (未処理%d件)", self._queue.unfinished_tasks)
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+
+        logger.info("[CACHE_WRITER] ドレイン完了")
+        return True
+
+    def metrics(self) -> Dict[str, Any]:
+        current = self._current_job
+        oldest_age = time.time() - current.enqueued_at if current else 0.0
+        with self._queue.mutex:
+            if self._queue.queue:
+                oldest_age = max(oldest_age, time.time() - self._queue.queue[0].enqueued_at)
+
+        return {
+            "depth": self._queue.qsize(),
+            "maxsize": self._queue.maxsize,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retried": self.retried,
+            "last_lag_seconds": self.last_lag,
+            "max_lag_seconds": self.max_lag,
+            "oldest_pending_seconds": oldest_age
+        }
+
+
+cache_write_queue = CacheWriteQueue(
+    store_response_in_pinecone_badminton,
+    maxsize=int(os.getenv("CACHE_WRITE_QUEUE_SIZE", "100")),
+    max_retries=int(os.getenv("CACHE_WRITE_MAX_RETRIES", "3")),
+    retry_backoff=float(os.getenv("CACHE_WRITE_RETRY_BACKOFF", "1.0")),
+    drop_policy=os.getenv("CACHE_WRITE_DROP_POLICY", DROP_OLDEST)
+)
@@ -0,0 +1,137 @@
+"""
+外部サービスのクライアントレジストリ
+
+Qdrant・OpenAI・DynamoDBのクライアントを初回利用時に一度だけ生成し、プロセス全体で
+使い回す。各呼び出し箇所はここからクライアントを取得するため、リクエストごとの
+TLSハンドシェイクや接続確立が発生しない。
+"""
+import os
+import threading
+
+import boto3
+import httpx
+from botocore.config import Config
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+from qdrant_client import AsyncQdrantClient, QdrantClient
+
+from observability import logger
+
+load_dotenv()
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _env_flag(name: str, default: str = "false") -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+def _http_limits() -> httpx.Limits:
+    """keep-aliveを有効にしたHTTPコネクションプール設定"""
+    max_connections = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", str(max_connections))),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+    )
+
+
+def _openai_timeout() -> httpx.Timeout:
+    """OpenAI呼び出しのタイムアウト（接続は短く、ストリーミングの読み取りは長めに待つ）"""
+    return httpx.Timeout(
+        float(os.getenv("OPENAI_TIMEOUT", "60")),
+        connect=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "3"))
+    )
+
+
+def _qdrant_timeout() -> int:
+    return int(os.getenv("QDRANT_TIMEOUT", "5"))
+
+
+def _get_or_create(name: str, factory):
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            client = factory()
+            _clients[name] = client
+            logger.info("[CLIENTS] クライアント初期化: %s", name)
+    return client
+
+
+def get_openai_client() -> OpenAI:
+    """共有のOpenAIクライアント（keep-alive付きHTTPプール）"""
+    return _get_or_create("openai", lambda: OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.Client(limits=_http_limits()),
+        timeout=_openai_timeout(),
+        max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+    ))
+
+
+def get_qdrant_client() -> QdrantClient:
+    """共有のQdrantクライアント（QDRANT_PREFER_GRPC=true でgRPC接続）"""
+    return _get_or_create("qdrant", lambda: QdrantClient(
+        url=os.getenv("QDRANT_URL"),
+        api_key=os.getenv("QDRANT_API_KEY"),
+        prefer_grpc=_env_flag("QDRANT_PREFER_GRPC"),
+        limits=_http_limits(),
+        timeout=_qdrant_timeout()
+    ))
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """共有の非同期OpenAIクライアント（async版パイプライン用）"""
+    return _get_or_create("async_openai", lambda: AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.AsyncClient(limits=_http_limits()),
+        timeout=_openai_timeout(),
+        max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+    ))
+
+
+def get_async_qdrant_client() -> AsyncQdrantClient:
+    """共有の非同期Qdrantクライアント（async版パイプライン用）"""
+    return _get_or_create("async_qdrant", lambda: AsyncQdrantClient(
+        url=os.getenv("QDRANT_URL"),
+        api_key=os.getenv("QDRANT_API_KEY"),
+        prefer_grpc=_env_flag("QDRANT_PREFER_GRPC"),
+        limits=_http_limits(),
+        timeout=_qdrant_timeout()
+    ))
+
+
+def get_dynamodb_resource():
+    """共有のDynamoDBリソース（botocoreの接続プールサイズ・タイムアウトを調整済み）"""
+    return _get_or_create("dynamodb", lambda: boto3.resource(
+        "dynamodb",
+        region_name=os.getenv("AWS_REGION", "ap-northeast-1"),
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        config=Config(
+            max_pool_connections=int(os.getenv("DYNAMODB_MAX_POOL_CONNECTIONS", "25")),
+            tcp_keepalive=True,
+            connect_timeout=float(os.getenv("DYNAMODB_CONNECT_TIMEOUT", "2")),
+            read_timeout=float(os.getenv("DYNAMODB_READ_TIMEOUT", "5")),
+            retries={"max_attempts": 3, "mode": "adaptive"}
+        )
+    ))
+
+
+def close_clients() -> None:
+    """生成済みの同期クライアントの接続を閉じる（終了処理用）"""
+    with _lock:
+        for name, client in list(_clients.items()):
+            if name.startswith("async_"):
+                # 非同期クライアントはイベントループと一緒に破棄される
+                continue
+            close = getattr(client, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception as e:
+                    logger.warning("[CLIENTS] クライアントのクローズ失敗 (%s): %s", name, e)
+        _clients.clear()
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from observability import logger, metrics
+from question_cache import normalize_question
+
+# リーダーの生成が回答なしで終わった場合にフォロワーへ返す文
+ABANDONED_MESSAGE = "申し訳ございません、回答の生成が中断されました。もう一度お試しください。"
+
+
+class Flight:
+    """
+    生成中の1件の回答（リーダーが書き込み、フォロワーが読む）
+
+    リーダーは publish() で生成途中の回答全文を更新し、finish() で確定する。
+    フォロワーは follow() / follow_async() で更新のたびに回答全文を受け取る。
+    """
+
+    def __init__(self, key: str, vector: Optional[np.ndarray]):
+        self.key = key
+        self.vector = vector
+        self.text = ""
+        self.done = False
+        self.shareable = True
+        self.finished_at = None
+        self.followers = 0
+
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def _notify_locked(self) -> None:
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def publish(self, text: str) -> None:
+        with self._cond:
+            self.text = text
+            self._notify_locked()
+
+    def finish(self, text: Optional[str] = None, shareable: bool = True) -> None:
+        """
+        回答を確定する
+
+        shareable=False（エラー・混雑時の定型文や中断）の場合、待っているフォロワーには
+        返すが、完了後に参加したリクエストとは共有しない。
+        """
+        with self._cond:
+            if self.done:
+                return
+            if text is not None:
+                self.text = text
+            self.shareable = shareable
+            if not self.text:
+                self.text = ABANDONED_MESSAGE
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._notify_locked()
+
+    def follow(self, timeout: float):
+        """回答全文を更新のたびに yield する（完了まで）。timeout 秒で完了しなければ TimeoutError"""
+        deadline = time.monotonic() + timeout
+        last = ""
+        while True:
+            with self._cond:
+                while self.text == last and not self.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("同じ質問の回答生成を待機中にタイムアウトしました")
+                    self._cond.wait(remaining)
+                text, done = self.text, self.done
+            if text != last:
+                last = text
+                yield text
+            if done:
+                return
+
+    async def follow_async(self, timeout: float):
+        """follow の非同期版"""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._cond:
+            self._async_waiters.append((loop, event))
+        try:
+            deadline = loop.time() + timeout
+            last = ""
+            while True:
+                # 読み取り前にクリアし、読み取り後の更新を取りこぼさない
+                event.clear()
+                with self._cond:
+                    text, done = self.text, self.done
+                if text != last:
+                    last = text
+                    yield text
+                if done:
+                    return
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError("同じ質問の回答生成を待機中にタイムアウトしました")
+                await asyncio.wait_for(event.wait(), remaining)
+        finally:
+            with self._cond:
+                self._async_waiters.remove((loop, event))
+
+
+class GenerationCoalescer:
+    """
+    同時に届いた同じ（よく似た）質問の生成を1件にまとめるシングルフライト
+
+    キャッシュミスした質問は join() で生成中の回答を探し、正規化した質問文が一致するか、
+    質問の埋め込みのコサイン類似度が similarity 以上のものがあればフォロワーとして
+    その回答を共有する。なければリーダーとして生成し、キャッシュへの書き込みもリーダーだけが行う。
+    完了した回答も linger 秒間は共有する（キャッシュへの書き戻しが終わるまでの間を埋める）。
+    """
+
+    def __init__(self, similarity: float = 0.95, wait_timeout: float = 60.0, linger: float = 30.0,
+                 enabled: bool = True):
+        self.similarity = similarity
+        self.wait_timeout = wait_timeout
+        self.linger = linger
+        self.enabled = enabled
+
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.followers_exact = 0
+        self.followers_similar = 0
+
+    def _expire_locked(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, flight in self._flights.items()
+                    if flight.done and (not flight.shareable or now - flight.finished_at > self.linger)]:
+            del self._flights[key]
+
+    def _match_locked(self, key: str, vector: Optional[np.ndarray]) -> Tuple[Optional[Flight], str]:
+        flight = self._flights.get(key)
+        if flight is not None:
+            return flight, "exact"
+        if vector is None:
+            return None, ""
+        best, best_score = None, self.similarity
+        for candidate in self._flights.values():
+            if candidate.vector is None:
+                continue
+            score = float(candidate.vector @ vector)
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best, "similar"
+
+    def join(self, question: str, embedding=None) -> Tuple[Optional[Flight], bool]:
+        """
+        生成中の回答に参加する
+
+        Returns:
+            (flight, is_leader)。無効化されている場合は (None, True)
+        """
+        if not self.enabled:
+            return None, True
+
+        key = normalize_question(question)
+        vector = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            norm = float(np.linalg.norm(vector))
+            vector = vector / norm if norm else None
+
+        with self._lock:
+            self._expire_locked()
+            flight, match = self._match_locked(key, vector)
+            if flight is not None:
+                flight.followers += 1
+                if match == "exact":
+                    self.followers_exact += 1
+                else:
+                    self.followers_similar += 1
+                metrics.inc("coalesced", match=match)
+                logger.debug("[COALESCE] 生成中の回答を共有 (%s): %s", match, flight.key)
+                return flight, False
+
+            flight = Flight(key, vector)
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def release(self, flight: Optional[Flight]) -> None:
+        """リーダーの処理終了時に呼ぶ。finish() 前に抜けた場合はフォロワーに中断を伝える"""
+        if flight is None:
+            return
+        if not flight.done:
+            flight.finish(shareable=False)
+        if not flight.shareable:
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = sum(1 for flight in self._flights.values() if not flight.done)
+            lingering = len(self._flights) - in_flight
+        return {
+            "in_flight": in_flight,
+            "lingering": lingering,
+            "leaders": self.leaders,
+            "followers_exact": self.followers_exact,
+            "followers_similar": self.followers_similar
+        }
+
+
+generation_coalescer = GenerationCoalescer(
+    similarity=float(os.getenv("COALESCE_SIMILARITY", "0.95")),
+    wait_timeout=float(os.getenv("COALESCE_WAIT_TIMEOUT", "60")),
+    linger=float(os.getenv("COALESCE_LINGER", "30")),
+    enabled=os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+)
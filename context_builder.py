@@ -0,0 +1,227 @@
+"""
+トークン予算つきのプロンプト組み立て
+
+LLMへのメッセージを次の順に並べる。
+
+    1. system  固定のシステムプロンプト（全リクエストで同一。プロバイダのプレフィックスキャッシュが効く）
+    2. 履歴    直近の会話（1件あたり HISTORY_MESSAGE_TOKENS まで）
+    3. system  参考情報（RAGの検索結果）とスケジュール情報
+    4. user    ユーザーの質問そのもの
+
+参考情報は スコア下限（CONTEXT_SCORE_FLOOR）未満を除き、内容が重なるチャンク
+（文字 n-gram の重複率が CONTEXT_DEDUP_OVERLAP 以上）を除いたうえで、スコアの高い順に
+CONTEXT_TOKEN_BUDGET トークンまで詰める（入りきらないチャンクは途中で切る）。
+
+トークン数は tiktoken（任意の依存）で数える。未インストール・エンコーディングを
+取得できない場合は文字数からの概算で数える。
+"""
+import os
+import re
+import threading
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from observability import logger, metrics
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+CONTEXT_SCORE_FLOOR = float(os.getenv("CONTEXT_SCORE_FLOOR", "0.3"))
+CONTEXT_DEDUP_OVERLAP = float(os.getenv("CONTEXT_DEDUP_OVERLAP", "0.8"))
+HISTORY_MESSAGE_TOKENS = int(os.getenv("HISTORY_MESSAGE_TOKENS", "300"))
+HISTORY_MESSAGES = int(os.getenv("HISTORY_MESSAGES", "2"))
+
+# これより短くしか入らないチャンクは途中で切らずに捨てる（トークン）
+MIN_CHUNK_TOKENS = 32
+# チャットの1メッセージあたりの書式分のトークン
+MESSAGE_OVERHEAD_TOKENS = 4
+SHINGLE_SIZE = 4
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+class TokenCounter:
+    """モデルのトークナイザでトークン数を数える（使えなければ文字数から概算）"""
+
+    def __init__(self, model: str = "gpt-4o"):
+        self.model = model
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _get_encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._encoding = self._load_encoding()
+                    self._loaded = True
+        return self._encoding
+
+    def _load_encoding(self):
+        if tiktoken is None:
+            logger.warning("[CONTEXT] tiktoken が未インストールのためトークン数は概算です")
+            return None
+        try:
+            return tiktoken.encoding_for_model(self.model)
+        except Exception as e:
+            logger.warning("[CONTEXT] トークナイザを読み込めないためトークン数は概算です: %s", e)
+            return None
+
+    @property
+    def exact(self) -> bool:
+        return self._get_encoding() is not None
+
+    @staticmethod
+    def _char_cost(char: str) -> float:
+        # 日本語は概ね1文字1トークン、英数字は4文字で1トークン程度
+        return 0.25 if ord(char) < 128 else 1.0
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text))
+        return int(sum(self._char_cost(char) for char in text) + 0.999)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """先頭から max_tokens トークン分を返す"""
+        if max_tokens <= 0:
+            return ""
+        encoding = self._get_encoding()
+        if encoding is not None:
+            tokens = encoding.encode(text)
+            return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+        cost = 0.0
+        for i, char in enumerate(text):
+            cost += self._char_cost(char)
+            if cost > max_tokens:
+                return text[:i]
+        return text
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+def _shingles(text: str) -> set:
+    compact = text.replace(" ", "").casefold()
+    if len(compact) <= SHINGLE_SIZE:
+        return {compact} if compact else set()
+    return {compact[i:i + SHINGLE_SIZE] for i in range(len(compact) - SHINGLE_SIZE + 1)}
+
+
+class ContextBuilder:
+    """参考情報を予算内に収め、固定プレフィックスのメッセージを組み立てる"""
+
+    def __init__(self, token_budget: int = 1200, score_floor: float = 0.3, dedup_overlap: float = 0.8,
+                 history_messages: int = 2, history_message_tokens: int = 300,
+                 counter: Optional[TokenCounter] = None):
+        self.token_budget = token_budget
+        self.score_floor = score_floor
+        self.dedup_overlap = dedup_overlap
+        self.history_messages = history_messages
+        self.history_message_tokens = history_message_tokens
+        self.counter = counter or TokenCounter()
+
+    def select_chunks(self, hits: Iterable[Tuple[str, float]]) -> Tuple[List[str], Dict[str, int]]:
+        """
+        (本文, スコア) の検索結果から参考情報に使うチャンクを選ぶ
+
+        Returns:
+            (チャンクのリスト, {"below_floor", "duplicates", "truncated", "over_budget", "tokens"})
+        """
+        stats = {"below_floor": 0, "duplicates": 0, "truncated": 0, "over_budget": 0, "tokens": 0}
+        selected: List[str] = []
+        seen: List[set] = []
+        budget = self.token_budget
+
+        for text, score in sorted(hits, key=lambda hit: hit[1], reverse=True):
+            text = (text or "").strip()
+            if not text:
+                continue
+            if score < self.score_floor:
+                stats["below_floor"] += 1
+                continue
+            shingles = _shingles(_normalize(text))
+            if any(len(shingles & other) >= self.dedup_overlap * min(len(shingles), len(other)) for other in seen):
+                stats["duplicates"] += 1
+                continue
+
+            tokens = self.counter.count(text)
+            if tokens > budget:
+                if budget < MIN_CHUNK_TOKENS:
+                    stats["over_budget"] += 1
+                    continue
+                text = self.counter.truncate(text, budget)
+                tokens = self.counter.count(text)
+                stats["truncated"] += 1
+
+            selected.append(text)
+            seen.append(shingles)
+            budget -= tokens
+            stats["tokens"] += tokens
+        return selected, stats
+
+    def build_messages(self, system_prompt: str, question: str, history_messages: list = (),
+                       hits: Iterable[Tuple[str, float]] = (), schedule_context: str = "") -> Tuple[list, Dict[str, Any]]:
+        """
+        LLMへのメッセージとトークン数の内訳を返す
+
+        Args:
+            system_prompt: 固定のシステムプロンプト（リクエストごとに変わる内容を含めない）
+            question: ユーザーの質問
+            history_messages: LangChainの会話履歴メッセージ（直近 history_messages 件を使う）
+            hits: 参考情報の検索結果 (本文, スコア)
+            schedule_context: スケジュール情報（予算の対象外。空なら付けない）
+        """
+        count = self.counter.count
+        messages = [{"role": "system", "content": system_prompt}]
+        usage = {"system": count(system_prompt), "history": 0, "reference": 0, "schedule": 0, "question": 0}
+
+        recent = list(history_messages)[-self.history_messages:] if self.history_messages else []
+        for msg in recent:
+            content = self.counter.truncate(msg.content, self.history_message_tokens)
+            messages.append({"role": "user" if msg.type == "human" else "assistant", "content": content})
+            usage["history"] += count(content)
+
+        chunks, chunk_stats = self.select_chunks(hits)
+        dynamic = []
+        if chunks:
+            dynamic.append("参考情報:\n" + "\n\n".join(chunks))
+            usage["reference"] = chunk_stats["tokens"]
+        if schedule_context:
+            dynamic.append(schedule_context.strip())
+            usage["schedule"] = count(schedule_context)
+        if dynamic:
+            messages.append({"role": "system", "content": "\n\n".join(dynamic)})
+
+        messages.append({"role": "user", "content": question})
+        usage["question"] = count(question)
+        usage["total"] = sum(usage.values()) + MESSAGE_OVERHEAD_TOKENS * len(messages)
+        usage["chunks"] = len(chunks)
+        usage.update({key: value for key, value in chunk_stats.items() if key != "tokens"})
+        usage["exact"] = self.counter.exact
+
+        metrics.inc("prompt_tokens", usage["total"])
+        metrics.inc("context_chunks_dropped", chunk_stats["below_floor"], reason="below_floor")
+        metrics.inc("context_chunks_dropped", chunk_stats["duplicates"], reason="duplicate")
+        metrics.inc("context_chunks_dropped", chunk_stats["over_budget"], reason="over_budget")
+        logger.info("[CONTEXT] プロンプト %d tokens%s (system %d / 履歴 %d / 参考 %d [%d件, 下限未満 %d, 重複 %d, 切詰 %d, "
+                    "予算超過 %d] / スケジュール %d / 質問 %d)",
+                    usage["total"], "" if usage["exact"] else "（概算）", usage["system"], usage["history"],
+                    usage["reference"], usage["chunks"], usage["below_floor"], usage["duplicates"],
+                    usage["truncated"], usage["over_budget"], usage["schedule"], usage["question"])
+        return messages, usage
+
+
+context_builder = ContextBuilder(
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    score_floor=CONTEXT_SCORE_FLOOR,
+    dedup_overlap=CONTEXT_DEDUP_OVERLAP,
+    history_messages=HISTORY_MESSAGES,
+    history_message_tokens=HISTORY_MESSAGE_TOKENS
+)
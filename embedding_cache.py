@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from clients import get_async_openai_client, get_openai_client
+from observability import logger, span
+from resilience import circuit_breakers, hedged_call, hedged_call_async, request_timeout
+from ttl_cache import TTLCache
+
+load_dotenv()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+class EmbeddingDiskStore:
+    """埋め込みベクトルをSQLiteに永続化するストア（再起動後もAPI呼び出しを省略するため）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def set(self, key: str, vector: List[float]) -> None:
+        blob = np.asarray(vector, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", (key, blob)
+            )
+            self._conn.commit()
+
+
+class EmbeddingCache:
+    """LRU+TTLのメモリキャッシュと、任意のディスクストアを組み合わせた埋め込みキャッシュ"""
+
+    def __init__(self, maxsize: int = 2048, ttl: Optional[float] = 86400, disk_path: Optional[str] = None,
+                 model: str = EMBEDDING_MODEL):
+        self.model = model
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.disk = None
+        self.api_calls = 0
+
+        if disk_path:
+            try:
+                self.disk = EmbeddingDiskStore(disk_path)
+                logger.info("[EMBED_CACHE] 埋め込みディスクキャッシュ: %s", disk_path)
+            except Exception as e:
+                logger.warning("[EMBED_CACHE] 埋め込みディスクキャッシュを開けません: %s", e)
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        vector = self.memory.get(key)
+        if vector is not None:
+            return vector
+
+        if self.disk is not None:
+            try:
+                vector = self.disk.get(key)
+            except Exception as e:
+                logger.warning("[EMBED_CACHE] 埋め込みディスクキャッシュ読み込み失敗: %s", e)
+                vector = None
+            if vector is not None:
+                self.memory.set(key, vector)
+        return vector
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self.memory.set(key, vector)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, vector)
+            except Exception as e:
+                logger.warning("[EMBED_CACHE] 埋め込みディスクキャッシュ書き込み失敗: %s", e)
+
+    def _collect(self, texts: List[str]):
+        """キャッシュ済みの結果と、APIで取得が必要なテキスト（→結果の位置）を返す"""
+        results = [self._lookup(self._key(text)) for text in texts]
+        missing = {}
+        for i, vector in enumerate(results):
+            if vector is None:
+                missing.setdefault(texts[i], []).append(i)
+        return results, missing
+
+    def _fill(self, results: list, missing: dict, response) -> List[List[float]]:
+        self.api_calls += 1
+        if len(response.data) != len(missing):
+            raise ValueError("埋め込みの件数が入力と一致しません")
+
+        for text, item in zip(missing.keys(), response.data):
+            if not item.embedding:
+                raise ValueError("埋め込みが空です")
+            self._remember(self._key(text), item.embedding)
+            for i in missing[text]:
+                results[i] = item.embedding
+        return results
+
+    def _create(self, inputs: List[str]):
+        with span("embedding", texts=len(inputs)):
+            return get_openai_client().embeddings.create(model=self.model, input=inputs)
+
+    async def _create_async(self, inputs: List[str]):
+        with span("embedding", texts=len(inputs)):
+            return await get_async_openai_client().embeddings.create(model=self.model, input=inputs)
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """
+        複数テキストを埋め込む。キャッシュにないものだけを1回のAPI呼び出しでまとめて取得する
+
+        API呼び出しはサーキットブレーカー越しに行い、リクエスト内では締め切りから割り当てた
+        持ち時間で打ち切る。p95 を過ぎても返らなければ同じ要求をヘッジする。
+        """
+        results, missing = self._collect(texts)
+        if not missing:
+            return results
+        response = circuit_breakers.get("openai_embedding").call(
+            hedged_call, "embedding", self._create, list(missing.keys()), timeout=request_timeout("embedding")
+        )
+        return self._fill(results, missing, response)
+
+    async def embed_many_async(self, texts: List[str]) -> List[List[float]]:
+        """embed_many の非同期版（AsyncOpenAIを使用）"""
+        results, missing = self._collect(texts)
+        if not missing:
+            return results
+        response = await circuit_breakers.get("openai_embedding").call_async(
+            hedged_call_async, "embedding", self._create_async, list(missing.keys()),
+            timeout=request_timeout("embedding")
+        )
+        return self._fill(results, missing, response)
+
+    def embed(self, text: str) -> List[float]:
+        return self.embed_many([text])[0]
+
+    async def embed_async(self, text: str) -> List[float]:
+        return (await self.embed_many_async([text]))[0]
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats["api_calls"] = self.api_calls
+        stats["disk_enabled"] = self.disk is not None
+        return stats
+
+
+embedding_cache = EmbeddingCache(
+    maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("EMBEDDING_CACHE_TTL", "86400")),
+    disk_path=os.getenv("EMBEDDING_CACHE_PATH") or None
+)
+
+
+class EmbeddingContext:
+    """
+    1リクエスト分の質問埋め込みを保持するコンテキスト
+
+    ユーザーの生の質問から一度だけ埋め込みを計算し、キャッシュ検索・RAG検索・
+    キャッシュ書き戻しのすべてで同じベクトルを使い回す。
+    """
+
+    def __init__(self, question: str, cache: EmbeddingCache = None):
+        self.question = question
+        self._cache = cache or embedding_cache
+        self._embedding = None
+        self._lock = threading.Lock()
+        self._async_lock = None
+
+    @property
+    def embedding(self) -> List[float]:
+        if self._embedding is None:
+            with self._lock:
+                if self._embedding is None:
+                    self._embedding = self._cache.embed(self.question)
+        return self._embedding
+
+    async def get_embedding_async(self) -> List[float]:
+        """embedding の非同期版。同じリクエスト内の並行タスクからも1回だけ計算する"""
+        if self._embedding is None:
+            if self._async_lock is None:
+                self._async_lock = asyncio.Lock()
+            async with self._async_lock:
+                if self._embedding is None:
+                    self._embedding = await self._cache.embed_async(self.question)
+        return self._embedding
+
+    @property
+    def is_computed(self) -> bool:
+        return self._embedding is not None
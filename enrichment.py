@@ -0,0 +1,167 @@
+"""
+質問・回答のローカル拡張（キーワード・カテゴリ・難易度・意図の抽出）
+
+カテゴリ・難易度の辞書と、キーワード抽出で区別する意図グループの語彙を1つの
+Aho-Corasickオートマトンにまとめ、質問文を1回走査するだけで全ての一致を取り出す。
+LLMを呼ばずに数マイクロ秒〜数十マイクロ秒で終わる。
+
+    enricher.enrich("来週の練習はどこの体育館ですか？")
+    # {"keywords": ["来週", "どこ", "体育館"], "category": "練習", "intents": ["場所", "時間"], ...}
+"""
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# カテゴリ辞書（先に書いたカテゴリを優先する）
+CATEGORY_KEYWORDS = {
+    "技術": ["スマッシュ", "クリア", "ドロップ", "ネット", "サーブ", "レシーブ", "フォア", "バック", "フットワーク"],
+    "戦術": ["戦術", "戦略", "ダブルス", "シングルス", "ポジション", "攻撃", "守備", "ローテーション"],
+    "道具": ["ラケット", "ガット", "シューズ", "ウェア", "グリップ", "シャトル", "バッグ"],
+    "練習": ["練習", "トレーニング", "メニュー", "上達", "コツ", "基礎", "応用", "筋トレ"],
+    "ルール": ["ルール", "反則", "得点", "審判", "コート", "サイズ", "線", "規則"],
+    "怪我・健康": ["怪我", "痛み", "予防", "ストレッチ", "準備運動", "アイシング", "テーピング"],
+    "サークル運営": ["サークル", "練習日", "会費", "新人", "イベント", "大会", "合宿"]
+}
+DEFAULT_CATEGORY = "その他"
+
+# 難易度辞書（上級 > 中級 > 初級 の順に判定する）
+DIFFICULTY_KEYWORDS = {
+    "上級": ["高度", "応用", "戦術", "競技", "大会", "プロ"],
+    "中級": ["上達", "コツ", "改善", "練習方法"],
+    "初級": ["初心者", "始める", "基礎", "基本", "簡単", "教えて"]
+}
+DEFAULT_DIFFICULTY = "中級"
+
+# 質問の意図グループ（場所・内容・時間・費用・参加・準備を区別する）
+INTENT_KEYWORDS = {
+    "場所": ["どこ", "場所", "会場", "体育館", "住所", "アクセス"],
+    "内容": ["どんな", "内容", "メニュー", "何をする", "練習内容", "プログラム"],
+    "時間": ["いつ", "曜日", "時間", "スケジュール", "日程", "今週", "来週", "今月"],
+    "費用": ["料金", "費用", "いくら", "お金", "参加費", "会費", "paypay", "現金", "キャンセル"],
+    "参加": ["初心者", "レベル", "条件", "年齢", "経験", "学生", "子供", "親子", "見学", "途中参加", "ブランク"],
+    "準備": ["持ち物", "ラケット", "シューズ", "服装", "用意"]
+}
+
+# キーワードとしては汎用的すぎる語（カテゴリ・意図の判定には使う）
+GENERIC_KEYWORDS = {"バドミントン", "練習", "サークル"}
+
+MAX_KEYWORDS = 5
+QUESTION_SUMMARY_LENGTH = 30
+ANSWER_SUMMARY_LENGTH = 50
+
+
+class KeywordAutomaton:
+    """
+    複数パターンを同時に探すAho-Corasickオートマトン
+
+    各パターンには任意のタグ（(種別, ラベル) など）を複数付けられ、find() は
+    出現位置順に (開始位置, パターン, タグ一覧) を返す。
+    """
+
+    def __init__(self, patterns: Iterable[Tuple[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, Tuple[Any, ...]]]] = [[]]
+        tags: Dict[str, List[Any]] = {}
+        for pattern, tag in patterns:
+            tags.setdefault(pattern, []).append(tag)
+        for pattern, pattern_tags in tags.items():
+            self._add(pattern, tuple(pattern_tags))
+        self._build()
+
+    def _add(self, pattern: str, tags: Tuple[Any, ...]) -> None:
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append((pattern, tags))
+
+    def _build(self) -> None:
+        # ルート直下の失敗遷移はルート。以降は幅優先で親の失敗遷移をたどって決める
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text: str) -> List[Tuple[int, str, Tuple[Any, ...]]]:
+        matches = []
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for pattern, tags in self._output[node]:
+                matches.append((end - len(pattern) + 1, pattern, tags))
+        matches.sort(key=lambda m: (m[0], -len(m[1])))
+        return matches
+
+
+def _summarize(text: str, length: int) -> str:
+    text = " ".join((text or "").split())
+    return text[:length] + "…" if len(text) > length else text
+
+
+class Enricher:
+    """カテゴリ・難易度・意図の辞書から作ったオートマトンで質問を解析する"""
+
+    def __init__(self, categories: Dict[str, List[str]] = CATEGORY_KEYWORDS,
+                 difficulties: Dict[str, List[str]] = DIFFICULTY_KEYWORDS,
+                 intents: Dict[str, List[str]] = INTENT_KEYWORDS):
+        self._category_order = {name: i for i, name in enumerate(categories)}
+        self._difficulty_order = {name: i for i, name in enumerate(difficulties)}
+        self._intent_order = {name: i for i, name in enumerate(intents)}
+        patterns = []
+        for kind, groups in (("category", categories), ("difficulty", difficulties), ("intent", intents)):
+            for label, keywords in groups.items():
+                patterns.extend((keyword.lower(), (kind, label)) for keyword in keywords)
+        self.automaton = KeywordAutomaton(patterns)
+
+    def analyze(self, text: str) -> Dict[str, Any]:
+        """キーワード（出現順）・カテゴリ・難易度・意図を返す"""
+        categories, difficulties, intents = set(), set(), set()
+        keywords = []
+        for _, pattern, tags in self.automaton.find(text.lower()):
+            for kind, label in tags:
+                if kind == "category":
+                    categories.add(label)
+                elif kind == "difficulty":
+                    difficulties.add(label)
+                else:
+                    intents.add(label)
+            if pattern not in GENERIC_KEYWORDS and pattern not in keywords:
+                keywords.append(pattern)
+
+        return {
+            "keywords": keywords[:MAX_KEYWORDS],
+            "category": min(categories, key=self._category_order.get) if categories else DEFAULT_CATEGORY,
+            "difficulty_level": min(difficulties, key=self._difficulty_order.get) if difficulties else DEFAULT_DIFFICULTY,
+            "intents": sorted(intents, key=self._intent_order.get)
+        }
+
+    def enrich(self, question: str, answer: Optional[str] = None) -> Dict[str, Any]:
+        """キャッシュ保存用の拡張情報（enhance_with_ai と同じキー）"""
+        result = self.analyze(question)
+        result["question_summary"] = _summarize(question, QUESTION_SUMMARY_LENGTH)
+        if answer is not None:
+            result["answer_summary"] = _summarize(answer, ANSWER_SUMMARY_LENGTH)
+        result["alternative_questions"] = []
+        return result
+
+    @staticmethod
+    def is_confident(result: Dict[str, Any]) -> bool:
+        """辞書でカテゴリか意図を判定できたか（できなければLLMのフォールバック対象）"""
+        return result["category"] != DEFAULT_CATEGORY or bool(result["intents"])
+
+
+enricher = Enricher()
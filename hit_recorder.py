@@ -0,0 +1,143 @@
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict
+
+from cache_mirror import CACHE_COLLECTION_NAME
+from clients import get_qdrant_client
+from observability import logger, span
+
+# 最終ヒット時刻を書き込むペイロードキー（コンパクションで最近使われていない回答から削除する）
+LAST_HIT_FIELD = "last_hit_at"
+
+
+class HitRecorder:
+    """
+    キャッシュヒットした回答IDを溜め、まとめて last_hit_at をQdrantに書き込む
+
+    検索経路からは record() でメモリに積むだけで、書き込みは flush_interval 秒ごとに
+    バックグラウンドスレッドが1回の set_payload で行う（同じ回でヒットした回答は同じ時刻になる）。
+    削除済みの点は除いて書き込み、Qdrantに届かなかった分は次回に持ち越す。
+    """
+
+    def __init__(self, collection_name: str = CACHE_COLLECTION_NAME, flush_interval: float = 30.0,
+                 max_pending: int = 5000):
+        self.collection_name = collection_name
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stop = threading.Event()
+
+        self.recorded = 0
+        self.flushed = 0
+        self.failed = 0
+        self.missing = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="cache-hit-recorder", daemon=True)
+            self._worker.start()
+
+    def record(self, answer_id) -> None:
+        if not answer_id:
+            return
+        self.start()
+        with self._lock:
+            if len(self._pending) >= self.max_pending and str(answer_id) not in self._pending:
+                self.dropped += 1
+                return
+            self._pending.add(str(answer_id))
+            self.recorded += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _set_last_hit(self, client, ids, timestamp: str) -> None:
+        # wait=False だと適用前に応答が返り、削除済みの点によるエラーを受け取れない
+        # （バックグラウンドスレッドで実行するので適用完了まで待ってよい）
+        with span("hit_flush", points=len(ids)):
+            client.set_payload(
+                collection_name=self.collection_name,
+                payload={LAST_HIT_FIELD: timestamp},
+                points=ids,
+                wait=True
+            )
+
+    def _requeue(self, ids) -> None:
+        """書き込めなかった回答IDを次回の flush に回す（max_pending を超える分は破棄）"""
+        with self._lock:
+            for answer_id in ids:
+                if answer_id in self._pending:
+                    continue
+                if len(self._pending) >= self.max_pending:
+                    self.dropped += 1
+                    continue
+                self._pending.add(answer_id)
+
+    def flush(self) -> int:
+        """
+        溜まっている回答IDの last_hit_at を現在時刻で更新する。書き込んだ件数を返す
+
+        1件でも削除済み（コンパクション・期限切れ）の点が含まれると set_payload 全体が失敗するため、
+        失敗時は存在する点だけを取得し直して書き込む。Qdrantに届かない場合は次回に持ち越す。
+        """
+        with self._lock:
+            ids, self._pending = list(self._pending), set()
+        if not ids:
+            return 0
+
+        client = get_qdrant_client()
+        timestamp = datetime.now().isoformat(timespec="seconds")
+        try:
+            self._set_last_hit(client, ids, timestamp)
+            self.flushed += len(ids)
+            return len(ids)
+        except Exception as e:
+            logger.debug("[HIT_RECORDER] 一括書き込み失敗、存在する点だけで再試行します (%d件): %s", len(ids), e)
+
+        try:
+            existing = [str(record.id) for record in client.retrieve(
+                collection_name=self.collection_name, ids=ids, with_payload=False, with_vectors=False
+            )]
+            missing = len(ids) - len(existing)
+            if existing:
+                self._set_last_hit(client, existing, timestamp)
+        except Exception as e:
+            self.failed += len(ids)
+            self._requeue(ids)
+            logger.warning("[HIT_RECORDER] last_hit_at の書き込み失敗、次回に持ち越します (%d件): %s", len(ids), e)
+            return 0
+
+        self.flushed += len(existing)
+        self.missing += missing
+        if missing:
+            logger.debug("[HIT_RECORDER] 削除済みの点 %d件を除いて書き込みました", missing)
+        return len(existing)
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "failed": self.failed,
+            "missing": self.missing,
+            "dropped": self.dropped
+        }
+
+
+hit_recorder = HitRecorder(
+    flush_interval=float(os.getenv("CACHE_HIT_FLUSH_INTERVAL", "30")),
+    max_pending=int(os.getenv("CACHE_HIT_MAX_PENDING", "5000"))
+)
@@ -0,0 +1,250 @@
+"""
+質問の意図ルーター（スケジュールの質問をLLMを使わずにテンプレートで回答する）
+
+期間（今週・来週・今月・今後）、特定の日付・曜日、予定を尋ねる表現（いつ・何時から・どこ・予定など）、
+知りたい項目（場所・時間）を表す語を1つのオートマトンにまとめて質問を1回走査し、
+
+    schedule - スケジュールの質問。ScheduleSnapshot の予定からテンプレートで回答する
+    llm      - それ以外（技術・道具・ルールなどの自由な質問）。通常のキャッシュ検索とLLM生成へ
+
+に振り分ける。振り分け結果は routing カウンタ（route, reason ラベル）に記録する。
+"""
+import re
+import unicodedata
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from enrichment import DEFAULT_CATEGORY, KeywordAutomaton, enricher
+from observability import logger, metrics, span
+
+# 期間
+PERIOD_KEYWORDS = {
+    "this_week": ["今週", "この週"],
+    "next_week": ["来週", "次週"],
+    "this_month": ["今月", "この月"],
+    "upcoming": ["次の練習", "次回", "今後", "近々", "直近"]
+}
+# 相対的な日付（今日からの日数）
+RELATIVE_DAY_KEYWORDS = {"今日": 0, "本日": 0, "明日": 1, "あした": 1, "明後日": 2, "あさって": 2}
+# 曜日（date.weekday() の値。今日以降で最初のその曜日とみなす）
+WEEKDAY_KEYWORDS = {"月曜": 0, "火曜": 1, "水曜": 2, "木曜": 3, "金曜": 4, "土曜": 5, "日曜": 6}
+# 予定を尋ねる表現（期間・日付・曜日と組み合わさった場合だけスケジュールの質問とみなす）
+SCHEDULE_ASK_KEYWORDS = ["いつ", "何時から", "何時に", "何時まで", "何曜", "予定", "日程", "スケジュール",
+                         "どこ", "場所", "会場", "開催", "ありますか", "ある?", "あります?"]
+# 「今週の練習は？」のように、期間・日付のあとに主題だけを置いて尋ねる文末
+# （主題 + は/って + 疑問・文末。主題の前に技術などの語がある場合はカテゴリの判定でLLMへ回る）
+_BARE_SUBJECT_RE = re.compile(r"(?:練習日?|活動)(?:は|って)?(?:ある|あります)?(?:か|ですか)?[?。!\s]*$")
+# 知りたい項目
+ASPECT_KEYWORDS = {
+    "venue": ["どこ", "場所", "会場", "体育館", "住所", "アクセス"],
+    "time": ["いつ", "何時", "時間", "何曜"]
+}
+# スケジュールの語を含んでも自由な質問として扱う語
+OPEN_ENDED_KEYWORDS = ["練習方法", "練習内容", "メニュー", "コツ", "上達", "どうすれば", "どうしたら", "なぜ", "おすすめ",
+                       "するには", "ためには", "練習後", "練習前", "練習中", "飲み会", "懇親会"]
+# スケジュールの質問として扱うカテゴリ（それ以外のカテゴリの語を含む質問はLLMへ）
+SCHEDULE_CATEGORIES = {DEFAULT_CATEGORY, "練習", "サークル運営"}
+# 予定ではなく参加条件・費用・持ち物・内容を尋ねる意図（enrichment の意図グループ）
+NON_SCHEDULE_INTENTS = {"内容", "費用", "参加", "準備"}
+
+# 以前の is_schedule_question の語彙（LLM生成時にスケジュールを参考情報として添えるかの判定）
+SCHEDULE_MENTION_KEYWORDS = ['練習', 'スケジュール', '予定', '日程', 'いつ', '時間', '場所', '今週', '来週', '今月']
+
+# 3月15日 / 3/15 形式の日付。3/15 形式は分数（1/2の確率）と区別するため、直後が日付に続く語
+# （日・曜・助詞・練習や予定など）か文末のものだけを日付とみなす
+_DATE_RE = re.compile(
+    r"(?<![\d./])(\d{1,2})\s*(?:月\s*(\d{1,2})\s*日"
+    r"|/\s*(\d{1,2})(?=$|[\s日曜(はにへ、。?!]|の(?:練習|予定|活動|日程|スケジュール)|から|まで|って))"
+)
+
+NO_PRACTICE_MESSAGE = "通常は毎週木曜日19:00-21:00に越谷市立地域スポーツセンターで練習を行っております。"
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+def _format_date(date_str: str, day_of_week: str = "") -> str:
+    try:
+        formatted = datetime.strptime(date_str, '%Y-%m-%d').strftime('%m月%d日')
+    except ValueError:
+        formatted = date_str
+    return f"{formatted}（{day_of_week}）" if day_of_week else formatted
+
+
+def format_venues_for_chat(schedules: List[Dict[str, Any]], title: str) -> str:
+    """練習会場を中心にした回答"""
+    if not schedules:
+        return f"{title}の練習予定はまだ登録されていません。{NO_PRACTICE_MESSAGE}"
+    lines = [f"📍 **{title}の練習会場**", ""]
+    for schedule in schedules:
+        court = schedule.get('court', '')
+        venue = schedule.get('venue', '場所未定') + (f"（{court}）" if court else "")
+        lines.append(f"• **{_format_date(schedule.get('date', ''), schedule.get('day_of_week', ''))}** {venue}")
+    return "\n".join(lines)
+
+
+def format_times_for_chat(schedules: List[Dict[str, Any]], title: str) -> str:
+    """練習日時を中心にした回答"""
+    if not schedules:
+        return f"{title}の練習予定はまだ登録されていません。{NO_PRACTICE_MESSAGE}"
+    lines = [f"🕖 **{title}の練習日時**", ""]
+    for schedule in schedules:
+        lines.append(
+            f"• **{_format_date(schedule.get('date', ''), schedule.get('day_of_week', ''))}** "
+            f"{schedule.get('start_time', '19:00')}〜{schedule.get('end_time', '21:00')}"
+        )
+    return "\n".join(lines)
+
+
+class IntentRouter:
+    """スケジュールの質問を判定し、テンプレートで回答を作るルーター"""
+
+    def __init__(self):
+        patterns = []
+        for period, keywords in PERIOD_KEYWORDS.items():
+            patterns.extend((keyword, ("period", period)) for keyword in keywords)
+        for keyword, days in RELATIVE_DAY_KEYWORDS.items():
+            patterns.append((keyword, ("day", days)))
+        for keyword, weekday in WEEKDAY_KEYWORDS.items():
+            patterns.append((keyword, ("weekday", weekday)))
+        for aspect, keywords in ASPECT_KEYWORDS.items():
+            patterns.extend((keyword, ("aspect", aspect)) for keyword in keywords)
+        patterns.extend((keyword, ("ask", None)) for keyword in SCHEDULE_ASK_KEYWORDS)
+        patterns.extend((keyword, ("open", None)) for keyword in OPEN_ENDED_KEYWORDS)
+        patterns.extend((keyword, ("mention", None)) for keyword in SCHEDULE_MENTION_KEYWORDS)
+        self.automaton = KeywordAutomaton(patterns)
+
+    def _scan(self, text: str) -> Dict[str, Any]:
+        found = {"period": None, "day": None, "weekday": None, "aspects": [], "ask": False, "open": False,
+                 "mention": False}
+        for _, _, tags in self.automaton.find(text):
+            for kind, value in tags:
+                if kind == "period":
+                    found["period"] = found["period"] or value
+                elif kind in ("day", "weekday"):
+                    found[kind] = value if found[kind] is None else found[kind]
+                elif kind == "aspect":
+                    if value not in found["aspects"]:
+                        found["aspects"].append(value)
+                else:
+                    found[kind] = True
+        return found
+
+    def mentions_schedule(self, text: str) -> bool:
+        """スケジュールに関する語を含むか（LLM生成時にスケジュールを参考情報として添えるかの判定）"""
+        return self._scan(text)["mention"]
+
+    @staticmethod
+    def _parse_date(text: str, today: date) -> Optional[date]:
+        match = _DATE_RE.search(text)
+        if not match:
+            return None
+        month, day = int(match.group(1)), int(match.group(2) or match.group(3))
+        try:
+            target = date(today.year, month, day)
+        except ValueError:
+            return None
+        # 過ぎた日付は来年のこととみなす
+        if target < today - timedelta(days=1):
+            try:
+                target = date(today.year + 1, month, day)
+            except ValueError:
+                return None
+        return target
+
+    def classify(self, message: str, today: Optional[date] = None) -> Dict[str, Any]:
+        """
+        振り分け先を決める
+
+        スケジュールの質問とみなすのは、期間・日付・曜日のいずれかに加えて、予定を尋ねる表現
+        （いつ・何時から・どこ・予定など）があるか、「今週の練習は？」のように練習・活動を
+        文末に置いて尋ねている場合だけ。「練習」と「時間」のような語の組み合わせだけでは振り分けない。そのうえで自由な質問を表す語、技術・道具などの
+        カテゴリの語、参加条件・費用などの意図を含む場合はLLMに回す。
+        """
+        today = today or datetime.now().date()
+        text = _normalize(message)
+        found = self._scan(text)
+        target = self._parse_date(text, today)
+        if target is None and found["day"] is not None:
+            target = today + timedelta(days=found["day"])
+        if target is None and found["weekday"] is not None:
+            target = today + timedelta(days=(found["weekday"] - today.weekday()) % 7)
+
+        when = found["period"] or target
+        route = {"route": "llm", "reason": "open", "period": found["period"], "date": target,
+                 "aspect": found["aspects"][0] if found["aspects"] else None}
+
+        if not (when and (found["ask"] or _BARE_SUBJECT_RE.search(text))):
+            return route
+        if found["open"]:
+            route["reason"] = "open_ended"
+            return route
+        analysis = enricher.analyze(text)
+        if analysis["category"] not in SCHEDULE_CATEGORIES:
+            route["reason"] = f"category:{analysis['category']}"
+            return route
+        other_intents = [intent for intent in analysis["intents"] if intent in NON_SCHEDULE_INTENTS]
+        if other_intents:
+            route["reason"] = f"intent:{other_intents[0]}"
+            return route
+
+        route["route"] = "schedule"
+        route["reason"] = "date" if target else (found["period"] or "upcoming")
+        return route
+
+    def answer(self, route: Dict[str, Any], today: Optional[date] = None) -> str:
+        """スケジュールの質問にテンプレートで回答する"""
+        # DynamoDBを使う badminton_utils はスケジュールの回答時にだけ読み込む
+        from badminton_utils import get_schedule_snapshot
+
+        today = today or datetime.now().date()
+        snapshot = get_schedule_snapshot()
+        period = route.get("period")
+        target = route.get("date")
+
+        if target is not None:
+            schedules = snapshot.on_date(target)
+            title = f"{target.month}月{target.day}日"
+        elif period == "this_week":
+            schedules, title = snapshot.this_week(today), "今週"
+        elif period == "next_week":
+            schedules, title = snapshot.next_week(today), "来週"
+        elif period == "this_month":
+            schedules, title = snapshot.this_month(today), "今月"
+        else:
+            schedules, title = snapshot.upcoming(today), "今後2週間"
+
+        if route.get("aspect") == "venue":
+            return format_venues_for_chat(schedules, title)
+        if route.get("aspect") == "time":
+            return format_times_for_chat(schedules, title)
+        if target is not None and not schedules:
+            return f"{title}の練習予定は登録されていません。{NO_PRACTICE_MESSAGE}"
+        return snapshot.manager.format_schedule_for_chat(schedules)
+
+    def route(self, message: str) -> Optional[str]:
+        """
+        スケジュールの質問ならテンプレートの回答を返し、それ以外は None を返す
+
+        予定の取得に失敗した場合も None（通常のLLM生成にフォールバック）。
+        """
+        with span("intent_route") as s:
+            route = self.classify(message)
+            s.set(route=route["route"], reason=route["reason"])
+            if route["route"] == "schedule":
+                try:
+                    answer = self.answer(route)
+                except Exception as e:
+                    logger.warning("[ROUTER] スケジュール回答の作成に失敗: %s", e)
+                    route = {"route": "llm", "reason": "schedule_error"}
+                    answer = None
+            else:
+                answer = None
+
+        metrics.inc("routing", route=route["route"], reason=route["reason"])
+        logger.debug("[ROUTER] %s -> %s (%s)", message, route["route"], route["reason"])
+        return answer
+
+
+intent_router = IntentRouter()
@@ -0,0 +1,162 @@
+"""
+badminton-cache を正規回答レイアウト（answer_id 参照）に移行する
+
+旧形式では類義語の点も回答本文を含む完全なペイロードを持っていた。新形式では
+正規の回答点だけが本文を持ち、類義語の点は answer_id で正規の回答点を参照する。
+検索は answer_id でグループ化するため、answer_id を持たない点は検索に出てこない。
+
+使い方:
+    python migrate_cache_layout.py --create-index   # answer_id のキーワードインデックスを作成
+    python migrate_cache_layout.py --migrate        # 旧形式の点に answer_id を設定
+    python migrate_cache_layout.py --migrate --dry-run
+
+同じ質問・同じ回答を持つ旧形式の点は1つを正規の回答点とし、残りは類義語の点として
+本文などの重複ペイロードを削除する。正規の回答点は通常の書き込みと同じ
+canonical_point_id(質問) のIDに付け替え（旧IDの点は削除）、以降の同じ質問の書き込みが
+同じ点を上書きするようにする。そのIDの点がすでにある場合は、旧形式の点をすべて
+その点の類義語の点にする。
+
+移行で付け替えた点は timestamp が古いままなので、キャッシュミラーの差分取得では
+取り込まれない。移行後はスナップショット（CACHE_SNAPSHOT_DIR）を削除してワーカーを再起動する。
+"""
+import argparse
+from collections import defaultdict
+
+from dotenv import load_dotenv
+from qdrant_client.models import (PayloadSchemaType, PointIdsList, PointStruct, SetPayloadOperation, SetPayload,
+                                  DeletePayloadOperation, DeletePayload)
+
+from clients import get_qdrant_client
+from badminton_utils import ANSWER_GROUP_KEY, CACHE_COLLECTION_NAME, canonical_point_id
+from question_cache import normalize_question
+
+load_dotenv()
+
+# 類義語の点から削除する重複ペイロード
+DUPLICATED_FIELDS = ["text", "answer_summary", "alternative_questions", "keywords", "question_summary"]
+
+
+def create_index(client):
+    client.create_payload_index(
+        collection_name=CACHE_COLLECTION_NAME,
+        field_name=ANSWER_GROUP_KEY,
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+    print(f"[INFO] '{ANSWER_GROUP_KEY}' のキーワードインデックスを作成しました")
+
+
+def _legacy_points(client, batch_size=256):
+    """answer_id を持たない点を (id, payload) で列挙する"""
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=CACHE_COLLECTION_NAME,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["question", "text", "timestamp", ANSWER_GROUP_KEY],
+            with_vectors=False
+        )
+        for record in records:
+            payload = record.payload or {}
+            if not payload.get(ANSWER_GROUP_KEY):
+                yield str(record.id), payload
+        if offset is None:
+            break
+
+
+def _rekey_canonical(client, point_id, answer_id):
+    """正規の回答点を answer_id のIDで作り直し、旧IDの点を削除する"""
+    record = client.retrieve(
+        collection_name=CACHE_COLLECTION_NAME, ids=[point_id], with_payload=True, with_vectors=True
+    )[0]
+    payload = dict(record.payload or {}, **{ANSWER_GROUP_KEY: answer_id, "kind": "canonical"})
+    client.upsert(
+        collection_name=CACHE_COLLECTION_NAME,
+        points=[PointStruct(id=answer_id, vector=record.vector, payload=payload)],
+        wait=True
+    )
+    client.delete(
+        collection_name=CACHE_COLLECTION_NAME,
+        points_selector=PointIdsList(points=[point_id]),
+        wait=True
+    )
+
+
+def migrate(client, dry_run=False, batch_size=64):
+    # 同じ質問・回答の旧形式の点をまとめる
+    groups = defaultdict(list)
+    questions = {}
+    for point_id, payload in _legacy_points(client):
+        key = (normalize_question(payload.get("question", "")), payload.get("text", ""))
+        groups[key].append((payload.get("timestamp", ""), point_id))
+        questions[key] = payload.get("question", "")
+
+    operations = []
+    rekeys = []
+    canonical_count = alternative_count = 0
+    for key, members in groups.items():
+        members.sort()
+        answer_id = canonical_point_id(questions[key])
+        legacy_ids = [point_id for _, point_id in members]
+
+        if answer_id in legacy_ids:
+            # すでに canonical_point_id の点（付け替え不要）
+            canonical_id = answer_id
+        elif client.retrieve(collection_name=CACHE_COLLECTION_NAME, ids=[answer_id], with_payload=False):
+            # 同じ質問の新形式の点がすでにある: 旧形式の点はすべてその類義語にする
+            canonical_id = None
+        else:
+            canonical_id = legacy_ids[0]
+            rekeys.append((canonical_id, answer_id))
+
+        if canonical_id is not None:
+            canonical_count += 1
+            if canonical_id == answer_id:
+                operations.append(SetPayloadOperation(set_payload=SetPayload(
+                    payload={ANSWER_GROUP_KEY: answer_id, "kind": "canonical"}, points=[answer_id]
+                )))
+
+        alternative_ids = [point_id for point_id in legacy_ids if point_id != canonical_id]
+        if alternative_ids:
+            alternative_count += len(alternative_ids)
+            operations.append(SetPayloadOperation(set_payload=SetPayload(
+                payload={ANSWER_GROUP_KEY: answer_id, "kind": "alternative"}, points=alternative_ids
+            )))
+            operations.append(DeletePayloadOperation(delete_payload=DeletePayload(
+                keys=DUPLICATED_FIELDS, points=alternative_ids
+            )))
+
+    print(f"[INFO] 正規の回答点: {canonical_count}件（うちID付け替え {len(rekeys)}件） / 類義語の点: {alternative_count}件")
+    if dry_run:
+        print("[DRY-RUN] 書き込みは行いません")
+        return
+
+    # 付け替えを先に行い、類義語の点が参照する回答点を用意してから answer_id を設定する
+    for point_id, answer_id in rekeys:
+        _rekey_canonical(client, point_id, answer_id)
+    for i in range(0, len(operations), batch_size):
+        client.batch_update_points(
+            collection_name=CACHE_COLLECTION_NAME,
+            update_operations=operations[i:i + batch_size]
+        )
+    print("[INFO] 移行完了")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="badminton-cache の正規回答レイアウト移行ツール")
+    parser.add_argument('--create-index', action='store_true', help='answer_id のインデックスを作成する')
+    parser.add_argument('--migrate', action='store_true', help='旧形式の点に answer_id を設定する')
+    parser.add_argument('--dry-run', action='store_true', help='書き込みを行わず件数だけ表示する')
+    args = parser.parse_args()
+
+    client = get_qdrant_client()
+    if args.create_index:
+        create_index(client)
+    if args.migrate:
+        migrate(client, dry_run=args.dry_run)
+    if not (args.create_index or args.migrate):
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
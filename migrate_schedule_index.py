@@ -0,0 +1,157 @@
+"""
+bad_schedules テーブルの検索用GSI（status-month-index）の作成・バックフィル・効果測定
+
+使い方:
+    python migrate_schedule_index.py --create-index   # GSIを作成してACTIVEになるまで待つ
+    python migrate_schedule_index.py --backfill       # 既存アイテムに status_month を書き込む
+    python migrate_schedule_index.py --compare        # scan と query の消費RCUを比較する
+    python migrate_schedule_index.py --backfill --dry-run
+
+スケジュールを登録する側も、アイテム作成時に
+status_month = build_status_month(status, date) を設定すること。
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from boto3.dynamodb.conditions import Attr
+from dotenv import load_dotenv
+
+from clients import get_dynamodb_resource
+from badminton_utils import BadmintonScheduleManager, SCHEDULE_INDEX_NAME, build_status_month
+
+load_dotenv()
+
+TABLE_NAME = os.getenv('DYNAMODB_SCHEDULE_TABLE', 'bad_schedules')
+
+
+def create_index(client):
+    """status_month（HASH）+ date（RANGE）のGSIを作成する"""
+    table = client.describe_table(TableName=TABLE_NAME)['Table']
+    existing = [index['IndexName'] for index in table.get('GlobalSecondaryIndexes', [])]
+    if SCHEDULE_INDEX_NAME in existing:
+        print(f"[INFO] GSI '{SCHEDULE_INDEX_NAME}' は作成済みです")
+        return
+
+    index = {
+        'IndexName': SCHEDULE_INDEX_NAME,
+        'KeySchema': [
+            {'AttributeName': 'status_month', 'KeyType': 'HASH'},
+            {'AttributeName': 'date', 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'ALL'}
+    }
+    billing_mode = table.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+    if billing_mode == 'PROVISIONED':
+        index['ProvisionedThroughput'] = {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+
+    client.update_table(
+        TableName=TABLE_NAME,
+        AttributeDefinitions=[
+            {'AttributeName': 'status_month', 'AttributeType': 'S'},
+            {'AttributeName': 'date', 'AttributeType': 'S'}
+        ],
+        GlobalSecondaryIndexUpdates=[{'Create': index}]
+    )
+    print(f"[INFO] GSI '{SCHEDULE_INDEX_NAME}' を作成中...")
+
+    while True:
+        time.sleep(10)
+        table = client.describe_table(TableName=TABLE_NAME)['Table']
+        statuses = {i['IndexName']: i['IndexStatus'] for i in table.get('GlobalSecondaryIndexes', [])}
+        print(f"  状態: {statuses.get(SCHEDULE_INDEX_NAME)}")
+        if statuses.get(SCHEDULE_INDEX_NAME) == 'ACTIVE':
+            break
+    print("[INFO] GSI作成完了")
+
+
+def backfill(resource, client, dry_run=False):
+    """status_month が未設定・不一致のアイテムに値を書き込む（ページネーション付き）"""
+    table = resource.Table(TABLE_NAME)
+    key_names = [k['AttributeName'] for k in client.describe_table(TableName=TABLE_NAME)['Table']['KeySchema']]
+
+    scan_kwargs = {}
+    scanned = updated = skipped = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            scanned += 1
+            if not item.get('date') or not item.get('status'):
+                skipped += 1
+                continue
+
+            expected = build_status_month(item['status'], item['date'])
+            if item.get('status_month') == expected:
+                continue
+
+            updated += 1
+            if dry_run:
+                print(f"  [DRY-RUN] {item['date']} -> {expected}")
+                continue
+            table.update_item(
+                Key={name: item[name] for name in key_names},
+                UpdateExpression='SET status_month = :sm',
+                ExpressionAttributeValues={':sm': expected}
+            )
+
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            break
+        scan_kwargs['ExclusiveStartKey'] = last_key
+
+    print(f"[INFO] バックフィル完了: 走査{scanned}件 / 更新{'予定' if dry_run else ''}{updated}件 / スキップ{skipped}件")
+
+
+def compare(days_ahead=62):
+    """従来のscanとGSIクエリで、同じ期間を読むのに消費するRCUを比較する"""
+    manager = BadmintonScheduleManager()
+    today = datetime.now().date()
+    end_date = today + timedelta(days=days_ahead)
+
+    manager.last_consumed_capacity = 0.0
+    scanned = manager._paginate(
+        manager.schedule_table.scan,
+        FilterExpression=(
+            Attr('date').between(today.isoformat(), end_date.isoformat()) &
+            Attr('status').eq('active')
+        )
+    )
+    scan_rcu = manager.last_consumed_capacity
+
+    queried = manager.query_practices(today, end_date)
+    query_rcu = manager.last_consumed_capacity
+
+    print(f"期間: {today} ～ {end_date}")
+    print(f"  scan : {len(scanned):4d}件  消費RCU {scan_rcu:.1f}")
+    print(f"  query: {len(queried):4d}件  消費RCU {query_rcu:.1f}")
+    if not manager.index_available:
+        print("  ※ GSIが使えないため query はscanにフォールバックしました")
+    if len(scanned) != len(queried):
+        print("  ⚠ 件数が一致しません。--backfill を実行してください")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bad_schedules のGSI移行ツール")
+    parser.add_argument('--create-index', action='store_true', help='GSIを作成する')
+    parser.add_argument('--backfill', action='store_true', help='既存アイテムに status_month を設定する')
+    parser.add_argument('--compare', action='store_true', help='scan と query の消費RCUを比較する')
+    parser.add_argument('--days', type=int, default=62, help='比較に使う期間（日数）')
+    parser.add_argument('--dry-run', action='store_true', help='書き込みを行わず対象だけ表示する')
+    args = parser.parse_args()
+
+    resource = get_dynamodb_resource()
+    client = resource.meta.client
+
+    if args.create_index:
+        create_index(client)
+    if args.backfill:
+        backfill(resource, client, dry_run=args.dry_run)
+    if args.compare:
+        compare(args.days)
+    if not (args.create_index or args.backfill or args.compare):
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+トレーシング・メトリクス・ログ
+
+各処理ステージ（L1/L2キャッシュ検索、埋め込み、Qdrant検索、スケジュール取得、LLM生成、
+キャッシュ書き込み、ログ書き込み）を span で計測し、ステージごとのレイテンシ
+ヒストグラム（p50/p95/p99）とカウンタに集計する。集計結果は render_prometheus() で
+Prometheusのテキスト形式として /metrics から公開する。
+
+詳細なデバッグ出力は logger.debug に寄せ、LOG_LEVEL=DEBUG のときだけ整形される。
+"""
+import contextvars
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+METRIC_PREFIX = "badminton"
+
+# レイテンシヒストグラムのバケット境界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _setup_logger() -> logging.Logger:
+    log = logging.getLogger("badminton")
+    if not log.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    return log
+
+
+# 引数は %-形式で渡す（logger.debug("... %s", value)）。レベル外のメッセージは整形されない
+logger = _setup_logger()
+
+
+class LatencyHistogram:
+    """
+    1ステージ分のレイテンシ分布
+
+    Prometheus互換の累積バケットに加え、直近 window 件のサンプルから
+    p50/p95/p99 を計算する。
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window: int = 1024):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._counts[bisect_left(self.buckets, seconds)] += 1
+            self._recent.append(seconds)
+            self.count += 1
+            self.sum += seconds
+
+    def quantiles(self) -> Dict[float, float]:
+        with self._lock:
+            samples = sorted(self._recent)
+        if not samples:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in QUANTILES}
+
+    def quantile(self, q: float) -> float:
+        """直近のサンプルの q 分位点（サンプルがなければ 0）"""
+        with self._lock:
+            samples = sorted(self._recent)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def cumulative_buckets(self) -> List[tuple]:
+        with self._lock:
+            counts = list(self._counts)
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry:
+    """ステージ別レイテンシヒストグラム・カウンタ・ゲージの集計先"""
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._gauge_sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, LatencyHistogram(window=self.window))
+        histogram.observe(seconds)
+
+    def histogram(self, stage: str) -> Optional[LatencyHistogram]:
+        """ステージのヒストグラム（まだ記録がなければ None）"""
+        return self._histograms.get(stage)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_gauges(self, component: str, source: Callable[[], Dict[str, Any]]) -> None:
+        """スクレイプ時に source() を呼び、数値の値をゲージとして出力する"""
+        self._gauge_sources[component] = source
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """ステージごとの件数とp50/p95/p99（秒）"""
+        result = {}
+        for stage, histogram in sorted(self._histograms.items()):
+            quantiles = histogram.quantiles()
+            result[stage] = {
+                "count": histogram.count,
+                "p50": quantiles[0.5],
+                "p95": quantiles[0.95],
+                "p99": quantiles[0.99]
+            }
+        return result
+
+    def render_prometheus(self) -> str:
+        lines = []
+        name = f"{METRIC_PREFIX}_stage_latency_seconds"
+        lines.append(f"# HELP {name} Latency of each request stage.")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in sorted(self._histograms.items()):
+            for bound, count in histogram.cumulative_buckets():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        quantile_name = f"{METRIC_PREFIX}_stage_latency_quantile_seconds"
+        lines.append(f"# HELP {quantile_name} Recent latency quantiles of each request stage.")
+        lines.append(f"# TYPE {quantile_name} gauge")
+        for stage, histogram in sorted(self._histograms.items()):
+            for q, value in histogram.quantiles().items():
+                lines.append(f'{quantile_name}{{stage="{stage}",quantile="{q}"}} {value}')
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+        declared = set()
+        for (counter, labels), value in counters:
+            full_name = f"{METRIC_PREFIX}_{counter}_total"
+            if full_name not in declared:
+                lines.append(f"# TYPE {full_name} counter")
+                declared.add(full_name)
+            lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+        for component, source in sorted(self._gauge_sources.items()):
+            try:
+                values = source()
+            except Exception as e:
+                logger.warning("[METRICS] ゲージ取得失敗 (%s): %s", component, e)
+                continue
+            for key, value in _flatten(values):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                full_name = f"{METRIC_PREFIX}_{component}_{key}"
+                lines.append(f"# TYPE {full_name} gauge")
+                lines.append(f"{full_name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+_LABEL_ESCAPE_RE = re.compile(r'(["\\])')
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        escaped = _LABEL_ESCAPE_RE.sub(r"\\\1", str(value))
+        parts.append(f'{key}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _flatten(values: Dict[str, Any], prefix: str = ""):
+    for key, value in values.items():
+        name = _NAME_RE.sub("_", f"{prefix}{key}")
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{name}_")
+        else:
+            yield name, value
+
+
+metrics = MetricsRegistry(window=int(os.getenv("METRICS_QUANTILE_WINDOW", "1024")))
+
+_trace_id = contextvars.ContextVar("badminton_trace_id", default=None)
+
+
+def start_trace() -> str:
+    """リクエストの開始時に呼び、以降の span に共通のトレースIDを付ける"""
+    trace_id = uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+class span:
+    """
+    1ステージの処理時間を計測するコンテキストマネージャ
+
+        with span("qdrant_query", collection="badminton-cache") as s:
+            ...
+            s.set(hits=len(points))
+
+    終了時にステージのヒストグラムへ記録し、例外で抜けた場合は
+    stage_errors カウンタを増やす（例外はそのまま送出される）。
+    """
+
+    __slots__ = ("stage", "attributes", "trace_id", "start", "duration", "status")
+
+    def __init__(self, stage: str, **attributes):
+        self.stage = stage
+        self.attributes = attributes
+        self.trace_id = None
+        self.start = 0.0
+        self.duration = 0.0
+        self.status = "ok"
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "span":
+        self.trace_id = _trace_id.get()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.status = "error"
+            metrics.inc("stage_errors", stage=self.stage)
+        metrics.observe(self.stage, self.duration)
+        logger.debug("[SPAN] stage=%s trace=%s duration_ms=%.1f status=%s %s",
+                     self.stage, self.trace_id, self.duration * 1000, self.status, self.attributes)
+        return False
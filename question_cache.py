@@ -0,0 +1,75 @@
+import os
+import re
+import unicodedata
+from typing import Any, Dict, Optional
+
+from ttl_cache import TTLCache
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _is_trim_char(ch: str) -> bool:
+    return ch.isspace() or unicodedata.category(ch).startswith("P")
+
+
+def normalize_question(text: str) -> str:
+    """
+    質問文を正規化してキャッシュキーにする
+
+    - NFKC正規化（全角英数・記号の半角化、半角カナの全角化）
+    - 英字の大文字小文字を統一
+    - 連続する空白を1つにまとめる
+    - 前後の空白・句読点（？！。、など）を除去
+    """
+    if not text:
+        return ""
+
+    normalized = unicodedata.normalize("NFKC", text).casefold()
+    normalized = _WHITESPACE_RE.sub(" ", normalized)
+
+    start, end = 0, len(normalized)
+    while start < end and _is_trim_char(normalized[start]):
+        start += 1
+    while end > start and _is_trim_char(normalized[end - 1]):
+        end -= 1
+
+    return normalized[start:end]
+
+
+class QuestionAnswerCache:
+    """
+    正規化した質問文をキーにした完全一致のL1回答キャッシュ
+
+    ベクトル検索（L2）の前段に置き、同じ質問の繰り返しをネットワーク呼び出しなしで返す。
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, question: str) -> Optional[Dict[str, Any]]:
+        key = normalize_question(question)
+        if not key:
+            return None
+        return self._cache.get(key)
+
+    def put(self, question: str, answer: str, vector_id: Optional[str] = None, score: Optional[float] = None) -> None:
+        key = normalize_question(question)
+        if not key or not answer:
+            return
+        self._cache.set(key, {
+            "answer": answer,
+            "vector_id": vector_id,
+            "score": score
+        })
+
+    def invalidate(self, question: str) -> None:
+        self._cache.pop(normalize_question(question))
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+
+question_answer_cache = QuestionAnswerCache(
+    maxsize=int(os.getenv("L1_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("L1_CACHE_TTL", "3600"))
+)
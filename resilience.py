@@ -0,0 +1,387 @@
+"""
+外部呼び出しのデッドライン・ヘッジ・サーキットブレーカー
+
+- デッドライン: リクエストの開始時に start_deadline() で締め切りを決め、各ステージは
+  stage_timeout(stage) で「ステージの上限」と「締め切りまでの残り（後段のLLM生成の分を
+  残す）」の小さい方だけ待つ。締め切りは contextvar なので span のトレースIDと同じく
+  copy_context() 経由でワーカースレッドにも引き継がれる。
+- ヘッジ: 冪等な読み取り（埋め込み・Qdrant検索）は、そのステージの直近レイテンシの
+  p95（HEDGE_PERCENTILE）を過ぎても終わらなければ同じ要求をもう1本送り、先に返った方を使う。
+- サーキットブレーカー: 依存先ごとに連続失敗を数え、閾値を超えたら reset_timeout 秒の間は
+  呼び出さずに CircuitOpenError を送出する（TCPタイムアウトを待たずにそのステージを飛ばす）。
+  期間が過ぎたら1件だけ試し、成功すれば閉じる。
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+from observability import logger, metrics
+
+# リクエスト全体の締め切り（秒）
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "60"))
+# LLM生成の前のステージが使い切らずに残しておく時間（秒）
+LLM_MIN_BUDGET = float(os.getenv("LLM_MIN_BUDGET", "15"))
+
+# 各ステージの上限（秒）
+STAGE_TIMEOUTS = {
+    "embedding": float(os.getenv("EMBEDDING_TIMEOUT", "2.0")),
+    "cache_query": float(os.getenv("CACHE_QUERY_TIMEOUT", "1.0")),
+    "schedule": float(os.getenv("SCHEDULE_LOOKUP_TIMEOUT", "3.0")),
+    "rag": float(os.getenv("RAG_LOOKUP_TIMEOUT", "5.0")),
+    "llm": float(os.getenv("LLM_TIMEOUT", "60"))
+}
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+# ヘッジ判定に使う最低サンプル数と、ヘッジを送るまでの最短待ち時間（秒）
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+# ヘッジを送ってよい呼び出しの割合（依存先が全体に遅いときに負荷を倍にしない）
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """ステージの持ち時間（またはリクエストの締め切り）を過ぎた"""
+
+
+class BudgetExhausted(DeadlineExceeded):
+    """呼び出す前に持ち時間が残っていなかった（依存先は呼んでいないので障害として数えない）"""
+
+
+class CircuitOpenError(Exception):
+    """サーキットが開いているため呼び出さなかった"""
+
+    def __init__(self, name: str):
+        super().__init__(f"サーキット '{name}' が開いています")
+        self.name = name
+
+
+# ---------------------------------------------------------------------------
+# デッドライン
+# ---------------------------------------------------------------------------
+
+_deadline = contextvars.ContextVar("badminton_deadline", default=None)
+
+
+def start_deadline(seconds: float = REQUEST_DEADLINE) -> float:
+    """リクエストの開始時に呼び、以降のステージの持ち時間をこの締め切りから割り当てる"""
+    deadline = time.monotonic() + seconds
+    _deadline.set(deadline)
+    return deadline
+
+
+def has_deadline() -> bool:
+    return _deadline.get() is not None
+
+
+def remaining() -> Optional[float]:
+    """締め切りまでの残り秒数（締め切りがなければ None）"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def stage_timeout(stage: str) -> float:
+    """
+    ステージの持ち時間（秒）
+
+    ステージの上限と、締め切りまでの残りの小さい方。LLM生成より前のステージは
+    LLM_MIN_BUDGET 秒を後段に残す。締め切りがなければステージの上限を返す。
+    """
+    cap = STAGE_TIMEOUTS[stage]
+    left = remaining()
+    if left is None:
+        return cap
+    if stage != "llm":
+        left -= LLM_MIN_BUDGET
+    return max(0.0, min(cap, left))
+
+
+def request_timeout(stage: str) -> Optional[float]:
+    """リクエスト内なら stage_timeout、バックグラウンド処理（締め切りなし）なら None"""
+    return stage_timeout(stage) if has_deadline() else None
+
+
+# ---------------------------------------------------------------------------
+# サーキットブレーカー
+# ---------------------------------------------------------------------------
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    依存先1つ分のサーキットブレーカー
+
+    連続 failure_threshold 回失敗すると開き、reset_timeout 秒間は allow() が False を返す。
+    その後は1件だけ試行を通し（半開）、成功すれば閉じ、失敗すればまた開く。
+    依存先を呼ぶ前に持ち時間が尽きた場合（BudgetExhausted）は成功にも失敗にも数えない。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """呼び出してよいか（開いている間は即座に False）"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            # 試行の結果が記録されないまま reset_timeout が過ぎたら次の試行を通す
+            if self.state == HALF_OPEN and (not self._probing or now - self._probe_started >= self.reset_timeout):
+                self._probing = True
+                self._probe_started = now
+                return True
+            self.rejected += 1
+        metrics.inc("circuit_rejected", dependency=self.name)
+        return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("[CIRCUIT] %s を閉じました（復旧）", self.name)
+            self.state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.trips += 1
+                logger.warning("[CIRCUIT] %s を開きました（連続失敗 %d回、%g秒間呼び出しを止めます）",
+                               self.name, self._failures, self.reset_timeout)
+
+    def release(self) -> None:
+        """allow() で通したが依存先を呼ばずに終わった（半開の試行枠を返す）"""
+        with self._lock:
+            self._probing = False
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """fn を呼び、結果をブレーカーに記録する。開いていれば CircuitOpenError"""
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+        try:
+            result = fn(*args, **kwargs)
+        except BudgetExhausted:
+            self.release()
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, fn: Callable, *args, **kwargs):
+        """call の非同期版（fn はコルーチン関数）"""
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+        try:
+            result = await fn(*args, **kwargs)
+        except BudgetExhausted:
+            self.release()
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": _STATE_VALUES[self.state],
+                "failures": self._failures,
+                "trips": self.trips,
+                "rejected": self.rejected
+            }
+
+
+class CircuitBreakerRegistry:
+    """依存先名 -> CircuitBreaker"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    name, CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+                )
+        return breaker
+
+    def metrics(self) -> Dict[str, Any]:
+        return {name: breaker.metrics() for name, breaker in list(self._breakers.items())}
+
+
+circuit_breakers = CircuitBreakerRegistry(
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=CIRCUIT_RESET_TIMEOUT
+)
+
+
+# ---------------------------------------------------------------------------
+# ヘッジ
+# ---------------------------------------------------------------------------
+
+# 同期版のヘッジで本体と複製を走らせるスレッドプール
+hedge_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("HEDGE_MAX_WORKERS", "16")),
+    thread_name_prefix="badminton-hedge"
+)
+
+_hedge_counts: Dict[str, list] = {}
+_hedge_lock = threading.Lock()
+
+
+def hedge_delay(stage: str) -> Optional[float]:
+    """ヘッジを送るまでの待ち時間（ステージの直近 p95）。サンプル不足・無効時は None"""
+    if not HEDGE_ENABLED:
+        return None
+    histogram = metrics.histogram(stage)
+    if histogram is None or histogram.count < HEDGE_MIN_SAMPLES:
+        return None
+    return max(HEDGE_MIN_DELAY, histogram.quantile(HEDGE_PERCENTILE))
+
+
+def _count_call(stage: str) -> None:
+    with _hedge_lock:
+        _hedge_counts.setdefault(stage, [0, 0])[0] += 1
+
+
+def _take_hedge(stage: str) -> bool:
+    """ヘッジの割合が HEDGE_MAX_RATIO 以下ならヘッジを1本数えて True"""
+    with _hedge_lock:
+        counts = _hedge_counts.setdefault(stage, [0, 0])
+        if counts[1] + 1 > counts[0] * HEDGE_MAX_RATIO:
+            return False
+        counts[1] += 1
+    metrics.inc("hedged", stage=stage)
+    return True
+
+
+def hedge_metrics() -> Dict[str, Any]:
+    with _hedge_lock:
+        return {stage: {"calls": calls, "hedged": hedged} for stage, (calls, hedged) in _hedge_counts.items()}
+
+
+def hedged_call(stage: str, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+    """
+    fn(*args, **kwargs) を呼び、stage の p95 を過ぎても返らなければ同じ呼び出しをもう1本送る
+
+    先に成功した方の結果を返す（両方失敗すれば後の例外を送出）。timeout 秒以内に
+    どちらも返らなければ DeadlineExceeded。fn は冪等な読み取りであること。
+    timeout もヘッジもなければ呼び出し元のスレッドでそのまま実行する。
+    """
+    _count_call(stage)
+    delay = hedge_delay(stage)
+    if timeout is None and delay is None:
+        return fn(*args, **kwargs)
+    if timeout is not None and timeout <= 0:
+        metrics.inc("deadline_exceeded", stage=stage)
+        raise BudgetExhausted(f"{stage} の持ち時間が残っていません")
+
+    start = time.monotonic()
+    # copy_context: 本体・複製の span にもトレースIDと締め切りを引き継ぐ
+    pending = {hedge_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)}
+    hedge = None
+    error = None
+    while pending:
+        elapsed = time.monotonic() - start
+        wait_for = None if timeout is None else max(0.0, timeout - elapsed)
+        if hedge is None and delay is not None and (wait_for is None or delay - elapsed < wait_for):
+            wait_for = max(0.0, delay - elapsed)
+        done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    metrics.inc("hedge_wins", stage=stage)
+                return future.result()
+            error = future.exception()
+        if done:
+            continue
+        if hedge is None and delay is not None and (timeout is None or time.monotonic() - start < timeout):
+            delay = None
+            if _take_hedge(stage):
+                hedge = hedge_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+                pending.add(hedge)
+            continue
+        metrics.inc("deadline_exceeded", stage=stage)
+        raise DeadlineExceeded(f"{stage} が {timeout:.2f}秒以内に完了しませんでした")
+    raise error
+
+
+async def hedged_call_async(stage: str, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+    """hedged_call の非同期版（fn はコルーチン関数。負けた方はキャンセルする）"""
+    _count_call(stage)
+    delay = hedge_delay(stage)
+    if timeout is None and delay is None:
+        return await fn(*args, **kwargs)
+    if timeout is not None and timeout <= 0:
+        metrics.inc("deadline_exceeded", stage=stage)
+        raise BudgetExhausted(f"{stage} の持ち時間が残っていません")
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    pending = {asyncio.ensure_future(fn(*args, **kwargs))}
+    hedge = None
+    error = None
+    try:
+        while pending:
+            elapsed = loop.time() - start
+            wait_for = None if timeout is None else max(0.0, timeout - elapsed)
+            if hedge is None and delay is not None and (wait_for is None or delay - elapsed < wait_for):
+                wait_for = max(0.0, delay - elapsed)
+            done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        metrics.inc("hedge_wins", stage=stage)
+                    return task.result()
+                error = task.exception()
+            if done:
+                continue
+            if hedge is None and delay is not None and (timeout is None or loop.time() - start < timeout):
+                delay = None
+                if _take_hedge(stage):
+                    hedge = asyncio.ensure_future(fn(*args, **kwargs))
+                    pending.add(hedge)
+                continue
+            metrics.inc("deadline_exceeded", stage=stage)
+            raise DeadlineExceeded(f"{stage} が {timeout:.2f}秒以内に完了しませんでした")
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
@@ -1,15 +1,246 @@
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 from datetime import datetime
 from decimal import Decimal
+import os
+import threading
+import time
 import uuid
+from clients import get_dynamodb_resource
+from observability import logger, span
+from resilience import CLOSED, CircuitOpenError, circuit_breakers
 
 # DynamoDBクライアントを初期化
-dynamodb = boto3.resource('dynamodb', region_name='ap-northeast-1')  # 東京リージョンの例
+dynamodb = get_dynamodb_resource()
 table = dynamodb.Table('badminton_chat_logs')  # テーブル名
 
-def save_to_dynamodb_async(message, bot_response, user_info, cached_result=None, processing_time=None, vector_id=None):
+# BatchWriteItem の1回あたりの上限件数
+DYNAMODB_BATCH_LIMIT = 25
+# 再試行しても成功しないエラー（アイテムのサイズ超過・形式の誤りなど）
+NON_RETRYABLE_ERRORS = {'ValidationException', 'SerializationException', 'ItemCollectionSizeLimitExceededException'}
+
+
+def _is_non_retryable(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in NON_RETRYABLE_ERRORS
+
+
+class ChatLogSink:
+    """
+    チャットログを非同期・バッチでDynamoDBに書き込むシンク
+
+    save_to_dynamodb_async から渡されたアイテムをバッファに溜め、件数（最大25件）
+    または経過時間をトリガーにバックグラウンドスレッドでまとめて書き込む。
+    未処理アイテム（UnprocessedItems）は指数バックオフでリトライする。
+    DynamoDBのサーキットが開いている間は書き込みを試みず、max_wait 秒まで回復を待つ。
+    サイズ超過などアイテム自体が原因のエラーはリトライせず failed に数える。
+    """
+
+    def __init__(self, table, batch_size=DYNAMODB_BATCH_LIMIT, flush_interval=2.0, max_buffer=1000,
+                 max_retries=5, retry_backoff=0.2, max_wait=60.0):
+        self.table = table
+        self.batch_size = min(batch_size, DYNAMODB_BATCH_LIMIT)
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_wait = max_wait
+
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._worker = None
+        self._closed = False
+        self._flushing = 0
+
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def start(self):
+        with self._cond:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name="chat-log-sink", daemon=True)
+            self._worker.start()
+
+    def put(self, item):
+        """アイテムをバッファに追加する（ブロックしない）"""
+        self.start()
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                print("[DYNAMODB] シャットダウン中のためログを破棄")
+                return
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.pop(0)
+                self.dropped += 1
+                logger.warning("[DYNAMODB] バッファ満杯のため最古のログを破棄")
+            self._buffer.append(item)
+            if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._buffer and not self._closed:
+                    self._cond.wait()
+                if len(self._buffer) < self.batch_size and not self._closed:
+                    # 件数が揃うまで最大 flush_interval 秒待つ
+                    self._cond.wait(self.flush_interval)
+                if self._closed and not self._buffer:
+                    self._cond.notify_all()
+                    return
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                self._flushing += 1
+
+            try:
+                if batch:
+                    self._write_batch(batch)
+                    self.flushes += 1
+            finally:
+                with self._cond:
+                    self._flushing -= 1
+                    self._cond.notify_all()
+
+    def _batch_write_item(self, breaker, request_items):
+        """
+        BatchWriteItem を1回呼ぶ。開いていれば CircuitOpenError
+
+        アイテムの内容が原因のエラー（NON_RETRYABLE_ERRORS）は DynamoDB 自体は応答して
+        いるため、ブレーカーには失敗として記録しない。
+        """
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        try:
+            with span("log_write", items=sum(len(v) for v in request_items.values())):
+                response = self.table.meta.client.batch_write_item(RequestItems=request_items)
+        except Exception as e:
+            if _is_non_retryable(e):
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+            raise
+        breaker.record_success()
+        return response
+
+    def _write_batch(self, items):
+        """
+        最大25件を BatchWriteItem で書き込み、未処理分をバックオフ付きでリトライ
+
+        リトライは max_retries 回まで、サーキットが開いている間の待機も含めて max_wait 秒まで。
+        どちらかを超えた分と、再試行しても成功しないエラーのアイテムは failed に数える。
+        """
+        request_items = {
+            self.table.name: [{'PutRequest': {'Item': item}} for item in items]
+        }
+        attempt = 0
+        give_up_at = time.monotonic() + self.max_wait
+        breaker = circuit_breakers.get("dynamodb")
+
+        while request_items:
+            pending = sum(len(v) for v in request_items.values())
+            try:
+                response = self._batch_write_item(breaker, request_items)
+                unprocessed = response.get('UnprocessedItems') or {}
+            except CircuitOpenError:
+                # 障害中はリトライ回数を消費せず、ブレーカーが試行を許すまで待つ（max_wait まで）
+                if time.monotonic() >= give_up_at:
+                    self.failed += pending
+                    logger.error("[DYNAMODB] サーキットが開いたままのため%d件の書き込みを断念しました", pending)
+                    break
+                time.sleep(min(1.0, breaker.reset_timeout))
+                continue
+            except (ClientError, BotoCoreError) as e:
+                if _is_non_retryable(e):
+                    self._write_rejected(request_items, e)
+                    break
+                logger.warning("[DYNAMODB] バッチ書き込みエラー: %s", e)
+                if breaker.state != CLOSED and time.monotonic() < give_up_at:
+                    # この失敗でサーキットが開いた（または復旧の試行が失敗した）。回復を待つ
+                    continue
+                unprocessed = request_items
+
+            remaining = sum(len(v) for v in unprocessed.values())
+            self.written += pending - remaining
+            request_items = unprocessed
+
+            if not request_items:
+                break
+
+            attempt += 1
+            if attempt > self.max_retries or time.monotonic() >= give_up_at:
+                self.failed += remaining
+                logger.error("[DYNAMODB] %d件の書き込みを断念しました", remaining)
+                break
+
+            wait = self.retry_backoff * (2 ** (attempt - 1))
+            logger.warning("[DYNAMODB] 未処理%d件を%.2f秒後にリトライ", remaining, wait)
+            time.sleep(wait)
+
+    def _write_rejected(self, request_items, error):
+        """
+        再試行しても成功しないエラーになったバッチを処理する
+
+        どのアイテムが原因かは分からないため、複数件のバッチは1件ずつ書き直し、
+        原因のアイテムだけを failed に数える。
+        """
+        requests = [request for value in request_items.values() for request in value]
+        if len(requests) == 1:
+            self.failed += 1
+            logger.error("[DYNAMODB] 書き込めないログを破棄しました: %s", error)
+            return
+        logger.warning("[DYNAMODB] バッチが拒否されたため1件ずつ書き直します: %s", error)
+        for request in requests:
+            self._write_batch([request['PutRequest']['Item']])
+
+    def flush(self, timeout=10.0):
+        """バッファを空にし、書き込み中のバッチが終わるまで待つ"""
+        deadline = time.time() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._buffer or self._flushing:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._worker is None or not self._worker.is_alive():
+                    break
+                self._cond.notify_all()
+                self._cond.wait(min(remaining, 0.1))
+            return not self._buffer and not self._flushing
+
+    def close(self, timeout=10.0):
+        """新規受付を止めて残りを書き出す（SIGINT時に呼ぶ）"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        print(f"[DYNAMODB] 残りのチャットログを書き込み中... ({len(self._buffer)}件)")
+        done = self.flush(timeout)
+        print(f"[DYNAMODB] チャットログ書き込み{'完了' if done else 'タイムアウト'}")
+        return done
+
+    def metrics(self):
+        return {
+            'buffered': len(self._buffer),
+            'written': self.written,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'flushes': self.flushes
+        }
+
+
+chat_log_sink = ChatLogSink(
+    table,
+    batch_size=int(os.getenv('CHAT_LOG_BATCH_SIZE', str(DYNAMODB_BATCH_LIMIT))),
+    flush_interval=float(os.getenv('CHAT_LOG_FLUSH_INTERVAL', '2.0')),
+    max_wait=float(os.getenv('CHAT_LOG_MAX_WAIT', '60'))
+)
+
+def save_to_dynamodb_async(message, bot_response, user_info, cached_result=None, processing_time=None, vector_id=None,
+                           response_tier=None):
     """
     バドミントンチャットのやり取りをDynamoDBに保存（saved_vector_id対応版）
+
+    アイテムは ChatLogSink のバッファに積むだけで、書き込みはバックグラウンドで
+    バッチ実行される。生成した chat_id はすぐに返す。
     
     Args:
         message: ユーザーの質問
@@ -18,10 +249,9 @@ def save_to_dynamodb_async(message, bot_response, user_info, cached_result=None,
         cached_result: キャッシュ結果（ヒットした場合）
         processing_time: AI処理時間（秒）
         vector_id: 新規回答生成時のベクトルID（キャッシュ時はNone）
+        response_tier: 応答に使った tier（hit / near_miss / miss / routed / coalesced / shed）
     """
     try:
-        print("[DYNAMODB] データ保存開始...")
-        
         # 一意のIDを生成
         chat_id = str(uuid.uuid4())
         
@@ -40,7 +270,10 @@ def save_to_dynamodb_async(message, bot_response, user_info, cached_result=None,
             
             # キャッシュ情報
             'is_cached_response': is_cached,
-            'cache_similarity_score': float(cached_result.get('similarity_score', 0)) if cached_result and cached_result.get('found') else 0,
+            'response_tier': response_tier or ('hit' if is_cached else 'miss'),
+            'cache_tier': cached_result.get('tier', 'miss') if cached_result else 'miss',
+            # hit・near_miss の類似度（near_miss は調整に使った回答の類似度）
+            'cache_similarity_score': float(cached_result.get('score') or 0) if cached_result else 0,
             'cache_vector_id': cached_result.get('vector_id', '') if cached_result else '',
             
             # パフォーマンス情報
@@ -56,9 +289,7 @@ def save_to_dynamodb_async(message, bot_response, user_info, cached_result=None,
         # 新規回答生成時のみsaved_vector_idを追加
         if not is_cached and vector_id:
             item['saved_vector_id'] = vector_id
-            print(f"[DYNAMODB] 新規生成 - ベクトルID保存: {vector_id}")
-        elif is_cached:
-            print(f"[DYNAMODB] キャッシュ利用 - ベクトルID保存なし")
+            logger.debug("[DYNAMODB] 新規生成 - ベクトルID保存: %s", vector_id)
         
         # Decimal型に変換（DynamoDBの数値型要件）
         if 'cache_similarity_score' in item:
@@ -66,23 +297,22 @@ def save_to_dynamodb_async(message, bot_response, user_info, cached_result=None,
         if 'processing_time_seconds' in item:
             item['processing_time_seconds'] = Decimal(str(item['processing_time_seconds']))
         
-        # DynamoDBに保存
-        response = table.put_item(Item=item)
+        # DynamoDBへの書き込みはシンクに任せる
+        chat_log_sink.put(item)
         
-        print(f"[DYNAMODB] 保存成功: {chat_id}")
-        print(f"[DYNAMODB] キャッシュ利用: {'はい' if item['is_cached_response'] else 'いいえ'}")
-        print(f"[DYNAMODB] 処理時間: {item['processing_time_seconds']}秒")
+        logger.debug("[DYNAMODB] 保存キュー投入: %s (tier: %s, 処理時間: %s秒)",
+                     chat_id, item['response_tier'], item['processing_time_seconds'])
         
         return {
             'success': True,
+            'queued': True,
             'chat_id': chat_id,
             'saved_at': item['created_at'],
             'saved_vector_id': vector_id if not is_cached else None  # 新規生成時のベクトルIDを返す
         }
         
     except Exception as e:
-        print(f"[DYNAMODB] 保存エラー: {str(e)}")
-        print(f"[DYNAMODB] エラータイプ: {type(e).__name__}")
+        logger.error("[DYNAMODB] 保存エラー: %s (%s)", e, type(e).__name__)
         return {
             'success': False,
             'error': str(e)
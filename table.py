@@ -1,8 +1,8 @@
-import boto3
 from pprint import pprint
+from clients import get_dynamodb_resource
 
 # DynamoDB クライアントを作成
-dynamodb = boto3.client('dynamodb', region_name='ap-northeast-1')
+dynamodb = get_dynamodb_resource().meta.client
 
 # テーブル名
 table_name = 'badminton_chat_logs'
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+
+from admission import AdmissionController
+
+
+def _acquire_in_thread(controller, results, name, timeout=5.0):
+    def run():
+        results.append((name, controller.acquire(timeout)))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def _wait_until(predicate):
+    deadline = time.monotonic() + 5
+    while not predicate():
+        assert time.monotonic() < deadline, "条件が満たされない"
+        time.sleep(0.001)
+
+
+def _wait_for_queue(controller, depth):
+    _wait_until(lambda: controller.metrics()["queue_depth"] >= depth)
+
+
+def test_admits_up_to_limit_then_sheds_when_queue_full():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=5.0)
+    assert controller.acquire()
+
+    results = []
+    waiter = _acquire_in_thread(controller, results, "queued")
+    _wait_for_queue(controller, 1)
+
+    # 枠も待ち行列も埋まっているので即座に shed
+    assert controller.acquire() is False
+    assert controller.metrics()["shed_queue_full"] == 1
+    assert controller.overloaded
+
+    controller.release()
+    waiter.join(5)
+    assert results == [("queued", True)]
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    controller = AdmissionController(max_concurrent=1, max_queue=3)
+    assert controller.acquire()
+
+    results, threads = [], []
+    for name in ("first", "second", "third"):
+        threads.append(_acquire_in_thread(controller, results, name))
+        _wait_for_queue(controller, len(threads))
+
+    for admitted in range(1, len(threads) + 1):
+        controller.release()
+        _wait_until(lambda: len(results) >= admitted)
+
+    assert [name for name, _ in results] == ["first", "second", "third"]
+    assert all(admitted for _, admitted in results)
+    assert controller.metrics()["active_generations"] == 1
+
+
+def test_queue_timeout_sheds_and_frees_the_queue_slot():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+    assert controller.acquire()
+
+    assert controller.acquire() is False
+    metrics = controller.metrics()
+    assert metrics["shed_timeout"] == 1
+    assert metrics["queue_depth"] == 0
+
+    # タイムアウトした待ちは枠を持たないので、返却すると空きに戻る
+    controller.release()
+    assert controller.metrics()["active_generations"] == 0
+    assert controller.acquire(0)
+
+
+def test_async_waiter_is_granted_before_later_arrivals():
+    controller = AdmissionController(max_concurrent=1, max_queue=2)
+    assert controller.acquire()
+
+    async def run():
+        order = []
+
+        async def wait(name):
+            if await controller.acquire_async(5.0):
+                order.append(name)
+
+        first = asyncio.create_task(wait("first"))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(wait("second"))
+        await asyncio.sleep(0.01)
+
+        controller.release()
+        await first
+        controller.release()
+        await second
+        return order
+
+    assert asyncio.run(run()) == ["first", "second"]
+
+
+def test_async_timeout_sheds():
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+    assert controller.acquire()
+
+    assert asyncio.run(controller.acquire_async(0.05)) is False
+    assert controller.metrics()["shed_timeout"] == 1
+    assert controller.metrics()["queue_depth"] == 0
@@ -0,0 +1,27 @@
+from cache_mirror import VectorMirror
+
+
+def _mirror():
+    mirror = VectorMirror()
+    mirror.replace_all(
+        ["canonical", "alternative", "legacy"],
+        [[1.0, 0.0], [0.9, 0.1], [1.0, 0.01]],
+        [
+            {"answer_id": "canonical", "kind": "canonical", "text": "回答"},
+            {"answer_id": "canonical", "kind": "alternative"},
+            {"question": "旧形式", "text": "旧回答"}
+        ]
+    )
+    return mirror
+
+
+def test_search_groups_groups_by_answer_and_looks_up_canonical():
+    groups = _mirror().search_groups([1.0, 0.0], "answer_id", limit=5, with_lookup=True)
+    assert [group.id for group in groups] == ["canonical"]
+    assert groups[0].hits[0].id == "canonical"
+    assert groups[0].lookup.payload["text"] == "回答"
+
+
+def test_search_groups_skips_points_without_group_key_like_qdrant():
+    groups = _mirror().search_groups([1.0, 0.01], "answer_id", limit=5)
+    assert "legacy" not in [group.id for group in groups]
@@ -0,0 +1,61 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from cache_mirror import VectorMirror
+from cache_snapshot import MirrorSync, SnapshotWriter
+
+
+class FakeQdrant:
+    """scroll だけを持つQdrantクライアント（timestamp の範囲条件は gte として扱う）"""
+
+    def __init__(self, points):
+        self.points = points
+
+    def scroll(self, collection_name, limit, offset, with_payload, with_vectors, scroll_filter=None):
+        ids = sorted(self.points)
+        if scroll_filter is not None:
+            since = scroll_filter.must[0].range.gte.replace(tzinfo=None)
+            ids = [point_id for point_id in ids
+                   if datetime.fromisoformat(self.points[point_id][1]["timestamp"]) >= since]
+        start = offset or 0
+        page = ids[start:start + limit]
+        records = [SimpleNamespace(id=point_id, vector=self.points[point_id][0] if with_vectors else None,
+                                   payload=self.points[point_id][1]) for point_id in page]
+        return records, (start + limit if start + limit < len(ids) else None)
+
+
+def _point(i, timestamp):
+    vector = [0.0] * 4
+    vector[i % 4] = 1.0
+    return vector, {"question": f"q{i}", "answer": f"a{i}", "timestamp": timestamp}
+
+
+def _synced_mirror(client):
+    mirror = VectorMirror()
+    mirror.replace_all(list(client.points), [v for v, _ in client.points.values()],
+                       [p for _, p in client.points.values()])
+    mirror.ready = True
+    sync = MirrorSync(mirror, interval=0)
+    sync.start(client)
+    return mirror, sync
+
+
+def test_sync_without_changes_does_not_touch_the_mirror(tmp_path):
+    client = FakeQdrant({str(i): _point(i, f"2026-10-0{i + 1}T00:00:00") for i in range(3)})
+    mirror, sync = _synced_mirror(client)
+    writer = SnapshotWriter(mirror, str(tmp_path))
+    version = mirror.version
+
+    assert sync.sync() == {"applied": 0, "removed": 0}
+    assert mirror.version == version
+    assert writer.save_if_changed() is False
+
+
+def test_sync_applies_new_and_deleted_points():
+    client = FakeQdrant({str(i): _point(i, f"2026-10-0{i + 1}T00:00:00") for i in range(3)})
+    mirror, sync = _synced_mirror(client)
+
+    client.points["9"] = _point(9, "2026-10-09T00:00:00")
+    del client.points["0"]
+    assert sync.sync() == {"applied": 1, "removed": 1}
+    assert mirror.ids() == {"1", "2", "9"}
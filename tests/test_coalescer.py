@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import pytest
+
+from coalescer import ABANDONED_MESSAGE, GenerationCoalescer
+
+
+def _follow_in_thread(flight, timeout=5.0):
+    """フォロワーを別スレッドで動かし、受け取った回答全文の列を返す"""
+    received, errors = [], []
+
+    def run():
+        try:
+            received.extend(flight.follow(timeout))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, received, errors
+
+
+def test_follower_joining_mid_generation_sees_partial_and_final_text():
+    coalescer = GenerationCoalescer(linger=30.0)
+    flight, is_leader = coalescer.join("スマッシュのコツは？")
+    assert is_leader
+
+    flight.publish("スマッシュは")
+    follower, is_leader = coalescer.join("スマッシュのコツは？")
+    assert follower is flight and not is_leader
+
+    thread, received, errors = _follow_in_thread(follower)
+    flight.publish("スマッシュは打点が大事です")
+    flight.finish()
+    coalescer.release(flight)
+    thread.join(5)
+
+    assert not errors
+    assert received[0].startswith("スマッシュは")
+    assert received[-1] == "スマッシュは打点が大事です"
+    assert coalescer.metrics()["followers_exact"] == 1
+
+    # 完了後も linger の間は同じ回答を共有する
+    late, is_leader = coalescer.join("スマッシュのコツは？")
+    assert late is flight and not is_leader
+    assert list(late.follow(1.0)) == ["スマッシュは打点が大事です"]
+
+
+def test_similar_question_joins_by_embedding():
+    coalescer = GenerationCoalescer(similarity=0.95)
+    flight, _ = coalescer.join("スマッシュのコツは？", embedding=[1.0, 0.0])
+
+    follower, is_leader = coalescer.join("スマッシュのコツを教えて", embedding=[0.99, 0.05])
+
+    assert follower is flight and not is_leader
+    assert coalescer.metrics()["followers_similar"] == 1
+
+
+def test_leader_failure_propagates_abandoned_message_to_followers():
+    coalescer = GenerationCoalescer()
+    flight, _ = coalescer.join("ドライブの打ち方")
+    follower, _ = coalescer.join("ドライブの打ち方")
+
+    thread, received, errors = _follow_in_thread(follower)
+    # リーダーが finish() せずに抜けた（例外など）
+    coalescer.release(flight)
+    thread.join(5)
+
+    assert not errors
+    assert received == [ABANDONED_MESSAGE]
+    assert not flight.shareable
+
+    # 中断された回答は後続と共有せず、次のリクエストが新たなリーダーになる
+    retry, is_leader = coalescer.join("ドライブの打ち方")
+    assert is_leader and retry is not flight
+
+
+def test_leader_failure_propagates_to_async_follower():
+    coalescer = GenerationCoalescer()
+    flight, _ = coalescer.join("ヘアピンのコツ")
+    follower, _ = coalescer.join("ヘアピンのコツ")
+
+    async def run():
+        async def fail_leader():
+            await asyncio.sleep(0.01)
+            await asyncio.to_thread(coalescer.release, flight)
+
+        task = asyncio.create_task(fail_leader())
+        received = [text async for text in follower.follow_async(5.0)]
+        await task
+        return received
+
+    assert asyncio.run(run()) == [ABANDONED_MESSAGE]
+
+
+def test_follower_times_out_when_leader_stalls():
+    coalescer = GenerationCoalescer()
+    flight, _ = coalescer.join("ロブの高さ")
+    follower, _ = coalescer.join("ロブの高さ")
+
+    with pytest.raises(TimeoutError):
+        list(follower.follow(0.05))
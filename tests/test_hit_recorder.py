@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+
+import hit_recorder as hit_recorder_module
+from hit_recorder import LAST_HIT_FIELD, HitRecorder
+
+
+class FakeQdrant:
+    """set_payload は存在しない点を含むと失敗する（wait=True のときのQdrantと同じ）"""
+
+    def __init__(self, existing):
+        self.existing = set(existing)
+        self.down = False
+        self.writes = []
+
+    def set_payload(self, collection_name, payload, points, wait):
+        assert wait is True
+        if self.down:
+            raise ConnectionError("qdrant unavailable")
+        missing = set(points) - self.existing
+        if missing:
+            raise ValueError(f"No point with id {sorted(missing)[0]} found")
+        self.writes.append((sorted(points), payload))
+
+    def retrieve(self, collection_name, ids, with_payload, with_vectors):
+        if self.down:
+            raise ConnectionError("qdrant unavailable")
+        return [SimpleNamespace(id=point_id) for point_id in ids if point_id in self.existing]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    fake = FakeQdrant({"a", "b", "c"})
+    monkeypatch.setattr(hit_recorder_module, "get_qdrant_client", lambda: fake)
+    return fake
+
+
+def _recorder(*answer_ids):
+    recorder = HitRecorder(flush_interval=3600)
+    for answer_id in answer_ids:
+        recorder._pending.add(answer_id)
+    return recorder
+
+
+def test_flush_writes_all_hits(client):
+    recorder = _recorder("a", "b")
+    assert recorder.flush() == 2
+    assert client.writes[0][0] == ["a", "b"]
+    assert LAST_HIT_FIELD in client.writes[0][1]
+
+
+def test_flush_skips_deleted_point(client):
+    recorder = _recorder("a", "b", "c", "deleted")
+    assert recorder.flush() == 3
+    assert client.writes == [(["a", "b", "c"], client.writes[0][1])]
+    assert recorder.metrics()["missing"] == 1
+    assert recorder.metrics()["pending"] == 0
+
+
+def test_flush_keeps_hits_when_qdrant_is_down(client):
+    recorder = _recorder("a", "b")
+    client.down = True
+    assert recorder.flush() == 0
+    assert recorder.metrics()["pending"] == 2
+
+    client.down = False
+    assert recorder.flush() == 2
+    assert client.writes[-1][0] == ["a", "b"]
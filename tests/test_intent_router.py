@@ -0,0 +1,73 @@
+from datetime import date
+
+import pytest
+
+from intent_router import intent_router
+
+# 2026-10-18（日曜日）
+TODAY = date(2026, 10, 18)
+
+
+@pytest.mark.parametrize("message, period, target, aspect", [
+    ("来週の練習はどこ？", "next_week", None, "venue"),
+    ("今週の練習予定は？", "this_week", None, None),
+    ("今月のスケジュールを教えて", "this_month", None, None),
+    ("今週の練習は？", "this_week", None, None),
+    ("来週の練習は？", "next_week", None, None),
+    ("次の練習は？", "upcoming", None, None),
+    ("今月の練習", "this_month", None, None),
+    ("明日の練習ってありますか", None, date(2026, 10, 19), None),
+    ("次の練習はいつ？", "upcoming", None, "time"),
+    ("明日練習ある？", None, date(2026, 10, 19), None),
+    ("3月15日の練習は何時から？", None, date(2027, 3, 15), "time"),
+    ("3/15の練習はどこ", None, date(2027, 3, 15), "venue"),
+    ("木曜日の練習はどこ？", None, date(2026, 10, 22), "venue"),
+])
+def test_schedule_questions_are_routed(message, period, target, aspect):
+    route = intent_router.classify(message, today=TODAY)
+    assert route["route"] == "schedule"
+    assert route["period"] == period
+    assert route["date"] == target
+    assert route["aspect"] == aspect
+
+
+@pytest.mark.parametrize("message", [
+    "練習時間を短くするには？",
+    "1/2の確率で勝てる練習",
+    "練習後の飲み会はいつ？",
+    "来週の練習後の飲み会はいつ？",
+    "練習は何時間くらいですか",
+    "練習はいつ？",
+    "来週のスマッシュ練習のコツ",
+    "来週の練習の参加費はいくら？",
+    "スマッシュを速くするには？",
+    "来週のスマッシュ練習は？",
+    "今週の練習メニューは？",
+    "今週の練習でやったドライブのコツ",
+])
+def test_other_questions_go_to_llm(message):
+    assert intent_router.classify(message, today=TODAY)["route"] == "llm"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("3月15日", date(2027, 3, 15)),
+    ("3/15", date(2027, 3, 15)),
+    ("3/15(日)の練習", date(2027, 3, 15)),
+    ("12/3から練習ある?", date(2026, 12, 3)),
+    ("10月18日", date(2026, 10, 18)),
+    ("1/2の確率", None),
+    ("1/2のラリー", None),
+    ("1/2.5", None),
+    ("10/12/2026", None),
+    ("2月30日", None),
+])
+def test_parse_date(text, expected):
+    assert intent_router._parse_date(text, TODAY) == expected
+
+
+def test_failed_schedule_answer_falls_back_to_llm(monkeypatch):
+    def fail(route, today=None):
+        raise RuntimeError("DynamoDB unavailable")
+
+    monkeypatch.setattr(intent_router, "answer", fail)
+    assert intent_router.route("来週の練習はどこ？") is None
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+
+import resilience
+from resilience import (CLOSED, HALF_OPEN, OPEN, BudgetExhausted, CircuitBreaker, CircuitOpenError,
+                        DeadlineExceeded, hedged_call, hedged_call_async)
+
+
+def _fail():
+    raise ConnectionError("unavailable")
+
+
+def _ok():
+    return "ok"
+
+
+def _trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        with pytest.raises(ConnectionError):
+            breaker.call(_fail)
+
+
+def test_closed_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=60)
+    with pytest.raises(ConnectionError):
+        breaker.call(_fail)
+    assert breaker.call(_ok) == "ok"
+    assert breaker.state == CLOSED
+
+    _trip(breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.call(_ok)
+    assert breaker.metrics()["rejected"] == 1
+
+
+def test_half_open_probe_success_closes():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05)
+    _trip(breaker)
+    time.sleep(0.06)
+
+    assert breaker.allow() is True
+    assert breaker.state == HALF_OPEN
+    # 試行中は他の呼び出しを通さない
+    assert breaker.allow() is False
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_failure_reopens():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05)
+    _trip(breaker)
+    time.sleep(0.06)
+
+    with pytest.raises(ConnectionError):
+        breaker.call(_fail)
+    assert breaker.state == OPEN
+    assert breaker.metrics()["trips"] == 2
+
+
+def test_exhausted_budget_is_not_a_dependency_failure():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+    for _ in range(5):
+        with pytest.raises(BudgetExhausted):
+            breaker.call(hedged_call, "test_stage", _ok, timeout=0)
+    assert breaker.state == CLOSED
+    assert breaker.metrics()["failures"] == 0
+
+
+def test_exhausted_budget_releases_half_open_probe():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05)
+    _trip(breaker)
+    time.sleep(0.06)
+
+    with pytest.raises(BudgetExhausted):
+        breaker.call(hedged_call, "test_stage", _ok, timeout=0)
+    assert breaker.state == HALF_OPEN
+    # 依存先を呼ばなかった試行の枠は次の呼び出しに回る
+    assert breaker.call(_ok) == "ok"
+    assert breaker.state == CLOSED
+
+
+def test_async_exhausted_budget_is_not_a_dependency_failure():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+
+    async def ok():
+        return "ok"
+
+    async def run():
+        with pytest.raises(BudgetExhausted):
+            await breaker.call_async(hedged_call_async, "test_stage", ok, timeout=0)
+
+    asyncio.run(run())
+    assert breaker.state == CLOSED
+
+
+def test_timeout_after_calling_counts_as_failure(monkeypatch):
+    monkeypatch.setattr(resilience, "HEDGE_ENABLED", False)
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+
+    def slow():
+        time.sleep(0.2)
+
+    with pytest.raises(DeadlineExceeded) as excinfo:
+        breaker.call(hedged_call, "test_stage", slow, timeout=0.01)
+    assert not isinstance(excinfo.value, BudgetExhausted)
+    assert breaker.state == OPEN
@@ -0,0 +1,79 @@
+from datetime import date
+
+import badminton_utils
+from badminton_utils import BadmintonScheduleManager, build_status_month
+
+
+def _matches(condition, item):
+    """boto3 の条件式（And / Equals / Between / AttributeNotExists）を評価する"""
+    expr = condition.get_expression()
+    operator, values = expr["operator"], expr["values"]
+    if operator == "AND":
+        return all(_matches(value, item) for value in values)
+    name = values[0].name
+    if operator == "attribute_not_exists":
+        return name not in item
+    if name not in item:
+        return False
+    if operator == "=":
+        return item[name] == values[1]
+    if operator == "BETWEEN":
+        return values[1] <= item[name] <= values[2]
+    raise AssertionError(f"未対応の演算子: {operator}")
+
+
+class FakeTable:
+    def __init__(self, items):
+        self.items = items
+        self.scans = 0
+
+    def query(self, KeyConditionExpression, **kwargs):
+        return {"Items": [i for i in self.items if _matches(KeyConditionExpression, i)]}
+
+    def scan(self, FilterExpression, **kwargs):
+        self.scans += 1
+        return {"Items": [i for i in self.items if _matches(FilterExpression, i)]}
+
+
+def _manager(monkeypatch, items):
+    table = FakeTable(items)
+
+    class FakeResource:
+        def Table(self, name):
+            return table
+
+    monkeypatch.setattr(badminton_utils, "get_dynamodb_resource", lambda: FakeResource())
+    return BadmintonScheduleManager(), table
+
+
+def _practice(day, indexed=True):
+    item = {"date": day, "status": "active"}
+    if indexed:
+        item["status_month"] = build_status_month("active", day)
+    return item
+
+
+def test_indexed_month_uses_query_only(monkeypatch):
+    manager, table = _manager(monkeypatch, [_practice("2026-10-20"), _practice("2026-11-03")])
+
+    practices = manager.query_practices(date(2026, 10, 18), date(2026, 11, 10))
+
+    assert [p["date"] for p in practices] == ["2026-10-20", "2026-11-03"]
+    assert table.scans == 0
+
+
+def test_empty_gsi_month_falls_back_to_unindexed_rows(monkeypatch):
+    manager, table = _manager(monkeypatch, [_practice("2026-10-20"), _practice("2026-11-03", indexed=False)])
+
+    practices = manager.query_practices(date(2026, 10, 18), date(2026, 11, 10))
+
+    assert [p["date"] for p in practices] == ["2026-10-20", "2026-11-03"]
+    assert table.scans == 1
+
+
+def test_empty_month_is_verified_once(monkeypatch):
+    manager, table = _manager(monkeypatch, [_practice("2026-10-20")])
+
+    manager.query_practices(date(2026, 11, 1), date(2026, 11, 30))
+    assert manager.query_practices(date(2026, 11, 1), date(2026, 11, 30)) == []
+    assert table.scans == 1